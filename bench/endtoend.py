@@ -0,0 +1,326 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+"""End-to-end benchmark over a synthetic archive.
+
+A synthetic archive of the requested size is written in the same layout as the
+GeoNet FTP tree (/strong/processed/Proc/<year>/<MM>_Prelim/<event>/Vol1/data)
+and served to :class:`sm.Server` as a local mirror, along with a matching list
+of sites. Each operation is then driven at scale against a fresh cache:
+
+    * update_sites and a full update_events crawl.
+    * get_years, get_months, get_events, get_sites and events_at_site queries.
+    * get_record with the data file missing from the cache (cold) and then
+      present (warm).
+    * The visualiser's /events listings, built (cold) and then reused (warm).
+
+The latency percentiles and throughput of each operation are written as JSON.
+To keep large archives cheap to create, every record is a hard link to one of
+a handful of template data files, so the records of an archive differ in name
+and location only.
+
+Example, for an archive of 2 years x 500 events x 20 sites (20,000 records):
+
+    python bench/endtoend.py --years 2 --events 500 --sites 20 -o results.json
+
+"""
+
+import argparse
+import json
+import os
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../'))
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../visualiser'))
+
+import sm
+import sm.batch
+from sm import instrument
+from wsgi import Application
+
+# The base directory of the processed data on the FTP server.
+BASE_DIR = 'strong/processed/Proc'
+
+
+def site_codes(count):
+    """Generate a number of distinct four character site codes.
+
+    """
+    letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    codes = []
+    for i in range(count):
+        code = ''
+        for j in range(4):
+            code = letters[i % 26] + code
+            i //= 26
+        codes.append(code)
+    return codes
+
+
+def component(axis, samples, rng):
+    """Create the text of one component of a Volume 1 data file, which holds
+    accelerations only.
+
+    """
+    lines = ['Synthetic record for benchmarking\n'] * 16
+    lines.append('2011    2   21   23   51  420    0    0 2011    2\n')
+    lines.append('  43   35    0  172   41    0    5    5   21   23\n')
+    lines.append('  43   30    0  172   38    0    0 {0:4d}  100   10\n'.format(axis))
+    lines.append('{0:6d}    0    0 {0:6d}    0    0    0    0   51 30500\n'.format(samples))
+    lines.append(' 0.0' * 10 + '\n')
+    lines.append(' 0.0 0.0 0.0 0.0 6.3 0.0 6.2 0.0 0.0 0.0\n')
+    lines.append(' {0:.3f} 0.0 0.0 0.0 0.0 0.005 0.0 0.0 0.0 9810.0\n'.format(samples * 0.005))
+    lines.extend([' 0.0' * 10 + '\n'] * 3)
+    values = rng.randn(samples) * 100
+    for i in range(0, len(values), 10):
+        lines.append(''.join('{0:8.1f}'.format(v) for v in values[i:i + 10]) + '\n')
+    return ''.join(lines)
+
+
+def create_archive(root, years, events, sites, site_pool, samples, templates,
+                   first_year=2008, seed=0):
+    """Write a synthetic archive and site list under the given directory. The
+    number of records created is returned.
+
+    """
+    rng = numpy.random.RandomState(seed)
+    codes = site_codes(site_pool)
+
+    # The template data files.
+    template_dir = os.path.join(root, 'templates')
+    os.makedirs(template_dir)
+    template_files = []
+    for i in range(templates):
+        filename = os.path.join(template_dir, '{0}.V1A'.format(i))
+        f = open(filename, 'w')
+        for axis in (0, 90, 999):
+            f.write(component(axis, samples, rng))
+        f.close()
+        template_files.append(filename)
+
+    # The site list, in the format of the GeoNet CSV file.
+    f = open(os.path.join(root, 'sites.csv'), 'w')
+    f.write('Synthetic site list\n')
+    f.write('Code,Name,Latitude,Longitude,Opened,Status,Notes\n')
+    for code in codes:
+        f.write('{0},Site {0},{1:.4f},{2:.4f},2000-01-01 00:00:00.000,Open,\n'.format(
+            code, -47 + 12 * rng.rand(), 166 + 12 * rng.rand()))
+    f.close()
+
+    # The events, spread evenly over the months of each year.
+    created = 0
+    for year in range(first_year, first_year + years):
+        for i in range(events):
+            month = 1 + i * 12 // events
+            day = 1 + rng.randint(28)
+            seconds = rng.randint(86400)
+            name = '{0}-{1:02d}-{2:02d}_{3:02d}{4:02d}{5:02d}'.format(
+                year, month, day, seconds // 3600, seconds // 60 % 60,
+                seconds % 60)
+            data_dir = os.path.join(root, BASE_DIR, str(year),
+                                    '{0:02d}_Prelim'.format(month), name,
+                                    'Vol1', 'data')
+            if os.path.isdir(data_dir):
+                continue
+            os.makedirs(data_dir)
+            prefix = name.replace('-', '')[:8] + name[10:] + '_'
+            for code in rng.choice(codes, min(sites, site_pool), replace=False):
+                filename = os.path.join(data_dir, prefix + code + '.V1A')
+                template = template_files[rng.randint(templates)]
+                try:
+                    os.link(template, filename)
+                except OSError:
+                    shutil.copyfile(template, filename)
+                created += 1
+    return created
+
+
+def summarise(latencies, elapsed=None):
+    """Summarise a list of latencies in seconds.
+
+    """
+    latencies = numpy.asarray(latencies, dtype=float)
+    if elapsed is None:
+        elapsed = latencies.sum()
+    p50, p90, p99 = numpy.percentile(latencies, [50, 90, 99])
+    return {
+        'count': len(latencies),
+        'total': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed else None,
+        'mean': latencies.mean(),
+        'p50': p50,
+        'p90': p90,
+        'p99': p99,
+        'max': latencies.max(),
+    }
+
+
+def measure(func, calls):
+    """Time a function over a list of argument tuples.
+
+    """
+    latencies = []
+    start = time.time()
+    for args in calls:
+        begin = time.time()
+        func(*args)
+        latencies.append(time.time() - begin)
+    return summarise(latencies, time.time() - start)
+
+
+def wsgi_get(application, path):
+    """Make a GET request directly to a WSGI application and read the whole
+    response.
+
+    """
+    environment = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path,
+                   'HTTP_ACCEPT_ENCODING': 'gzip'}
+    status = []
+    body = ''.join(application(environment, lambda s, h: status.append(s)))
+    if not status[0].startswith('200'):
+        raise RuntimeError('{0} returned {1}'.format(path, status[0]))
+    return body
+
+
+def run(root, samples, record_samples, seed=0):
+    """Run each benchmark against a fresh cache and return the results.
+
+    """
+    rng = random.Random(seed)
+    results = {}
+    cache_dir = os.path.join(root, 'cache')
+    server = sm.Server(cache_dir=cache_dir, mirror=root,
+                       sites_url='file://' + os.path.join(root, 'sites.csv'))
+
+    # Populating the cache. The crawl prints its progress, which we don't want
+    # in the timings.
+    results['update_sites'] = measure(server.update_sites, [()])
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        results['update_events'] = measure(server.update_events, [()])
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    pairs = list(sm.batch.all_records(server))
+    results['update_events']['records_per_second'] = (
+        len(pairs) / results['update_events']['total'])
+
+    # Catalogue queries.
+    years = server.get_years()
+    months = [(y, m) for y in years for m in server.get_months(y)]
+    events = [event for event, site in pairs]
+    codes = [site for event, site in pairs]
+    results['get_years'] = measure(server.get_years, [()] * samples)
+    results['get_months'] = measure(server.get_months,
+                                    [(rng.choice(years),) for i in range(samples)])
+    results['get_events'] = measure(server.get_events,
+                                    [rng.choice(months) for i in range(samples)])
+    results['get_sites'] = measure(server.get_sites,
+                                   [(rng.choice(events),) for i in range(samples)])
+    results['events_at_site'] = measure(server.events_at_site,
+                                        [(rng.choice(codes),) for i in range(samples)])
+
+    # Records, first downloaded from the mirror and then from the cache.
+    chosen = rng.sample(pairs, min(record_samples, len(pairs)))
+    results['get_record_cold'] = measure(server.get_record, chosen)
+    results['get_record_warm'] = measure(server.get_record, chosen)
+
+    # The visualiser's event listings. The first request for each path builds
+    # the response and later requests reuse it.
+    application = Application(cache_dir)
+    paths = ['/events'] + ['/events/{0}'.format(y) for y in years]
+    paths += ['/events/{0}/{1}'.format(y, m) for y, m in months]
+    calls = [(application, path) for path in paths]
+    results['wsgi_events_cold'] = measure(wsgi_get, calls)
+    calls = [(application, rng.choice(paths)) for i in range(samples)]
+    results['wsgi_events_warm'] = measure(wsgi_get, calls)
+
+    results['records'] = len(pairs)
+    results['events'] = len(set(events))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the library and '
+                                     'visualiser against a synthetic archive.')
+    parser.add_argument('--years', type=int, default=1,
+                        help='the number of years in the archive (default: %(default)s)')
+    parser.add_argument('--events', type=int, default=100,
+                        help='the number of events per year (default: %(default)s)')
+    parser.add_argument('--sites', type=int, default=10,
+                        help='the number of sites recording each event '
+                             '(default: %(default)s)')
+    parser.add_argument('--site-pool', type=int, default=None,
+                        help='the total number of sites (default: four times '
+                             'the sites per event)')
+    parser.add_argument('--length', type=int, default=16000,
+                        help='the number of samples in each record '
+                             '(default: %(default)s)')
+    parser.add_argument('--templates', type=int, default=4,
+                        help='the number of distinct data files '
+                             '(default: %(default)s)')
+    parser.add_argument('--samples', type=int, default=1000,
+                        help='the number of calls of each query '
+                             '(default: %(default)s)')
+    parser.add_argument('--record-samples', type=int, default=50,
+                        help='the number of records to load (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='the seed for the random choices (default: %(default)s)')
+    parser.add_argument('--workdir', default=None,
+                        help='the directory to create the archive and cache in '
+                             '(default: a temporary directory, removed afterwards)')
+    parser.add_argument('--instrument', action='store_true',
+                        help='also collect and report the sm.instrument '
+                             'measurements (this adds some overhead)')
+    parser.add_argument('-o', '--output', default=None,
+                        help='the file to write the JSON results to '
+                             '(default: standard output)')
+    args = parser.parse_args()
+
+    root = args.workdir or tempfile.mkdtemp(prefix='sm-bench-')
+    try:
+        start = time.time()
+        created = create_archive(root, args.years, args.events, args.sites,
+                                 args.site_pool or 4 * args.sites, args.length,
+                                 args.templates, seed=args.seed)
+        setup = time.time() - start
+
+        if args.instrument:
+            instrument.enable()
+        results = run(root, args.samples, args.record_samples, args.seed)
+        results['archive'] = {'years': args.years, 'events': args.events,
+                              'sites': args.sites, 'records': created,
+                              'length': args.length, 'setup': setup}
+        if args.instrument:
+            results['instrument'] = instrument.snapshot()
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(root)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        f = open(args.output, 'w')
+        f.write(output + '\n')
+        f.close()
+    else:
+        print output
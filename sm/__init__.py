@@ -13,5 +13,8 @@
 # You should have received a copy of the GNU General Public License along with
 # geomotion.  If not, see <http://www.gnu.org/licenses/>.
 
+# Record and TooFewComponents live in sm.record, which loads numpy, so they are
+# not imported here. This lets scripts which only need the cache information
+# (such as the command line interface) start quickly; import them from
+# sm.record where they are needed.
 from sm.server import Server, NoSuchSite, NoSuchRecord
-from sm.record import TooFewComponents, Record
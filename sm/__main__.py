@@ -0,0 +1,268 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Command line interface to the cache, run as ``python -m sm``. For example:
+
+    python -m sm years
+    python -m sm months 2011
+    python -m sm events 2011 6
+    python -m sm events --site CECS
+    python -m sm sites 1194 --info
+    python -m sm record 1194 CECS -o cecs.csv
+    python -m sm update --since 2011-06-01
+    python -m sm watch --interval 60
+    python -m sm export snapshot.tar.gz --site CECS
+    python -m sm import snapshot.tar.gz
+
+Output is tab separated, one item per line, so it can be fed to other tools.
+Only the record and update commands load numpy or connect to GeoNet; the
+listing commands just read the info cache.
+
+"""
+
+import argparse
+from datetime import datetime
+import errno
+import sqlite3
+import sys
+
+import pytz
+
+from sm.server import NoSuchRecord, NoSuchSite, Server, SITES_URL
+
+
+def list_years(server, args):
+    for year in server.get_years():
+        print year
+
+
+def list_months(server, args):
+    for month in server.get_months(args.year):
+        print month
+
+
+def list_events(server, args):
+    if args.site is not None:
+        events = server.events_at_site(args.site.upper())
+    elif args.year is not None and args.month is not None:
+        events = server.get_events(args.year, args.month)
+    else:
+        raise SystemExit('events: give a year and month, or a site')
+    for event, date in events:
+        print '{0}\t{1}'.format(event, date.isoformat())
+
+
+def list_sites(server, args):
+    for site in server.get_sites(args.event):
+        if not args.info:
+            print site
+            continue
+        try:
+            info = server.get_site_info(site)
+        except NoSuchSite:
+            print site
+            continue
+        print u'{0}\t{1}\t{2}\t{3}'.format(site, info['latitude'],
+                                           info['longitude'],
+                                           info['name']).encode('utf-8')
+
+
+def export_record(server, args):
+    import numpy
+
+    record = server.get_record(args.event, args.site)
+    output = sys.stdout if args.output in (None, '-') else open(args.output, 'w')
+    try:
+        if args.format == 'npy':
+            numpy.save(output, numpy.vstack((record.time, record.acceleration)))
+        else:
+            output.write('# {0} {1} {2}\n'.format(args.event, args.site.upper(),
+                                                   record.start.isoformat()))
+            output.write('# time (s), north, east, vertical (m/s/s)\n')
+            numpy.savetxt(output, numpy.column_stack((record.time,
+                                                      record.acceleration.T)),
+                          fmt='%.6g', delimiter='\t')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+def update(server, args):
+    if not args.events_only:
+        server.update_sites()
+    if not args.sites_only:
+        since = datetime.strptime(args.since, '%Y-%m-%d')
+        server.update_events(since=since)
+
+
+def watch(server, args):
+    from sm.watch import Watcher
+
+    watcher = Watcher(server.cache_dir, server.local_timezone, server.mirror,
+                      months=args.months, downloaders=args.downloaders,
+                      parsers=args.parsers)
+    try:
+        watcher.run(args.interval, args.polls)
+    except KeyboardInterrupt:
+        pass
+
+
+def export_snapshot(server, args):
+    records = None
+    if args.no_records:
+        records = []
+    elif args.site:
+        records = [(event, site.upper()) for site in args.site for event, date
+                   in server.events_at_site(site.upper())]
+    manifest = server.export_snapshot(args.filename, records,
+                                      not args.uncompressed)
+    print 'Exported {0} data files'.format(len(manifest['files']) - 1)
+
+
+def import_snapshot(server, args):
+    from sm.snapshot import BadSnapshot
+
+    try:
+        manifest = server.import_snapshot(args.filename)
+    except BadSnapshot as e:
+        raise SystemExit('{0}: {1}'.format(args.filename, e))
+    print 'Imported {0} data files'.format(len(manifest['files']) - 1)
+    if manifest['newest_event'] is not None:
+        print 'Newest event {0}; run update --since {0} to catch up'.format(
+            manifest['newest_event'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m sm',
+                                     description='Look up and update the '
+                                     'strong motion data cache.')
+    parser.add_argument('--cache', default='cache',
+                        help='the cache directory (default: %(default)s)')
+    parser.add_argument('--timezone', default='NZ',
+                        help='the timezone to show dates in (default: %(default)s)')
+    parser.add_argument('--mirror', default=None,
+                        help='a local copy of the GeoNet FTP tree to use '
+                             'instead of the FTP server')
+    parser.add_argument('--sites-url', default=SITES_URL,
+                        help='the URL of the CSV list of sites (default: the '
+                             'GeoNet list)')
+    commands = parser.add_subparsers(title='commands')
+
+    command = commands.add_parser('years', help='list the years with events')
+    command.set_defaults(func=list_years)
+
+    command = commands.add_parser('months', help='list the months of a year '
+                                  'with events')
+    command.add_argument('year', type=int)
+    command.set_defaults(func=list_months)
+
+    command = commands.add_parser('events', help='list the events of a month, '
+                                  'or the events recorded at a site')
+    command.add_argument('year', type=int, nargs='?')
+    command.add_argument('month', type=int, nargs='?')
+    command.add_argument('--site', default=None,
+                         help='list the events recorded at this site instead')
+    command.set_defaults(func=list_events)
+
+    command = commands.add_parser('sites', help='list the sites which '
+                                  'recorded an event')
+    command.add_argument('event', type=int)
+    command.add_argument('--info', action='store_true',
+                         help='also show the location and name of each site')
+    command.set_defaults(func=list_sites)
+
+    command = commands.add_parser('record', help='export the accelerations '
+                                  'of a record, downloading it if needed')
+    command.add_argument('event', type=int)
+    command.add_argument('site')
+    command.add_argument('-o', '--output', default=None,
+                         help='the file to write to (default: standard output)')
+    command.add_argument('--format', choices=('csv', 'npy'), default='csv',
+                         help='tab separated text, or a numpy array file of the '
+                              'time and the three axes (default: %(default)s)')
+    command.set_defaults(func=export_record)
+
+    command = commands.add_parser('update', help='update the cached lists of '
+                                  'sites and events')
+    command.add_argument('--since', default='1950-01-01',
+                         help='only update events from the month of this date '
+                              '(YYYY-MM-DD) onwards (default: %(default)s)')
+    group = command.add_mutually_exclusive_group()
+    group.add_argument('--sites-only', action='store_true',
+                       help='only update the sites')
+    group.add_argument('--events-only', action='store_true',
+                       help='only update the events')
+    command.set_defaults(func=update, writes=True)
+
+    command = commands.add_parser('watch', help='keep polling for new events '
+                                  'and process their records')
+    command.add_argument('--interval', type=float, default=300,
+                         help='seconds between polls (default: %(default)s)')
+    command.add_argument('--polls', type=int, default=None,
+                         help='stop after this many polls (default: never)')
+    command.add_argument('--months', type=int, default=2,
+                         help='the number of the newest months to poll '
+                              '(default: %(default)s)')
+    command.add_argument('--downloaders', type=int, default=4,
+                         help='the number of download threads '
+                              '(default: %(default)s)')
+    command.add_argument('--parsers', type=int, default=2,
+                         help='the number of parsing threads '
+                              '(default: %(default)s)')
+    command.set_defaults(func=watch, writes=True)
+
+    command = commands.add_parser('export', help='write a snapshot of the '
+                                  'cache for starting other caches from')
+    command.add_argument('filename')
+    command.add_argument('--site', action='append', default=[],
+                         help='only include the data files of this site; can '
+                              'be given more than once (default: all cached '
+                              'data files)')
+    command.add_argument('--no-records', action='store_true',
+                         help='do not include any data files')
+    command.add_argument('--uncompressed', action='store_true',
+                         help='do not gzip the snapshot')
+    command.set_defaults(func=export_snapshot)
+
+    command = commands.add_parser('import', help='replace the info cache with '
+                                  'a snapshot and add its data files')
+    command.add_argument('filename')
+    command.set_defaults(func=import_snapshot, writes=True)
+
+    args = parser.parse_args(argv)
+
+    server = Server(cache_dir=args.cache,
+                    local_timezone=pytz.timezone(args.timezone),
+                    read_only=not getattr(args, 'writes', False),
+                    mirror=args.mirror, sites_url=args.sites_url)
+    try:
+        args.func(server, args)
+    except NoSuchRecord:
+        raise SystemExit('no record of event {0} at {1}'.format(args.event,
+                                                                 args.site))
+    except sqlite3.OperationalError as e:
+        # The tables are only created by the first update.
+        if not str(e).startswith('no such table'):
+            raise
+        raise SystemExit('the cache in {0} has not been updated; run update '
+                         'first'.format(args.cache))
+    except IOError as e:
+        # Let the output be piped into head and the like.
+        if e.errno != errno.EPIPE:
+            raise
+
+
+if __name__ == '__main__':
+    main()
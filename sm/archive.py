@@ -0,0 +1,308 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Consolidated binary archive of record accelerations.
+
+Parsing the ASCII data files is slow, so for work which needs random access to
+a large number of records (such as training models) the accelerations can be
+exported into an archive. This is a directory containing two files:
+
+    * ``samples.bin`` - the acceleration of every record, one after the other,
+                        as raw binary values. Each record is stored as its
+                        three axes in turn.
+    * ``index.sqlite`` - an SQLite database giving the position, length,
+                         timestep, filename and metadata of each record in the
+                         samples file.
+
+Any record can then be read as a slice of a memory map of the samples file
+without any parsing. New records are appended to the end of the samples file,
+so the existing data never needs to be rewritten.
+
+Records are indexed by event ID and site code, but :meth:`Server.update_events`
+renumbers the events, after which an entry may be under the ID of a different
+event. Each entry therefore also stores the filename of the record on the FTP
+server, which includes the event time and site. Running :meth:`Archive.export`
+again after updating the events re-exports any record whose filename has
+changed, and passing the filename to :meth:`Archive.get` or
+:meth:`Archive.info` makes them refuse an entry for a different record.
+
+"""
+
+from datetime import datetime
+import json
+import os
+import os.path
+import sqlite3
+
+import numpy
+
+from sm.batch import all_records
+
+
+def _jsonable(value):
+    """Helper function to convert the datetimes in a metadata dictionary to
+    ISO 8601 strings so it can be encoded as JSON.
+
+    """
+    if isinstance(value, dict):
+        return dict((k, _jsonable(v)) for k, v in value.items())
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+class Archive(object):
+    """A consolidated binary archive of record accelerations. See the module
+    documentation for details of the format.
+
+    """
+
+    def __init__(self, path, dtype='float32'):
+        """
+
+        :param path: The directory containing the archive. It will be created
+                     if it does not exist.
+        :type path: string
+        :param dtype: The numpy data type to store samples as. This is only used
+                      when creating a new archive; existing archives keep the
+                      type they were created with.
+        :type dtype: string
+
+        """
+        self.path = os.path.normpath(os.path.abspath(path))
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.samples_filename = os.path.join(self.path, 'samples.bin')
+
+        # Connect to the index, creating the tables if needed.
+        self.index = sqlite3.connect(os.path.join(self.path, 'index.sqlite'))
+        self.index.row_factory = sqlite3.Row
+        self.index.execute('''create table if not exists properties (
+            name varchar primary key not null,
+            value varchar not null);''')
+        self.index.execute('''create table if not exists records (
+            event_id integer not null,
+            site varchar not null,
+            filename varchar not null,
+            offset integer not null,
+            length integer not null,
+            timestep float not null,
+            start timestamp not null,
+            metadata varchar not null,
+            primary key (event_id, site));''')
+        self.index.execute('''insert or ignore into properties (name, value)
+                           values ('dtype', ?);''', (numpy.dtype(dtype).str,))
+
+        # Archives created before filenames were stored get an empty filename
+        # for each record, so they are exported again.
+        columns = [row['name'] for row in
+                   self.index.execute('pragma table_info(records);')]
+        if 'filename' not in columns:
+            self.index.execute('''alter table records add column filename
+                               varchar not null default '';''')
+        self.index.commit()
+
+        # Use the data type the archive was created with.
+        row = self.index.execute('''select value from properties where
+                                 name='dtype';''').fetchone()
+        self.dtype = numpy.dtype(str(row['value']))
+
+        # The memory map of the samples file, created when first needed.
+        self._map = None
+
+    def __del__(self):
+        self.index.close()
+
+    def __len__(self):
+        return self.index.execute('select count(*) from records;').fetchone()[0]
+
+    def __contains__(self, key):
+        event, site = key
+        row = self.index.execute('''select 1 from records where event_id=? and
+                                 site=?;''', (event, site)).fetchone()
+        return row is not None
+
+    def keys(self):
+        """Get a list of the (event ID, site code) pairs in the archive.
+
+        """
+        cursor = self.index.execute('select event_id, site from records;')
+        return [(row['event_id'], row['site']) for row in cursor]
+
+    def append(self, event, site, record, filename):
+        """Add a record to the end of the archive. If the archive already has
+        this record for this event and site, nothing is done. If it has a
+        different record (as the events have been renumbered since), the entry
+        is replaced; the old samples are left unused in the samples file.
+
+        :param event: The event ID of the record.
+        :type event: integer
+        :param site: The GeoNet code for the site of the record.
+        :type site: string
+        :param record: The record to add.
+        :type record: :class:`Record`
+        :param filename: The filename of the record on the FTP server, as given
+                         by :meth:`Server.get_record_filename`.
+        :type filename: string
+
+        """
+        if self._filename(event, site) == filename:
+            return
+
+        # Write the samples first. If we are interrupted before the index is
+        # updated, the samples are simply ignored; as the offset is taken from
+        # the size of the file, they will not be overwritten by anything else.
+        data = numpy.ascontiguousarray(record.acceleration, dtype=self.dtype)
+        f = open(self.samples_filename, 'ab')
+        try:
+            # An interrupted write may have left a partial sample at the end,
+            # so pad out to a whole number of samples first.
+            f.seek(0, os.SEEK_END)
+            partial = f.tell() % self.dtype.itemsize
+            if partial:
+                f.write('\0' * (self.dtype.itemsize - partial))
+            offset = f.tell() // self.dtype.itemsize
+            f.write(data.tostring())
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+        # And then index them.
+        metadata = {
+            'event': _jsonable(record.event),
+            'site': _jsonable(record.site),
+            'magnitudes': record.magnitudes,
+            'duration': record.duration,
+        }
+        self.index.execute('''insert or replace into records (event_id, site,
+                           filename, offset, length, timestep, start, metadata)
+                           values (?, ?, ?, ?, ?, ?, ?, ?);''', (event, site,
+                           filename, offset, record.data_length,
+                           record.timestep, record.start.isoformat(),
+                           json.dumps(metadata)))
+        self.index.commit()
+
+    def export(self, server, pairs=None):
+        """Add records from a server to the archive, downloading them if they
+        are not already cached. Records which are already in the archive are
+        skipped, so this can be run again after updating the server to add
+        just the new records and replace those whose event has been renumbered.
+        Records which cannot be found or parsed (that is, getting them raises a
+        ValueError such as :class:`TooFewComponents`) are also skipped. The
+        number of records added is returned.
+
+        :param server: The server to get the records from.
+        :type server: :class:`sm.Server`
+        :param pairs: The (event ID, site code) pairs to export. If None, every
+                      record known to the server is exported.
+
+        """
+        if pairs is None:
+            pairs = all_records(server)
+
+        added = 0
+        for event, site in pairs:
+            try:
+                filename = server.get_record_filename(event, site)
+                if self._filename(event, site) == filename:
+                    continue
+                record = server.get_record(event, site)
+            except ValueError:
+                continue
+            self.append(event, site, record, filename)
+            added += 1
+        return added
+
+    def _samples(self, end):
+        """Get a memory map of the samples file which covers at least up to the
+        given sample. The file is remapped if it has grown since it was last
+        mapped.
+
+        """
+        if self._map is None or len(self._map) < end:
+            self._map = numpy.memmap(self.samples_filename, dtype=self.dtype,
+                                     mode='r')
+        return self._map
+
+    def _filename(self, event, site):
+        """Helper function to get the filename stored for a record, or None if
+        the archive does not contain it.
+
+        """
+        row = self.index.execute('''select filename from records where
+                                 event_id=? and site=?;''', (event, site)).fetchone()
+        return row['filename'] if row is not None else None
+
+    def _row(self, event, site, filename=None):
+        """Get the index entry of a record, raising a KeyError if the archive
+        does not contain it or, if a filename is given, it holds a different
+        record.
+
+        """
+        row = self.index.execute('''select * from records where event_id=? and
+                                 site=?;''', (event, site)).fetchone()
+        if row is None or (filename is not None and row['filename'] != filename):
+            raise KeyError((event, site))
+        return row
+
+    def get(self, event, site, filename=None):
+        """Get the acceleration of a record. This is a read-only view of the
+        memory mapped samples file, indexed by axis and then sample in the same
+        way as :attr:`Record.acceleration`.
+
+        :param event: The event ID of the record.
+        :type event: integer
+        :param site: The GeoNet code for the site of the record.
+        :type site: string
+        :param filename: If given, the filename of the record on the FTP
+                         server (see :meth:`Server.get_record_filename`), which
+                         the archived record must match.
+        :type filename: string
+        :raise KeyError: If the record is not in the archive.
+
+        """
+        row = self._row(event, site, filename)
+        end = row['offset'] + 3 * row['length']
+        samples = self._samples(end)
+        return samples[row['offset']:end].reshape(3, row['length'])
+
+    def info(self, event, site, filename=None):
+        """Get the details of a record in the archive. These are returned as a
+        dictionary with the keys ``filename``, ``offset``, ``length``,
+        ``timestep``, ``start`` and ``metadata``. The offset is in samples from
+        the start of the samples file, and the metadata is a dictionary with
+        the ``event``, ``site``, ``magnitudes`` and ``duration`` of the record
+        (with dates and times as ISO 8601 strings).
+
+        :param event: The event ID of the record.
+        :type event: integer
+        :param site: The GeoNet code for the site of the record.
+        :type site: string
+        :param filename: If given, the filename of the record on the FTP
+                         server, which the archived record must match.
+        :type filename: string
+        :raise KeyError: If the record is not in the archive.
+
+        """
+        row = self._row(event, site, filename)
+        return {
+            'filename': row['filename'],
+            'offset': row['offset'],
+            'length': row['length'],
+            'timestep': row['timestep'],
+            'start': row['start'],
+            'metadata': json.loads(row['metadata']),
+        }
@@ -0,0 +1,178 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Run an analysis over many records using a pool of worker processes.
+
+Each worker process has its own read-only :class:`sm.Server` instance, so
+parsing and numerical work is spread across all the available cores. For
+example, to find the peak ground acceleration of every record in the cache:
+
+    >>> import sm.batch
+    >>> def pga(record):
+    ...     return abs(record.acceleration).max()
+    >>> for event, site, result, error in sm.batch.map_records(pga, sm.batch.all_records):
+    ...     print event, site, result
+
+"""
+
+import multiprocessing
+import os.path
+import traceback
+
+import pytz
+
+from sm.record import Record
+from sm.server import Server
+
+# The server and task details of a worker process, set by _initialise_worker().
+_worker = {}
+
+
+def all_records(server):
+    """Query function for :func:`map_records` which returns every record in
+    the cache.
+
+    :param server: The server to query.
+    :type server: :class:`sm.Server`
+
+    """
+    pairs = []
+    for year in server.get_years():
+        for month in server.get_months(year):
+            for event, date in server.get_events(year, month):
+                pairs.extend((event, site) for site in server.get_sites(event))
+    return pairs
+
+
+def _initialise_worker(func, cache_dir, local_timezone, alignment):
+    """Set up a worker process with its own server instance.
+
+    """
+    _worker['server'] = Server(cache_dir, local_timezone, read_only=True)
+    _worker['func'] = func
+    _worker['alignment'] = alignment
+
+
+def _process(pair):
+    """Run the function on one record in a worker process. A four element
+    tuple of the event, site, result and error is returned. If the record
+    could not be retrieved or the function raised an exception, the result is
+    None and the error is the formatted traceback. Otherwise the error is None.
+
+    """
+    event, site = pair
+    try:
+        record = _worker['server'].get_record(event, site,
+                                              alignment=_worker['alignment'])
+        return event, site, _worker['func'](record), None
+    except Exception:
+        return event, site, None, traceback.format_exc()
+
+
+def _load_checkpoint(filename):
+    """Load the set of (event, site) pairs which have been completed according
+    to a checkpoint file. Each line of the file is an event ID and a site code
+    separated by a space.
+
+    """
+    done = set()
+    if filename is None or not os.path.isfile(filename):
+        return done
+    f = open(filename, 'r')
+    for line in f:
+        try:
+            event, site = line.split()
+            done.add((int(event), site))
+        except ValueError:
+            # A partial line left by an interrupted run.
+            continue
+    f.close()
+    return done
+
+
+def map_records(func, query, processes=None, cache_dir='cache',
+                local_timezone=pytz.timezone('NZ'),
+                alignment=Record.Alignment.NORTH_AND_EAST, checkpoint=None,
+                chunksize=1):
+    """Apply a function to many records in parallel. This is a generator which
+    yields a four element tuple for each record as soon as it has been
+    processed, so the results arrive in the order they complete rather than the
+    order they were requested. The tuple consists of the event ID, the site
+    code, the value returned by the function and an error. If the record could
+    not be loaded or the function raised an exception, the value is None and
+    the error is the formatted traceback; the failure does not stop the run.
+    Otherwise the error is None.
+
+    If a checkpoint file is given, every record which is processed successfully
+    is appended to it just before its result is yielded. Records listed
+    in the file are skipped, so an interrupted run can be resumed by calling
+    this again with the same checkpoint. Their results are not yielded again,
+    so you should store the results as they arrive. Records which failed are
+    tried again when the run is resumed.
+
+    :param func: The function to apply. It is given a :class:`Record` and can
+                 return any value which can be pickled. As it is sent to the
+                 worker processes it must be defined at the top level of a
+                 module.
+    :type func: function
+    :param query: Either a sequence of (event ID, site code) pairs to process,
+                  or a function which is given a :class:`sm.Server` and returns
+                  such a sequence (such as :func:`all_records`).
+    :param processes: The number of worker processes to use. If None, one
+                      process is used for each CPU.
+    :type processes: integer
+    :param cache_dir: The cache directory to use, as for :class:`sm.Server`.
+    :type cache_dir: string
+    :param local_timezone: The timezone to return dates and times in.
+    :type local_timezone: pytz.timezone
+    :param alignment: A constant from :class:`Record.Alignment` specifying
+                      what alignment the measured values should be remapped to.
+    :param checkpoint: The filename of the checkpoint file, or None to not keep
+                       track of progress.
+    :type checkpoint: string
+    :param chunksize: How many records to send to a worker at a time. Larger
+                      values reduce the communication overhead when the
+                      function is quick.
+    :type chunksize: integer
+
+    """
+    # Work out what needs doing.
+    if callable(query):
+        server = Server(cache_dir, local_timezone, read_only=True)
+        query = query(server)
+        del server
+    done = _load_checkpoint(checkpoint)
+    pairs = [(event, site) for event, site in query if (event, site) not in done]
+    if not pairs:
+        return
+
+    pool = multiprocessing.Pool(processes, _initialise_worker,
+                                (func, cache_dir, local_timezone, alignment))
+    log = open(checkpoint, 'a') if checkpoint is not None else None
+    try:
+        for event, site, result, error in pool.imap_unordered(_process, pairs,
+                                                              chunksize):
+            # Record the progress first, as the caller may stop iterating
+            # (or be interrupted) before control returns here.
+            if error is None and log is not None:
+                log.write('{0} {1}\n'.format(event, site))
+                log.flush()
+            yield event, site, result, error
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        if log is not None:
+            log.close()
@@ -0,0 +1,119 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Reduce waveforms to a small number of points for plotting.
+
+Two methods are provided. :func:`minmax` splits the data into buckets and keeps
+the smallest and largest value of each, which preserves every peak and so gives
+an exact envelope when drawn one bucket per pixel. :func:`lttb` implements the
+Largest-Triangle-Three-Buckets algorithm of Steinarsson (2013), which picks one
+representative sample per bucket and gives a smoother looking line.
+
+Both work on arrays indexed by axis and then sample, and process every axis at
+once.
+
+"""
+
+import numpy
+
+
+def bucket_edges(length, buckets):
+    """Split a number of samples into evenly sized buckets, returning the index
+    of the first sample of each bucket. If there are fewer samples than
+    buckets, each sample gets its own bucket.
+
+    :param length: The number of samples.
+    :type length: integer
+    :param buckets: The number of buckets.
+    :type buckets: integer
+
+    """
+    buckets = max(1, min(buckets, length))
+    return (numpy.arange(buckets) * length) // buckets
+
+
+def minmax(data, buckets):
+    """Find the minimum and maximum of each bucket of the data. A three element
+    tuple is returned: the index of the first sample of each bucket, and the
+    minimum and maximum values of each bucket, both indexed by axis and then
+    bucket.
+
+    :param data: The data to decimate, indexed by axis and then sample.
+    :type data: numpy array
+    :param buckets: The number of buckets to use.
+    :type buckets: integer
+
+    """
+    edges = bucket_edges(data.shape[-1], buckets)
+    return (edges, numpy.minimum.reduceat(data, edges, axis=-1),
+            numpy.maximum.reduceat(data, edges, axis=-1))
+
+
+def lttb(data, points):
+    """Decimate the data using the Largest-Triangle-Three-Buckets algorithm.
+    The first and last samples are always kept, and one sample is chosen from
+    each of the buckets in between. A two element tuple is returned: the
+    indices of the chosen samples and their values, both indexed by axis and
+    then point, as each axis chooses its own samples.
+
+    :param data: The data to decimate, indexed by axis and then sample.
+    :type data: numpy array
+    :param points: The number of points to keep. As the first and last samples
+                   are always kept, fewer than 2 is treated as 2.
+    :type points: integer
+
+    """
+    axes, length = data.shape
+    points = max(points, 2)
+    if points >= length:
+        indices = numpy.tile(numpy.arange(length), (axes, 1))
+        return indices, data.copy()
+    if points == 2:
+        indices = numpy.tile([0, length - 1], (axes, 1))
+        return indices, data[:, [0, -1]]
+
+    # The buckets between the first and last samples.
+    edges = 1 + bucket_edges(length - 2, points - 2)
+    edges = numpy.append(edges, length - 1)
+
+    # The mean of every bucket, used as the third point of the triangle. The
+    # final bucket is just the last sample.
+    means = numpy.add.reduceat(data[:, :-1], edges[:-1], axis=-1)
+    means /= numpy.diff(edges)
+    centres = (edges[:-1] + edges[1:] - 1) / 2.0
+    means = numpy.column_stack((means, data[:, -1]))
+    centres = numpy.append(centres, length - 1)
+
+    indices = numpy.zeros((axes, points), dtype=int)
+    indices[:, -1] = length - 1
+    rows = numpy.arange(axes)
+
+    # Each bucket depends on the point chosen from the previous one, so the
+    # buckets have to be processed in turn, but all axes are done at once.
+    for bucket in range(points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        previous = indices[:, bucket]
+        ax = previous.astype(float)[:, numpy.newaxis]
+        ay = data[rows, previous][:, numpy.newaxis]
+        cx = centres[bucket + 1]
+        cy = means[:, bucket + 1][:, numpy.newaxis]
+
+        # Twice the area of the triangle formed with each candidate.
+        bx = numpy.arange(start, end)[numpy.newaxis, :]
+        by = data[:, start:end]
+        area = numpy.abs((ax - cx) * (by - ay) - (ax - bx) * (cy - ay))
+        indices[:, bucket + 1] = start + area.argmax(axis=-1)
+
+    return indices, data[rows[:, numpy.newaxis], indices]
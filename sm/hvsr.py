@@ -0,0 +1,248 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Horizontal to vertical spectral ratios (HVSR) of earthquake records.
+
+The spectral ratio of a record is found by removing the mean of each axis,
+applying a cosine taper to both ends, and taking the Fourier amplitude spectra.
+The horizontal spectrum is the quadratic mean of the two horizontal axes. Both
+it and the vertical spectrum are smoothed with the Konno and Ohmachi (1998)
+window at a set of logarithmically spaced frequencies, and the ratio taken.
+Frequencies above the Nyquist frequency of a record, or with fewer than ten
+cycles over its duration, are NaN.
+
+:func:`spectral_ratios` does this for a batch of records at once. Each record
+is zero padded to the next power of two, and the records with the same
+timestep and padded length are stacked so the spectra of every axis of every
+record come from one FFT, and the smoothing of all of them is a single matrix
+product. As the padding depends only on the record itself, its ratio is the
+same whichever batch it is calculated in.
+
+:func:`site_hvsr` averages the ratios of every record from a site. The ratio
+of each record is stored in the ``hvsr`` table of the info cache, along with
+the settings used, so only records which are new since the last call need to
+be loaded and transformed. The average is the geometric mean, as spectral
+ratios are close to log-normally distributed, and the spread is the standard
+deviation of the base 10 logarithm of the ratios.
+
+"""
+
+import sqlite3
+
+import numpy
+
+from sm.spectra import stack
+
+
+def frequencies(band=(0.1, 20.0), points=100):
+    """Get the logarithmically spaced frequencies the ratios are found at.
+
+    :param band: The lowest and highest frequencies in Hz.
+    :type band: tuple of floats
+    :param points: The number of frequencies.
+    :type points: integer
+
+    """
+    return numpy.logspace(numpy.log10(band[0]), numpy.log10(band[1]), points)
+
+
+def konno_ohmachi(fft_frequencies, centres, bandwidth=40.0):
+    """Calculate the Konno and Ohmachi smoothing window for each of a set of
+    centre frequencies, as a matrix with one row per centre frequency which
+    sums to one. Multiplying a spectrum by its transpose smooths it.
+
+    :param fft_frequencies: The frequencies of the spectrum to smooth.
+    :type fft_frequencies: numpy array
+    :param centres: The centre frequencies to smooth at.
+    :type centres: numpy array
+    :param bandwidth: The bandwidth coefficient of the window. Smaller values
+                      smooth more.
+    :type bandwidth: float
+
+    """
+    weights = numpy.zeros((len(centres), len(fft_frequencies)))
+    positive = fft_frequencies > 0
+    x = bandwidth * numpy.log10(fft_frequencies[positive] /
+                                centres[:, numpy.newaxis])
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        window = (numpy.sin(x) / x)**4
+    window[x == 0] = 1
+    weights[:, positive] = window
+    weights /= weights.sum(axis=1)[:, numpy.newaxis]
+    return weights
+
+
+def spectral_ratios(records, centres, bandwidth=40.0, taper=0.05):
+    """Calculate the smoothed horizontal to vertical spectral ratios of a batch
+    of records. A numpy array of the ratios is returned, indexed by record and
+    then frequency.
+
+    :param records: The records to calculate the ratios of.
+    :type records: list of :class:`Record`
+    :param centres: The frequencies to calculate the ratios at, in Hz.
+    :type centres: numpy array
+    :param bandwidth: The bandwidth coefficient of the smoothing window.
+    :type bandwidth: float
+    :param taper: The fraction of each record to taper at each end.
+    :type taper: float
+
+    """
+    ratios = numpy.empty((len(records), len(centres)))
+
+    # Group the records by timestep and padded length.
+    groups = {}
+    for i, record in enumerate(records):
+        nfft = 1 << (record.acceleration.shape[-1] - 1).bit_length()
+        groups.setdefault((record.timestep, nfft), []).append(i)
+
+    for (timestep, nfft), indices in groups.items():
+        data, lengths = stack([numpy.asarray(records[i].acceleration,
+                                             dtype=float) for i in indices])
+        samples = numpy.arange(data.shape[-1])
+        lengths = lengths[:, numpy.newaxis]
+
+        # Remove the mean of each axis, then taper each record over its own
+        # length. The window is zero past the end of the record.
+        data -= (data.sum(axis=-1) / lengths)[..., numpy.newaxis]
+        width = numpy.maximum((taper * lengths).astype(int), 1)
+        ramp = numpy.clip(numpy.minimum(samples, lengths - 1 - samples) /
+                          width.astype(float), 0, 1)
+        window = 0.5 * (1 - numpy.cos(numpy.pi * ramp))
+        window[samples >= lengths] = 0
+        data *= window[:, numpy.newaxis, :]
+
+        # Transform every axis of every record at once.
+        amplitudes = abs(numpy.fft.rfft(data, nfft, axis=-1))
+        horizontal = numpy.sqrt(0.5 * (amplitudes[:, 0]**2 +
+                                       amplitudes[:, 1]**2))
+        weights = konno_ohmachi(numpy.fft.rfftfreq(nfft, timestep), centres,
+                                bandwidth)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            group = (numpy.dot(horizontal, weights.T) /
+                     numpy.dot(amplitudes[:, 2], weights.T))
+        group[:, centres >= 0.5 / timestep] = numpy.nan
+        group[centres < 10.0 / (lengths * timestep)] = numpy.nan
+        ratios[indices] = group
+
+    return ratios
+
+
+def _create_table(server):
+    """Helper function to create the table of ratios in the info cache.
+
+    """
+    cursor = server.info_cache.cursor()
+    server._create_event_tables(cursor)
+    cursor.execute('''create table if not exists hvsr (
+        event_id integer not null,
+        site varchar not null,
+        settings varchar not null,
+        ratios blob,
+        primary key (event_id, site, settings),
+        foreign key(event_id) references events(id) on delete cascade);''')
+    server.info_cache.commit()
+    cursor.close()
+
+
+def site_hvsr(server, site, band=(0.1, 20.0), points=100, bandwidth=40.0,
+              taper=0.05, batch=64):
+    """Calculate the mean horizontal to vertical spectral ratio of all the
+    records from a site. A four element tuple is returned. The first element
+    is the frequencies in Hz, the second the geometric mean ratio at each
+    frequency, the third the standard deviation of the base 10 logarithm of the
+    ratios at each frequency and the fourth the list of event IDs whose records
+    were included. Records which cannot be parsed are left out.
+
+    :param server: The server to get the records from. If it is read only,
+                   the ratios of new records are calculated but not stored.
+    :type server: :class:`sm.Server`
+    :param site: The GeoNet code for the site.
+    :type site: string
+    :param band: The lowest and highest frequencies in Hz.
+    :type band: tuple of floats
+    :param points: The number of logarithmically spaced frequencies.
+    :type points: integer
+    :param bandwidth: The bandwidth coefficient of the smoothing window.
+    :type bandwidth: float
+    :param taper: The fraction of each record to taper at each end.
+    :type taper: float
+    :param batch: The number of records to load and transform at once.
+    :type batch: integer
+
+    """
+    site = site.upper()
+    centres = frequencies(band, points)
+    settings = '{0!r}:{1!r}:{2}:{3!r}:{4!r}'.format(float(band[0]),
+                                                    float(band[1]), points,
+                                                    float(bandwidth),
+                                                    float(taper))
+    events = [event for event, date in server.events_at_site(site)]
+
+    # The ratios we already know. A ratio of NULL marks a record which could
+    # not be parsed.
+    if not server.read_only:
+        _create_table(server)
+    known = {}
+    try:
+        cursor = server.info_cache.execute('''select event_id, ratios from
+                                           hvsr where site=? and
+                                           settings=?;''', (site, settings))
+        for row in cursor:
+            known[row['event_id']] = (
+                None if row['ratios'] is None else
+                numpy.frombuffer(row['ratios'], dtype='<f8'))
+    except sqlite3.OperationalError:
+        pass
+
+    # Calculate the rest in batches.
+    missing = [event for event in events if event not in known]
+    for start in range(0, len(missing), batch):
+        loaded = []
+        records = []
+        for event in missing[start:start + batch]:
+            try:
+                records.append(server.get_record(event, site))
+            except (ValueError, EOFError):
+                # This includes TooFewComponents, and truncated or garbled
+                # files.
+                known[event] = None
+                continue
+            loaded.append(event)
+        if records:
+            for event, ratios in zip(loaded, spectral_ratios(records, centres,
+                                                             bandwidth, taper)):
+                known[event] = ratios
+        if not server.read_only:
+            rows = [(event, site, settings,
+                     None if known[event] is None else
+                     sqlite3.Binary(known[event].astype('<f8').tostring()))
+                    for event in missing[start:start + batch]]
+            server.info_cache.executemany('''insert or replace into hvsr
+                                          (event_id, site, settings, ratios)
+                                          values (?, ?, ?, ?);''', rows)
+            server.info_cache.commit()
+
+    # Average the ratios in log space, ignoring frequencies a record does not
+    # cover.
+    included = [event for event in events if known[event] is not None]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        logs = numpy.log10(numpy.array([known[event] for event in included])
+                           .reshape(len(included), points))
+        valid = numpy.isfinite(logs)
+        logs[~valid] = 0
+        count = valid.sum(axis=0)
+        mean = logs.sum(axis=0) / count
+        spread = numpy.sqrt((valid * (logs - mean)**2).sum(axis=0) / count)
+    return centres, 10**mean, spread, included
@@ -0,0 +1,234 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Counters and latency histograms for finding out where time goes.
+
+Instrumentation is disabled by default, in which case each instrumented
+operation costs no more than a check of a global flag. Call :func:`enable` (or
+set the SM_INSTRUMENT environment variable to 1 before importing the package)
+to start collecting. The following names are used:
+
+    * ``ftp.<command>`` - timings of each FTP command (cwd, nlst, retrbinary,
+                          ...), and ``ftp.connect`` for logging in.
+    * ``ftp.bytes`` - counter of bytes downloaded.
+    * ``record_cache.hit`` and ``record_cache.miss`` - counters of data files
+                                                        found in or missing
+                                                        from the cache.
+    * ``parse.component`` - timings of parsing each component of a data file.
+    * ``query.<method>`` - timings of each info cache query method of
+                           :class:`sm.Server`.
+    * ``wsgi.<route>`` - timings of each visualiser request, by route.
+
+The statistics are kept per process and can be read with :func:`snapshot`
+(also available as :meth:`sm.Server.stats`) or formatted for Prometheus with
+:func:`prometheus`. Hooks added with :func:`add_hook` are called with every
+measurement as it is made.
+
+"""
+
+from bisect import bisect_left
+import functools
+import os
+import threading
+import time
+
+#: Whether measurements are being collected. Use :func:`enable` to change it.
+enabled = os.environ.get('SM_INSTRUMENT') == '1'
+
+#: The upper bounds, in seconds, of the latency histogram buckets. A final
+#: bucket holds everything slower than the last bound.
+BUCKETS = tuple(scale * 10.0**power for power in range(-4, 2)
+                for scale in (1, 2.5, 5))
+
+_lock = threading.Lock()
+_counters = {}
+_timings = {}
+_hooks = []
+
+
+def enable(flag=True):
+    """Start (or with a false flag, stop) collecting measurements.
+
+    :param flag: Whether to collect measurements.
+    :type flag: Boolean
+
+    """
+    global enabled
+    enabled = bool(flag)
+
+
+def reset():
+    """Discard all measurements collected so far.
+
+    """
+    with _lock:
+        _counters.clear()
+        _timings.clear()
+
+
+def add_hook(hook):
+    """Add a function to be called with every measurement. It is given three
+    arguments: the kind of measurement (either ``'count'`` or ``'time'``), its
+    name and its value. Hooks are only called while collection is enabled.
+
+    :param hook: The function to call.
+    :type hook: function
+
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    """Remove a function previously added with :func:`add_hook`.
+
+    :param hook: The function to remove.
+    :type hook: function
+
+    """
+    _hooks.remove(hook)
+
+
+def count(name, value=1):
+    """Add to a counter.
+
+    :param name: The name of the counter.
+    :type name: string
+    :param value: The amount to add.
+    :type value: integer
+
+    """
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+    for hook in _hooks:
+        hook('count', name, value)
+
+
+def record_time(name, seconds):
+    """Add a duration to a latency histogram.
+
+    :param name: The name of the histogram.
+    :type name: string
+    :param seconds: The duration.
+    :type seconds: float
+
+    """
+    if not enabled:
+        return
+    with _lock:
+        timing = _timings.get(name)
+        if timing is None:
+            timing = _timings[name] = {'count': 0, 'total': 0.0,
+                                       'buckets': [0] * (len(BUCKETS) + 1)}
+        timing['count'] += 1
+        timing['total'] += seconds
+        timing['buckets'][bisect_left(BUCKETS, seconds)] += 1
+    for hook in _hooks:
+        hook('time', name, seconds)
+
+
+class timer(object):
+    """Context manager which records how long its body takes:
+
+        >>> with timer('parse.component'):
+        ...     parse()
+
+    """
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if enabled:
+            self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        if self.start is not None:
+            record_time(self.name, time.time() - self.start)
+
+
+def timed(name):
+    """Decorator which records how long each call of a function takes.
+
+    :param name: The name of the histogram.
+    :type name: string
+
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record_time(name, time.time() - start)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    """Get a copy of the measurements collected so far. This is a dictionary
+    with two keys. ``counters`` maps each counter name to its value.
+    ``timings`` maps each histogram name to a dictionary with the ``count`` of
+    measurements, their ``total`` in seconds, and the number of measurements in
+    each of the ``buckets`` given by :data:`BUCKETS` (plus one for slower
+    measurements).
+
+    """
+    with _lock:
+        return {
+            'counters': dict(_counters),
+            'timings': dict((name, {'count': t['count'], 'total': t['total'],
+                                    'buckets': list(t['buckets'])})
+                            for name, t in _timings.items()),
+        }
+
+
+def _metric_name(name):
+    """Helper function to convert a measurement name to a Prometheus metric
+    name.
+
+    """
+    return 'sm_' + ''.join(c if c.isalnum() else '_' for c in name)
+
+
+def prometheus():
+    """Format the measurements collected so far in the Prometheus text
+    exposition format.
+
+    """
+    stats = snapshot()
+    lines = []
+    for name, value in sorted(stats['counters'].items()):
+        metric = _metric_name(name) + '_total'
+        lines.append('# TYPE {0} counter'.format(metric))
+        lines.append('{0} {1}'.format(metric, value))
+    for name, timing in sorted(stats['timings'].items()):
+        metric = _metric_name(name) + '_seconds'
+        lines.append('# TYPE {0} histogram'.format(metric))
+        cumulative = 0
+        for bound, number in zip(BUCKETS + ('+Inf',), timing['buckets']):
+            cumulative += number
+            lines.append('{0}_bucket{{le="{1}"}} {2}'.format(metric, bound,
+                                                               cumulative))
+        lines.append('{0}_sum {1!r}'.format(metric, timing['total']))
+        lines.append('{0}_count {1}'.format(metric, timing['count']))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,141 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Ground motion intensity measures of strong motion records.
+
+All measures are calculated for every axis of every record at the same time.
+The velocity and displacement histories are found by cumulative trapezoidal
+integration, and the cumulative integral of the squared acceleration is shared
+between the Arias intensity and the significant duration.
+
+"""
+
+import numpy
+
+from sm.spectra import stack
+
+#: Standard gravity in metres per second per second, used to normalise the
+#: Arias intensity.
+GRAVITY = 9.80665
+
+#: The fields of the structured arrays returned by this module. All values are
+#: in the units given in the :class:`sm.Server` documentation.
+#:
+#:     * ``pga`` - peak absolute ground acceleration.
+#:     * ``pgv`` - peak absolute ground velocity.
+#:     * ``pgd`` - peak absolute ground displacement.
+#:     * ``arias`` - Arias intensity, in metres per second.
+#:     * ``cav`` - cumulative absolute velocity.
+#:     * ``d5_95`` - significant duration between 5% and 95% of the Arias
+#:                   intensity.
+MEASURES = numpy.dtype([
+    ('pga', float),
+    ('pgv', float),
+    ('pgd', float),
+    ('arias', float),
+    ('cav', float),
+    ('d5_95', float),
+])
+
+
+def _cumulative_trapezoid(values, timesteps, padding, out):
+    """Cumulatively integrate along the last axis using the trapezoidal rule,
+    with the first value of the integral being zero. Steps which end in the
+    padding contribute nothing, so the padding holds the final value of the
+    integral.
+
+    :param values: The values to integrate, indexed by history, axis and then
+                   sample.
+    :param timesteps: The timestep of each history, with shape (histories, 1).
+    :param padding: Boolean array which is true for samples past the end of
+                    their history, broadcastable against the values.
+    :param out: The array to store the result in. This may be the same array
+                as the values.
+
+    """
+    steps = values[..., :-1] + values[..., 1:]
+    steps *= 0.5 * timesteps[..., numpy.newaxis]
+    steps *= ~padding[..., 1:]
+    out[..., 0] = 0
+    numpy.cumsum(steps, axis=-1, out=out[..., 1:])
+    return out
+
+
+def acceleration_measures(accelerations, timesteps):
+    """Calculate the intensity measures of a batch of acceleration histories.
+    The histories may have different lengths and timesteps.
+
+    The result is a structured array with the fields given by
+    :data:`MEASURES`, indexed by history and then axis.
+
+    :param accelerations: The acceleration histories. Each entry should be a
+                          two-dimensional array indexed by axis and then
+                          sample, such as :attr:`Record.acceleration`. All
+                          entries must have the same number of axes.
+    :type accelerations: sequence of numpy arrays
+    :param timesteps: The timestep of each history.
+    :type timesteps: sequence of floats
+
+    """
+    # Stack the histories into one zero-padded array. Zeros do not change any
+    # of the acceleration based measures.
+    acc, lengths = stack(accelerations)
+    samples = acc.shape[2]
+    dt = numpy.asarray(timesteps, dtype=float)[:, numpy.newaxis]
+
+    # Samples which are past the end of their history.
+    padding = numpy.arange(samples) >= lengths[:, numpy.newaxis, numpy.newaxis]
+
+    result = numpy.zeros(acc.shape[:2], dtype=MEASURES)
+
+    # Peak and cumulative absolute acceleration, giving the PGA and CAV.
+    work = numpy.abs(acc)
+    result['pga'] = work.max(axis=-1)
+    _cumulative_trapezoid(work, dt, padding, work)
+    result['cav'] = work[..., -1]
+
+    # Cumulative squared acceleration. The final value gives the Arias
+    # intensity and the normalised curve gives the significant duration.
+    numpy.multiply(acc, acc, work)
+    _cumulative_trapezoid(work, dt, padding, work)
+    total = work[..., -1]
+    result['arias'] = numpy.pi / (2 * GRAVITY) * total
+    start = (work < 0.05 * total[..., numpy.newaxis]).sum(axis=-1)
+    end = (work < 0.95 * total[..., numpy.newaxis]).sum(axis=-1)
+    result['d5_95'] = (end - start) * dt
+
+    # Velocity.
+    _cumulative_trapezoid(acc, dt, padding, work)
+    result['pgv'] = numpy.abs(work).max(axis=-1)
+
+    # And displacement, reusing the acceleration buffer as it is no longer
+    # needed.
+    _cumulative_trapezoid(work, dt, padding, acc)
+    result['pgd'] = numpy.abs(acc).max(axis=-1)
+
+    return result
+
+
+def intensity_measures(records):
+    """Calculate the intensity measures of a batch of :class:`Record`
+    instances. See :func:`acceleration_measures` for details of the returned
+    structured array.
+
+    :param records: The records to calculate the measures of.
+    :type records: sequence of :class:`Record`
+
+    """
+    return acceleration_measures([r.acceleration for r in records],
+                                 [r.timestep for r in records])
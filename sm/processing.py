@@ -0,0 +1,350 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Signal processing of strong motion records.
+
+A :class:`Pipeline` applies a chain of steps to the acceleration of a record or
+a batch of records. Steps are either applied in the time domain (such as
+:class:`Detrend` and :class:`Taper`) or are described by a frequency response
+(such as :class:`Bandpass` and :class:`Integrate`). Neighbouring frequency
+domain steps are combined so the data only goes through one forward and one
+inverse FFT for them.
+
+Everything which depends only on the length and timestep of the data (the FFT
+length, taper windows and combined frequency responses) is calculated once per
+pipeline and reused for every record with the same length and timestep. Records
+with the same length and timestep are processed together as a single array.
+
+"""
+
+import numpy
+
+
+def next_fast_length(n):
+    """Find the smallest FFT length which is at least n samples and which
+    numpy's FFT can compute quickly, i.e., one with no prime factors other than
+    2, 3 and 5.
+
+    :param n: The minimum length.
+    :type n: integer
+
+    """
+    best = 1
+    while best < n:
+        best *= 2
+    power5 = 1
+    while power5 < best:
+        power35 = power5
+        while power35 < best:
+            # Smallest power of two taking this candidate to at least n.
+            candidate = power35
+            while candidate < n:
+                candidate *= 2
+            best = min(best, candidate)
+            power35 *= 3
+        power5 *= 5
+    return best
+
+
+class Detrend(object):
+    """Time domain step which removes the mean (order zero) or the least
+    squares straight line (order one) from each axis. This is a simple
+    baseline correction.
+
+    """
+
+    def __init__(self, order=1):
+        """
+
+        :param order: The order of the trend to remove, either 0 or 1.
+        :type order: integer
+
+        """
+        if order not in (0, 1):
+            raise ValueError('Detrend order must be 0 or 1.')
+        self.order = order
+
+    def prepare(self, length, timestep):
+        """Calculate the centred sample indices and their sum of squares.
+
+        """
+        t = numpy.arange(length) - (length - 1) / 2.0
+        return t, numpy.dot(t, t)
+
+    def apply(self, data, prepared):
+        """Remove the trend from the data, in place.
+
+        """
+        data -= data.mean(axis=-1)[..., numpy.newaxis]
+        if self.order == 1:
+            t, tt = prepared
+            slope = numpy.dot(data, t) / tt
+            data -= slope[..., numpy.newaxis] * t
+
+
+class Taper(object):
+    """Time domain step which applies a cosine taper to both ends of each axis
+    so the data starts and ends smoothly at zero.
+
+    """
+
+    def __init__(self, fraction=0.05):
+        """
+
+        :param fraction: The fraction of the data to taper at each end.
+        :type fraction: float
+
+        """
+        if not 0 <= fraction <= 0.5:
+            raise ValueError('Taper fraction must be between 0 and 0.5.')
+        self.fraction = fraction
+
+    def prepare(self, length, timestep):
+        """Calculate the taper window.
+
+        """
+        window = numpy.ones(length)
+        width = int(self.fraction * length)
+        if width > 0:
+            ramp = 0.5 * (1 - numpy.cos(numpy.pi * numpy.arange(width) / width))
+            window[:width] = ramp
+            window[length - width:] = ramp[::-1]
+        return window
+
+    def apply(self, data, prepared):
+        """Taper the data, in place.
+
+        """
+        data *= prepared
+
+
+class Bandpass(object):
+    """Frequency domain step which applies a zero phase Butterworth bandpass
+    filter. Either corner may be omitted to give a lowpass or highpass filter.
+
+    """
+
+    def __init__(self, low=None, high=None, order=4):
+        """
+
+        :param low: The low corner frequency in hertz, or None for no highpass
+                    component.
+        :type low: float
+        :param high: The high corner frequency in hertz, or None for no lowpass
+                     component.
+        :type high: float
+        :param order: The order of the filter.
+        :type order: integer
+
+        """
+        self.low = low
+        self.high = high
+        self.order = order
+
+    def response(self, frequencies):
+        """Calculate the frequency response of the filter.
+
+        """
+        response = numpy.ones(len(frequencies))
+        if self.low:
+            with numpy.errstate(divide='ignore'):
+                ratio = self.low / frequencies
+            response /= numpy.sqrt(1 + ratio**(2 * self.order))
+        if self.high:
+            response /= numpy.sqrt(1 + (frequencies / self.high)**(2 * self.order))
+        return response
+
+
+class Integrate(object):
+    """Frequency domain step which integrates the data, for example to turn
+    acceleration into velocity (once) or displacement (twice). The mean of the
+    result is zero, so this is usually preceded by a highpass filter.
+
+    """
+
+    def __init__(self, times=1):
+        """
+
+        :param times: How many times to integrate.
+        :type times: integer
+
+        """
+        self.times = times
+
+    def response(self, frequencies):
+        """Calculate the frequency response of the integration.
+
+        """
+        response = numpy.zeros(len(frequencies), dtype=complex)
+        nonzero = frequencies > 0
+        response[nonzero] = (2j * numpy.pi * frequencies[nonzero])**-self.times
+        return response
+
+
+class Pipeline(object):
+    """A chain of processing steps to apply to acceleration data. For example,
+    to baseline correct, filter and integrate to displacement:
+
+        >>> pipeline = Pipeline([Detrend(), Taper(0.05),
+        ...                      Bandpass(low=0.1, high=25), Integrate(2)])
+        >>> displacement = pipeline.process_record(record)
+
+    """
+
+    def __init__(self, steps, padding=1.0):
+        """
+
+        :param steps: The steps to apply, in order.
+        :type steps: list
+        :param padding: How much zero padding to add before transforming to the
+                        frequency domain, as a fraction of the data length.
+                        This prevents the end of the data wrapping around onto
+                        the start.
+        :type padding: float
+
+        """
+        self.steps = list(steps)
+        self.padding = padding
+
+        # Group the steps into stages. Each stage is either a single time
+        # domain step, or a list of consecutive frequency domain steps.
+        self._stages = []
+        for step in self.steps:
+            if hasattr(step, 'response'):
+                if self._stages and isinstance(self._stages[-1], list):
+                    self._stages[-1].append(step)
+                else:
+                    self._stages.append([step])
+            else:
+                self._stages.append(step)
+
+        # The prepared data for each stage, keyed by length and timestep.
+        self._plans = {}
+
+    def _plan(self, length, timestep):
+        """Get the prepared data for each stage for the given length and
+        timestep, calculating it if this is the first time it is needed.
+
+        """
+        key = (length, timestep)
+        try:
+            return self._plans[key]
+        except KeyError:
+            pass
+
+        plan = []
+        for stage in self._stages:
+            if isinstance(stage, list):
+                # Combine the responses of all the frequency domain steps.
+                nfft = next_fast_length(int(length * (1 + self.padding)))
+                frequencies = numpy.fft.rfftfreq(nfft, timestep)
+                response = numpy.ones(len(frequencies))
+                for step in stage:
+                    response = response * step.response(frequencies)
+                plan.append((nfft, response))
+            else:
+                plan.append(stage.prepare(length, timestep))
+
+        self._plans[key] = plan
+        return plan
+
+    def process(self, data, timestep, in_place=False):
+        """Process data with a common length and timestep. The data can have
+        any number of dimensions, with time along the last one, so a single
+        record's acceleration or a stack of them can be processed at once.
+
+        :param data: The data to process.
+        :type data: numpy array
+        :param timestep: The time between samples.
+        :type timestep: float
+        :param in_place: If True, the data array is overwritten with the
+                         processed data and returned. Otherwise, the input is
+                         left untouched and a new array is returned.
+        :type in_place: Boolean
+
+        """
+        if not in_place:
+            data = numpy.array(data, dtype=float)
+        length = data.shape[-1]
+        plan = self._plan(length, timestep)
+
+        for stage, prepared in zip(self._stages, plan):
+            if isinstance(stage, list):
+                nfft, response = prepared
+                spectrum = numpy.fft.rfft(data, nfft, axis=-1)
+                spectrum *= response
+                data[...] = numpy.fft.irfft(spectrum, nfft, axis=-1)[..., :length]
+            else:
+                stage.apply(data, prepared)
+
+        return data
+
+    def process_record(self, record, in_place=False):
+        """Process the acceleration of a single :class:`Record`.
+
+        :param record: The record to process.
+        :type record: :class:`Record`
+        :param in_place: If True, the acceleration of the record is replaced by
+                         the processed data.
+        :type in_place: Boolean
+
+        """
+        return self.process(record.acceleration, record.timestep, in_place)
+
+    def process_records(self, records):
+        """Process the acceleration of a batch of :class:`Record` instances.
+        Records with the same length and timestep are stacked and processed
+        together. A list of the processed arrays is returned in the same order
+        as the records; the records themselves are not modified.
+
+        :param records: The records to process.
+        :type records: sequence of :class:`Record`
+
+        """
+        # Group the records.
+        groups = {}
+        for i, record in enumerate(records):
+            key = (record.data_length, record.timestep)
+            groups.setdefault(key, []).append(i)
+
+        # Process each group in one go.
+        results = [None] * len(records)
+        for (length, timestep), indices in groups.items():
+            stacked = numpy.array([records[i].acceleration for i in indices])
+            self.process(stacked, timestep, in_place=True)
+            for i, data in zip(indices, stacked):
+                results[i] = data
+
+        return results
+
+
+def fourier_spectra(data, timestep):
+    """Calculate the Fourier amplitude spectra of data with a common timestep.
+    The data can have any number of dimensions, with time along the last one.
+    It is zero padded to an efficient FFT length. A two element tuple is
+    returned, the first element of which is the frequencies in hertz and the
+    second the amplitudes (in the units of the data multiplied by seconds) with
+    frequency along the last axis.
+
+    :param data: The data to calculate the spectra of.
+    :type data: numpy array
+    :param timestep: The time between samples.
+    :type timestep: float
+
+    """
+    nfft = next_fast_length(data.shape[-1])
+    amplitudes = numpy.abs(numpy.fft.rfft(data, nfft, axis=-1))
+    amplitudes *= timestep
+    return numpy.fft.rfftfreq(nfft, timestep), amplitudes
@@ -0,0 +1,254 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Multi-resolution min/max pyramids of record accelerations.
+
+To draw any part of a record at any zoom level without decimating the whole
+record each time, a pyramid of successively coarser summaries is built once
+and stored alongside the cached data file. Level 0 holds the raw samples, and
+each level above it holds the minimum and maximum of every ``factor`` buckets
+of the level below. A tile covering any time range at any width is then drawn
+from the coarsest level which still has at least one bucket per pixel, so it
+never needs to read more than ``factor`` buckets per pixel however long the
+record is.
+
+Each pyramid is stored as two files in the pyramids/ directory of the cache,
+named after the record's data file: a JSON description of the levels and a
+flat file of little-endian float32 values which is memory mapped when read.
+
+"""
+
+import json
+import os
+import os.path
+import tempfile
+
+import numpy
+
+from sm.batch import all_records
+from sm.decimate import bucket_edges
+
+# The data type of the stored values.
+_DTYPE = numpy.dtype('<f4')
+
+
+def pyramid_basename(server, event, site):
+    """Get the filename (without an extension) of the pyramid of a record.
+
+    :param server: The server the record is from.
+    :type server: :class:`sm.Server`
+    :param event: The event ID of the record.
+    :type event: integer
+    :param site: The GeoNet code for the site of the record.
+    :type site: string
+    :raise NoSuchRecord:
+
+    """
+    return os.path.join(server.cache_dir, 'pyramids',
+                        server.get_record_filename(event, site))
+
+
+def _temporary(directory):
+    """Helper function to create a uniquely named temporary file in a
+    directory, readable by everyone once renamed into place. The open file and
+    its filename are returned.
+
+    """
+    handle, filename = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    os.chmod(filename, 0644)
+    return os.fdopen(handle, 'wb'), filename
+
+
+def build_pyramid(record, basename, factor=4, smallest=256):
+    """Build the pyramid of a record and save it.
+
+    :param record: The record to build the pyramid of.
+    :type record: :class:`Record`
+    :param basename: The filename to save the pyramid to, without an
+                     extension.
+    :type basename: string
+    :param factor: How many buckets of each level are combined into one bucket
+                   of the next.
+    :type factor: integer
+    :param smallest: Stop adding levels once a level has this many buckets or
+                     fewer.
+    :type smallest: integer
+
+    """
+    directory = os.path.dirname(basename)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another thread or process may have just created it.
+            if not os.path.isdir(directory):
+                raise
+
+    # Level 0 is the raw data.
+    arrays = [record.acceleration.astype(_DTYPE)]
+    levels = [{'offset': 0, 'length': record.data_length, 'scale': 1}]
+    offset = arrays[0].size
+
+    # Each level above combines factor buckets of the one below.
+    low = high = arrays[0]
+    while low.shape[-1] > smallest:
+        edges = numpy.arange(0, low.shape[-1], factor)
+        low = numpy.minimum.reduceat(low, edges, axis=-1)
+        high = numpy.maximum.reduceat(high, edges, axis=-1)
+        arrays.append(numpy.array((low, high)))
+        levels.append({'offset': offset, 'length': low.shape[-1],
+                       'scale': levels[-1]['scale'] * factor})
+        offset += arrays[-1].size
+
+    # Write the values to a temporary file first, so a reader never sees a
+    # partial pyramid. Several threads or processes may build the same
+    # pyramid at once, so each uses its own temporary file.
+    f, temporary = _temporary(directory)
+    for array in arrays:
+        f.write(array.tostring())
+    f.close()
+    os.rename(temporary, basename + '.f32')
+
+    description = {
+        'factor': factor,
+        'timestep': record.timestep,
+        'start': record.start.isoformat(),
+        'length': record.data_length,
+        'levels': levels,
+    }
+    f, temporary = _temporary(directory)
+    json.dump(description, f)
+    f.close()
+    os.rename(temporary, basename + '.json')
+
+
+def build_pyramids(server, pairs=None, factor=4):
+    """Build the pyramids of every cached record which does not have one yet.
+    This is intended to be run in the background (for example, after updating
+    the cache) so the visualiser never has to build them on demand. The number
+    of pyramids built is returned.
+
+    :param server: The server the records are from.
+    :type server: :class:`sm.Server`
+    :param pairs: The (event ID, site code) pairs to consider. If None, every
+                  record known to the server is considered.
+    :param factor: How many buckets of each level are combined into one bucket
+                   of the next.
+    :type factor: integer
+
+    """
+    if pairs is None:
+        pairs = all_records(server)
+
+    built = 0
+    for event, site in pairs:
+        filename = server.get_record_filename(event, site)
+        basename = os.path.join(server.cache_dir, 'pyramids', filename)
+
+        # Only records which have already been downloaded.
+        if os.path.isfile(basename + '.json'):
+            continue
+        if not os.path.isfile(os.path.join(server.cache_dir, filename)):
+            continue
+
+        try:
+            record = server.get_record(event, site)
+        except (ValueError, EOFError):
+            # Records which cannot be parsed.
+            continue
+        build_pyramid(record, basename, factor)
+        built += 1
+    return built
+
+
+class Pyramid(object):
+    """A stored pyramid of a record, from which tiles can be drawn.
+
+    """
+
+    def __init__(self, basename):
+        """
+
+        :param basename: The filename the pyramid was saved to, without an
+                         extension.
+        :type basename: string
+
+        """
+        f = open(basename + '.json', 'r')
+        description = json.load(f)
+        f.close()
+        self.factor = description['factor']
+        self.timestep = description['timestep']
+        self.start = description['start']
+        self.length = description['length']
+        self.levels = description['levels']
+        self._values = numpy.memmap(basename + '.f32', dtype=_DTYPE, mode='r')
+
+    def _level(self, index):
+        """Get the minimum and maximum arrays of a level. For the raw level,
+        both are the same array.
+
+        """
+        level = self.levels[index]
+        if index == 0:
+            raw = self._values[:3 * level['length']].reshape(3, level['length'])
+            return raw, raw
+        end = level['offset'] + 6 * level['length']
+        data = self._values[level['offset']:end].reshape(2, 3, level['length'])
+        return data[0], data[1]
+
+    def tile(self, start=None, end=None, width=1000):
+        """Get the minimum and maximum of each axis over a time range, split
+        into the given number of buckets. A three element tuple is returned:
+        the time of the start of each bucket in seconds from the start of the
+        record, and the minimum and maximum values of each bucket, indexed by
+        axis and then bucket. If the range holds fewer samples than the width,
+        each sample gets its own bucket.
+
+        :param start: The start of the range in seconds from the start of the
+                      record. If None, the start of the record is used.
+        :type start: float
+        :param end: The end of the range in seconds from the start of the
+                    record. If None, the end of the record is used.
+        :type end: float
+        :param width: The number of buckets to split the range into.
+        :type width: integer
+
+        """
+        # Convert the range to raw sample indices.
+        first = 0 if start is None else int(numpy.floor(start / self.timestep))
+        last = self.length if end is None else int(numpy.ceil(end / self.timestep)) + 1
+        first = min(max(first, 0), self.length - 1)
+        last = min(max(last, first + 1), self.length)
+
+        # The coarsest level which still has at least one bucket per pixel.
+        index = 0
+        for i, level in enumerate(self.levels):
+            if (last - first) // level['scale'] >= width:
+                index = i
+        scale = self.levels[index]['scale']
+
+        # Read only the buckets of that level covering the range.
+        low, high = self._level(index)
+        lo = first // scale
+        hi = min(-(-last // scale), self.levels[index]['length'])
+        low = numpy.asarray(low[:, lo:hi], dtype=float)
+        high = numpy.asarray(high[:, lo:hi], dtype=float)
+
+        # Combine them down to the requested width.
+        edges = bucket_edges(hi - lo, width)
+        low = numpy.minimum.reduceat(low, edges, axis=-1)
+        high = numpy.maximum.reduceat(high, edges, axis=-1)
+        return (lo + edges) * scale * self.timestep, low, high
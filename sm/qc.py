@@ -0,0 +1,316 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Data quality screening of records.
+
+The parser accepts any data file it can read, including ones with problems
+which make the record useless or misleading for analysis. :func:`screen` checks
+a batch of records for the following problems, each of which sets a bit in the
+flags returned for the record:
+
+    * :data:`SENTINEL` - the record contains GeoNet's 999999.9 placeholder
+                         for missing values, or values which are not finite.
+    * :data:`CLIPPED` - an axis stays at its peak value for several samples in
+                        a row, as happens when the instrument's range is
+                        exceeded.
+    * :data:`SPIKE` - a single sample stands out from its neighbours far more
+                      than is typical of the signal around it.
+    * :data:`FLATLINE` - an axis holds the same value for a large part of the
+                         record, as happens when a channel is dead.
+    * :data:`COUNT_MISMATCH` - the number of samples given in a component's
+                               header does not match the data read.
+    * :data:`UNPARSEABLE` - the data file could not be parsed into a record.
+                            This is only set by :func:`screen_cache`.
+
+All checks are done with vectorised passes over the stacked accelerations of
+the whole batch. :func:`screen_cache` screens records from a server and stores
+their flags in the ``qc`` table of the info cache, which is indexed by the
+flags so that :func:`passed_records` can find the records without problems
+without reading any data files. It can be used directly as the query of
+:func:`sm.batch.map_records`.
+
+"""
+
+import os.path
+import sqlite3
+
+import numpy
+
+from sm.batch import all_records
+from sm.spectra import stack
+
+#: Flag for missing value placeholders or non-finite values.
+SENTINEL = 1
+
+#: Flag for clipped axes.
+CLIPPED = 2
+
+#: Flag for spikes.
+SPIKE = 4
+
+#: Flag for flat-lined axes.
+FLATLINE = 8
+
+#: Flag for header sample counts which do not match the data.
+COUNT_MISMATCH = 16
+
+#: Flag for data files which could not be parsed.
+UNPARSEABLE = 32
+
+#: All flags.
+ALL = SENTINEL | CLIPPED | SPIKE | FLATLINE | COUNT_MISMATCH | UNPARSEABLE
+
+_NAMES = ((SENTINEL, 'sentinel'), (CLIPPED, 'clipped'), (SPIKE, 'spike'),
+          (FLATLINE, 'flatline'), (COUNT_MISMATCH, 'count_mismatch'),
+          (UNPARSEABLE, 'unparseable'))
+
+#: GeoNet's placeholder for missing values, once scaled to m/s/s.
+MISSING_VALUE = 999.9999
+
+#: The resolution of the values in the data files in m/s/s.
+RESOLUTION = 1e-4
+
+
+def describe(flags):
+    """Get the names of the flags which are set.
+
+    :param flags: The flags of a record.
+    :type flags: integer
+
+    """
+    return [name for flag, name in _NAMES if flags & flag]
+
+
+def _longest_run(mask):
+    """Helper function to find the length of the longest run of True values
+    along the last axis of a boolean array.
+
+    """
+    count = numpy.cumsum(mask, axis=-1)
+    reset = numpy.maximum.accumulate(numpy.where(mask, 0, count), axis=-1)
+    return (count - reset).max(axis=-1)
+
+
+def screen(records, clip_run=8, clip_minimum=0.1, spike_factor=20.0,
+           spike_window=200, flat_fraction=0.5):
+    """Check a batch of records for data quality problems, and return a numpy
+    array of the flags of each record. A record with no problems has flags of
+    zero.
+
+    :param records: The records to check. These can be :class:`Record` or
+                    :class:`sm.shared.SharedRecord` instances.
+    :type records: list
+    :param clip_run: The number of consecutive samples within one part in a
+                     thousand of an axis's peak which mark it as clipped.
+    :type clip_run: integer
+    :param clip_minimum: The smallest peak acceleration in m/s/s which is
+                         checked for clipping. Weak motion records do not clip,
+                         but their coarsely quantised values often repeat.
+    :type clip_minimum: float
+    :param spike_factor: How many times larger than the typical bend of the
+                         signal a sample's departure from its neighbours must
+                         be to count as a spike.
+    :type spike_factor: float
+    :param spike_window: The number of samples in each block over which the
+                         typical bend is found.
+    :type spike_window: integer
+    :param flat_fraction: The fraction of a record for which an axis must hold
+                          the same value to be flat-lined.
+    :type flat_fraction: float
+
+    """
+    acc, lengths = stack([numpy.asarray(r.acceleration, dtype=float) for r in
+                          records])
+    samples = acc.shape[-1]
+    flags = numpy.zeros(len(records), dtype=int)
+
+    # Samples which are past the end of their record.
+    padding = numpy.arange(samples) >= lengths[:, numpy.newaxis, numpy.newaxis]
+
+    # Missing values. When the horizontal components are realigned each one
+    # is spread over both axes, but for orthogonal components the horizontal
+    # magnitude is unchanged.
+    finite = numpy.isfinite(acc)
+    flags[~finite.all(axis=(1, 2))] |= SENTINEL
+    acc[~finite] = 0
+    horizontal = numpy.hypot(acc[:, 0], acc[:, 1])
+    limit = 0.999 * MISSING_VALUE
+    flags[(horizontal >= limit).any(axis=-1) |
+          (abs(acc[:, 2]) >= limit).any(axis=-1)] |= SENTINEL
+
+    # Clipping: runs of samples at the peak.
+    magnitude = abs(acc)
+    peak = magnitude.max(axis=-1)
+    near = magnitude >= 0.999 * peak[..., numpy.newaxis]
+    clipped = (_longest_run(near) >= clip_run) & (peak >= clip_minimum)
+    flags[clipped.any(axis=-1)] |= CLIPPED
+
+    # Spikes: samples which stand out from both neighbours in the same
+    # direction by much more than the signal typically bends in the
+    # surrounding second. The typical bend is the median magnitude of the
+    # second difference over blocks of samples, taking the larger of each
+    # block and its neighbours so that the sudden onset of shaking is not
+    # mistaken for a spike.
+    before = acc[..., 1:-1] - acc[..., :-2]
+    after = acc[..., 1:-1] - acc[..., 2:]
+    valid = ~padding[..., 2:]
+    departure = numpy.where((before * after > 0) & valid,
+                            numpy.minimum(abs(before), abs(after)), 0)
+    bend = abs(before + after) * valid
+    length = departure.shape[-1]
+    blocks = -(-length // spike_window)
+    typical = numpy.zeros(departure.shape[:-1] + (blocks * spike_window,))
+    typical[..., :length] = bend
+    typical = numpy.median(typical.reshape(departure.shape[:-1] +
+                                           (blocks, spike_window)), axis=-1)
+    typical[..., 1:] = numpy.maximum(typical[..., 1:], typical[..., :-1])
+    typical[..., :-1] = numpy.maximum(typical[..., :-1], typical[..., 1:])
+    typical = numpy.repeat(typical, spike_window, axis=-1)[..., :length]
+    spikes = departure > spike_factor * (typical + RESOLUTION)
+    flags[spikes.any(axis=(1, 2))] |= SPIKE
+
+    # Flat-lining: long runs of unchanged values.
+    unchanged = (numpy.diff(acc, axis=-1) == 0) & ~padding[..., 1:]
+    flat = (_longest_run(unchanged) + 1 >=
+            flat_fraction * lengths[:, numpy.newaxis])
+    flags[flat.any(axis=-1)] |= FLATLINE
+
+    # Header counts.
+    for i, record in enumerate(records):
+        counts = getattr(record, 'digitised_samples', None) or []
+        if any(count != record.data_length for count in counts):
+            flags[i] |= COUNT_MISMATCH
+
+    return flags
+
+
+def _create_table(server):
+    """Helper function to create the table of flags in the info cache.
+
+    """
+    cursor = server.info_cache.cursor()
+    server._create_event_tables(cursor)
+    cursor.execute('''create table if not exists qc (
+        event_id integer not null,
+        site varchar not null,
+        flags integer not null,
+        primary key (event_id, site),
+        foreign key(event_id) references events(id) on delete cascade);''')
+    cursor.execute('create index if not exists qc_flags on qc (flags);')
+    server.info_cache.commit()
+    cursor.close()
+
+
+def screen_cache(server, pairs=None, batch=64, rescreen=False, download=False,
+                 **kwargs):
+    """Screen records from a server and store their flags in the info cache.
+    By default, only records whose data files are already cached and which
+    have not been screened before are checked, so this is cheap to run after
+    every update. The number of records screened is returned.
+
+    :param server: The server to get the records from. It must not be read
+                   only.
+    :type server: :class:`sm.Server`
+    :param pairs: The (event ID, site code) pairs to consider. If None, every
+                  record known to the server is considered.
+    :param batch: The number of records to screen at once.
+    :type batch: integer
+    :param rescreen: Also screen records which have been screened before.
+    :type rescreen: Boolean
+    :param download: Also screen records which are not cached, downloading
+                     them.
+    :type download: Boolean
+
+    Any other keyword arguments are passed on to :func:`screen`.
+
+    """
+    _create_table(server)
+    if pairs is None:
+        pairs = all_records(server)
+    if not rescreen:
+        done = set((row['event_id'], row['site']) for row in
+                   server.info_cache.execute('select event_id, site from qc;'))
+        pairs = [pair for pair in pairs if pair not in done]
+    if not download:
+        pairs = [(event, site) for event, site in pairs if os.path.isfile(
+            os.path.join(server.cache_dir, server.get_record_filename(event, site)))]
+
+    screened = 0
+    for start in range(0, len(pairs), batch):
+        rows = []
+        keys = []
+        records = []
+        for event, site in pairs[start:start + batch]:
+            try:
+                records.append(server.get_record(event, site))
+            except (ValueError, EOFError):
+                # This includes TooFewComponents, and truncated or garbled
+                # files.
+                rows.append((event, site, UNPARSEABLE))
+                continue
+            keys.append((event, site))
+        if records:
+            rows.extend((event, site, int(flags)) for (event, site), flags in
+                        zip(keys, screen(records, **kwargs)))
+        server.info_cache.executemany('''insert or replace into qc (event_id,
+                                      site, flags) values (?, ?, ?);''', rows)
+        server.info_cache.commit()
+        screened += len(rows)
+    return screened
+
+
+def get_flags(server, event, site):
+    """Get the stored flags of a record, or None if it has not been screened.
+
+    :param server: The server the record is from.
+    :type server: :class:`sm.Server`
+    :param event: The event ID of the record.
+    :type event: integer
+    :param site: The GeoNet code for the site of the record.
+    :type site: string
+
+    """
+    try:
+        row = server.info_cache.execute('''select flags from qc where
+                                        event_id=? and site=?;''',
+                                        (event, site.upper())).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row['flags'] if row is not None else None
+
+
+def passed_records(server, flags=ALL):
+    """Query function for :func:`sm.batch.map_records` which returns the
+    records which have been screened and have none of the given flags set.
+    Records which have not been screened are not included.
+
+    :param server: The server to query.
+    :type server: :class:`sm.Server`
+    :param flags: The flags which exclude a record. By default, any problem
+                  excludes it.
+    :type flags: integer
+
+    """
+    if flags == ALL:
+        sql = 'select event_id, site from qc where flags=0;'
+        parameters = ()
+    else:
+        sql = 'select event_id, site from qc where flags & ? = 0;'
+        parameters = (flags,)
+    try:
+        cursor = server.info_cache.execute(sql, parameters)
+    except sqlite3.OperationalError:
+        return []
+    return [(row['event_id'], row['site']) for row in cursor]
@@ -18,7 +18,12 @@ import math
 import numpy
 import pytz
 
+from sm import instrument
+from sm.intensity import acceleration_measures
+from sm.spectra import acceleration_spectra
 
+
+@instrument.timed('parse.component')
 def parse_component(source, timezone):
     """Parse component information from a file object. This assumes the file
     pointer is at the start of the component - if not, unspecified bad things
@@ -90,14 +95,19 @@ def parse_component(source, timezone):
     t, pre, app, a, v, d, x, x, bmin, bs = map(int, source.readline().split())
 
     # Collate the buffer start time.
-    start = datetime(by, bm, bd, bh, bmin, bs/1000, 0, pytz.utc)
+    start = datetime(by, bm, bd, bh, bmin, bs // 1000, (bs % 1000) * 1000,
+                     pytz.utc)
     header['buffer_start'] = start.astimezone(timezone)
 
+    # The number of digitised samples the header claims there are. See the
+    # notes below about why this is not used to read the data.
+    header['digitised_samples'] = t
+
     # And then six lines of ten floating-point numbers, most of which we
     # don't care about.
     source.readline()
     x, x, x, x, ml, ms, mw, mb, x, x, = map(float, source.readline().split())
-    d, x, x, x, x, dt, x, x, x, g = map(float, source.readline().split())
+    duration, x, x, x, x, dt, x, x, x, g = map(float, source.readline().split())
     source.readline()
     source.readline()
     source.readline()
@@ -107,7 +117,7 @@ def parse_component(source, timezone):
     header['magnitudes']['Ms'] = ms
     header['magnitudes']['Mw'] = mw
     header['magnitudes']['Mb'] = mb
-    header['duration'] = d
+    header['duration'] = duration
     header['timestep'] = dt
     header['site']['local_gravity'] = g/1000
 
@@ -208,6 +218,10 @@ class Record(object):
                              and the final row the vertical acceleration.
         * ``data_length`` - the length of each row of data.
         * ``duration`` - the duration of the record in seconds.
+        * ``digitised_samples`` - the number of digitised samples given in the
+                                  header of each component read. This should
+                                  match ``data_length`` but is sometimes
+                                  wrong.
         * ``event`` - a dictionary containing some details of the event itself,
                       such as the bearing and distance from the site, the depth,
                       the location and when the event started.
@@ -279,6 +293,7 @@ class Record(object):
 
         # Pull out the components.
         first_run = True
+        self.digitised_samples = []
         seen_axes = set()
         horizontal_axes = 0
         vertical_axis = False
@@ -309,6 +324,7 @@ class Record(object):
             if header['axis'] in seen_axes:
                 continue
             seen_axes.add(header['axis'])
+            self.digitised_samples.append(header['digitised_samples'])
 
             # The vertical axis is represented by an angle of 999 degrees.
             if header['axis'] == 999:
@@ -347,3 +363,35 @@ class Record(object):
         # Did we get enough components?
         if not vertical_axis or horizontal_axes < 2:
             raise TooFewComponents()
+
+    def response_spectrum(self, periods, damping=0.05):
+        """Calculate the elastic response spectrum of all three axes of the
+        record. Three numpy arrays are returned: the spectral displacement,
+        the pseudo-spectral velocity and the pseudo-spectral acceleration. Each
+        is indexed first by axis, and then by period and (if an array of them
+        was given) damping ratio.
+
+        To calculate the spectra of many records at once, use
+        :func:`sm.spectra.response_spectra` instead.
+
+        :param periods: The natural periods, in seconds, to evaluate the
+                        spectrum at.
+        :type periods: float or array of floats
+        :param damping: The damping ratio(s) as a fraction of critical.
+        :type damping: float or array of floats
+
+        """
+        sd, psv, psa = acceleration_spectra([self.acceleration],
+                                            [self.timestep], periods, damping)
+        return sd[0], psv[0], psa[0]
+
+    def intensity_measures(self):
+        """Calculate the standard intensity measures of all three axes of the
+        record. These are returned as a structured numpy array indexed by axis,
+        with the fields described by :data:`sm.intensity.MEASURES`.
+
+        To calculate the measures of many records at once, use
+        :func:`sm.intensity.intensity_measures` instead.
+
+        """
+        return acceleration_measures([self.acceleration], [self.timestep])[0]
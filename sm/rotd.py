@@ -0,0 +1,137 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Orientation-independent measures of horizontal ground motion.
+
+The RotDnn measures of Boore (2010) rotate the two horizontal components of a
+record through a range of angles, take the peak of each rotated component, and
+then take the nn'th percentile of those peaks over all the angles. RotD50 is
+the median and RotD100 the maximum.
+
+All rotations are done with a single rotation matrix. The ground motion peaks
+rotate blocks of samples at a time, and the spectral peaks rotate the
+oscillator responses one time step at a time, so there is never a full length
+copy of the record for each angle.
+
+"""
+
+import numpy
+
+from sm.spectra import acceleration_spectra, stack, _rotated_peaks
+
+
+def rotation_matrix(angles=180):
+    """Create the matrix which rotates a pair of orthogonal horizontal
+    components. Row i of the matrix is [cos(theta_i), sin(theta_i)], where the
+    angles theta are evenly spaced over 0 to 180 degrees (the peaks repeat
+    after 180 degrees).
+
+    :param angles: The number of angles to rotate through.
+    :type angles: integer
+
+    """
+    theta = numpy.radians(numpy.arange(angles) * 180.0 / angles)
+    return numpy.column_stack((numpy.cos(theta), numpy.sin(theta)))
+
+
+def rotd(peaks, percentiles=(50, 100)):
+    """Reduce peaks of rotated components to the RotDnn measures. The angles
+    must be indexed by the last axis of the peaks, and the requested
+    percentiles become the first axis of the result.
+
+    :param peaks: The peaks of the rotated components.
+    :type peaks: numpy array
+    :param percentiles: The nn values of the RotDnn measures to calculate.
+    :type percentiles: sequence of numbers
+
+    """
+    return numpy.percentile(peaks, percentiles, axis=-1)
+
+
+def rotd_peaks(histories, percentiles=(50, 100), angles=180):
+    """Calculate the RotDnn values of the peaks of a batch of histories. The
+    first two axes of each history must be orthogonal horizontal components,
+    such as the acceleration of a :class:`Record` (with any alignment other
+    than :attr:`Record.Alignment.NONE`, which may not be orthogonal).
+
+    The result is indexed by history and then percentile.
+
+    :param histories: The histories. Each entry should be a two-dimensional
+                      array indexed by axis and then sample.
+    :type histories: sequence of numpy arrays
+    :param percentiles: The nn values of the RotDnn measures to calculate.
+    :type percentiles: sequence of numbers
+    :param angles: The number of angles to rotate through.
+    :type angles: integer
+
+    """
+    stacked, lengths = stack(histories)
+    peaks = _rotated_peaks(stacked, rotation_matrix(angles))
+    return numpy.rollaxis(rotd(peaks, percentiles), 0, 2)
+
+
+def rotd_pga(records, percentiles=(50, 100), angles=180):
+    """Calculate the RotDnn peak ground acceleration of a batch of
+    :class:`Record` instances. The result is indexed by record and then
+    percentile.
+
+    :param records: The records to calculate the values for.
+    :type records: sequence of :class:`Record`
+    :param percentiles: The nn values of the RotDnn measures to calculate.
+    :type percentiles: sequence of numbers
+    :param angles: The number of angles to rotate through.
+    :type angles: integer
+
+    """
+    return rotd_peaks([r.acceleration for r in records], percentiles, angles)
+
+
+def rotd_spectra(records, periods, damping=0.05, percentiles=(50, 100),
+                 angles=180):
+    """Calculate RotDnn elastic response spectra of a batch of :class:`Record`
+    instances. The oscillator responses to the two horizontal components are
+    rotated at every time step, which is equivalent to (and much cheaper than)
+    finding the response to each rotated component.
+
+    Three arrays are returned: the spectral displacement, the pseudo-spectral
+    velocity and the pseudo-spectral acceleration. Each is indexed by record
+    and then percentile, followed by period and (if an array of them was
+    given) damping ratio, as for :func:`sm.spectra.acceleration_spectra`.
+
+    :param records: The records to calculate the spectra of.
+    :type records: sequence of :class:`Record`
+    :param periods: The natural periods, in seconds, to evaluate the spectra
+                    at.
+    :type periods: float or array of floats
+    :param damping: The damping ratio(s) as a fraction of critical.
+    :type damping: float or array of floats
+    :param percentiles: The nn values of the RotDnn measures to calculate.
+    :type percentiles: sequence of numbers
+    :param angles: The number of angles to rotate through.
+    :type angles: integer
+
+    """
+    spectra = acceleration_spectra([r.acceleration for r in records],
+                                   [r.timestep for r in records], periods,
+                                   damping, rotation_matrix(angles))
+
+    # Move the angles to the end, reduce them to the percentiles, and then
+    # move the percentiles back to just after the records.
+    result = []
+    for values in spectra:
+        values = numpy.rollaxis(values, 1, values.ndim)
+        values = rotd(values, percentiles)
+        result.append(numpy.rollaxis(values, 0, 2))
+    return tuple(result)
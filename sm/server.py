@@ -13,17 +13,22 @@
 # You should have received a copy of the GNU General Public License along with
 # geomotion.  If not, see <http://www.gnu.org/licenses/>.
 
-import csv
+# Note that the modules which are only needed to update the cache or work with
+# records (ftplib, urllib2, csv and the numpy based parts of the package) are
+# imported by the methods that use them. This keeps the start up time down for
+# scripts which only look information up in the cache.
 from datetime import datetime
-import ftplib
 import os
 import os.path
 from operator import itemgetter
 import pytz
 import sqlite3
-import urllib2
+import tempfile
 
-from sm.record import Record
+from sm import instrument
+
+#: The URL of the CSV list of sites used by :meth:`Server.update_sites`.
+SITES_URL = 'http://magma.geonet.org.nz/ws-delta/site?type=seismicSite&outputFormat=csv'
 
 
 class NoSuchSite(ValueError):
@@ -46,6 +51,55 @@ class NoSuchRecord(ValueError):
     pass
 
 
+class LocalMirror(object):
+    """A stand-in for the FTP connection which reads from a local copy of the
+    GeoNet FTP tree instead. Only the commands used by :class:`Server` are
+    provided. Absolute paths on the server are taken relative to the root
+    directory of the mirror.
+
+    """
+
+    def __init__(self, root):
+        """
+
+        :param root: The directory holding the copy of the tree.
+        :type root: string
+
+        """
+        self.root = root
+        self._cwd = root
+
+    def login(self):
+        pass
+
+    def sendcmd(self, command):
+        return '200 NOOP command successful'
+
+    def quit(self):
+        pass
+
+    def cwd(self, directory):
+        import ftplib
+        path = os.path.join(self.root, directory.lstrip('/'))
+        if not os.path.isdir(path):
+            raise ftplib.error_perm('550 {0}: No such directory'.format(directory))
+        self._cwd = path
+
+    def nlst(self):
+        return sorted(os.listdir(self._cwd))
+
+    def retrbinary(self, command, callback, blocksize=8192):
+        f = open(os.path.join(self._cwd, command.split(' ', 1)[1]), 'rb')
+        try:
+            while True:
+                block = f.read(blocksize)
+                if not block:
+                    break
+                callback(block)
+        finally:
+            f.close()
+
+
 class Server(object):
     """Interface with the Geonet servers and retrieve strong motion data.
 
@@ -107,7 +161,8 @@ class Server(object):
 
     """
 
-    def __init__(self, cache_dir='cache', local_timezone=pytz.timezone('NZ')):
+    def __init__(self, cache_dir='cache', local_timezone=pytz.timezone('NZ'),
+                 read_only=False, mirror=None, sites_url=SITES_URL):
         """
 
         :param cache_dir: The directory to use as a cache. This can be either an
@@ -116,11 +171,35 @@ class Server(object):
         :type cache_dir: string
         :param local_timezone: The timezone to return event dates in.
         :type local_timezone: pytz.timezone
+        :param read_only: Open the info cache so it cannot be modified. This is
+                          useful when several processes are using the same
+                          cache at once. Data files are still downloaded into
+                          the cache when needed. This needs SQLite 3.8.0 or
+                          later.
+        :type read_only: Boolean
+        :param mirror: A directory holding a local copy of the GeoNet FTP tree
+                       to use instead of the FTP server. See
+                       :class:`LocalMirror`.
+        :type mirror: string
+        :param sites_url: The URL to download the list of sites from.
+        :type sites_url: string
+        :raise ValueError: If a read only cache is requested but the SQLite
+                           library is too old to enforce it.
 
         """
+        # Older versions of SQLite silently ignore the query_only pragma, which
+        # would leave a read only cache writable.
+        if read_only and sqlite3.sqlite_version_info < (3, 8, 0):
+            raise ValueError('Read only caches need SQLite 3.8.0 or later, '
+                             'not {0}.'.format(sqlite3.sqlite_version))
+
         # Store the timezone.
         self.local_timezone = local_timezone
 
+        # Where to get the data from.
+        self.mirror = mirror
+        self.sites_url = sites_url
+
         # Convert cache directory to an absolute path if necessary.
         if not os.path.isabs(cache_dir):
             cache_dir = os.path.abspath(cache_dir)
@@ -132,24 +211,49 @@ class Server(object):
         if not os.path.isdir(self.cache_dir):
             os.mkdir(self.cache_dir)
 
-        # Connect to the info cache.
-        self.info_cache = sqlite3.connect(os.path.join(self.cache_dir,
-                                                       'info_cache.sqlite'))
-
-        # Row factory.
-        self.info_cache.row_factory=sqlite3.Row
+        # The connection to the info cache is opened the first time it is
+        # needed. See the info_cache property.
+        self.read_only = read_only
+        self._info_cache = None
 
-        # Enable foreign keys.
-        self.info_cache.execute('pragma foreign_keys = ON;')
+        # The in-memory copy of the sites table. This is loaded the first time
+        # it is needed and discarded whenever the sites are updated.
+        self._site_table = None
 
     def __del__(self):
-        # Close the info cache, making sure we commit any pending changes.
-        self.info_cache.commit()
-        self.info_cache.close()
+        # Close the info cache if it was opened, making sure we commit any
+        # pending changes.
+        if getattr(self, '_info_cache', None) is not None:
+            self._info_cache.commit()
+            self._info_cache.close()
 
         # Ensure we close the FTP connection properly when the instance is deleted.
         self.disconnect_ftp()
 
+    @property
+    def info_cache(self):
+        """The connection to the SQLite database holding the info cache. This
+        is opened the first time it is used.
+
+        """
+        if self._info_cache is None:
+            # Connect to the info cache.
+            connection = sqlite3.connect(os.path.join(self.cache_dir,
+                                                      'info_cache.sqlite'))
+
+            # Row factory.
+            connection.row_factory=sqlite3.Row
+
+            # Enable foreign keys.
+            connection.execute('pragma foreign_keys = ON;')
+
+            # Refuse any modifications if requested.
+            if self.read_only:
+                connection.execute('pragma query_only = ON;')
+
+            self._info_cache = connection
+        return self._info_cache
+
     def connect_ftp(self):
         """Create or check the connection to the FTP server. If a connection
         previously existed, this will check it still works. If it has timed out,
@@ -159,10 +263,12 @@ class Server(object):
         retrieve data from the server will call this automatically.
 
         """
+        import ftplib
+
         # We already have a connection, see if it is still alive.
         if hasattr(self, '_ftpconnection'):
             try:
-                self._ftpconnection.sendcmd('NOOP')
+                self._ftp('sendcmd', 'NOOP')
             except ftplib.error_temp as e:
                 # Connection has timed out, we'll replace it with a new one later
                 # on.
@@ -176,10 +282,22 @@ class Server(object):
         # New connection needed. Note we need to run the check again in case it
         # timed out in the previous block.
         if not hasattr(self, '_ftpconnection'):
-            self._ftpconnection = ftplib.FTP('ftp.geonet.org.nz')
-            self._ftpconnection.login()
+            with instrument.timer('ftp.connect'):
+                if self.mirror is not None:
+                    self._ftpconnection = LocalMirror(self.mirror)
+                else:
+                    self._ftpconnection = ftplib.FTP('ftp.geonet.org.nz')
+                self._ftpconnection.login()
             return
 
+    def _ftp(self, command, *args):
+        """Helper function to run a command on the FTP connection, timing it
+        if instrumentation is enabled.
+
+        """
+        with instrument.timer('ftp.' + command):
+            return getattr(self._ftpconnection, command)(*args)
+
     def disconnect_ftp(self):
         """Close the connection to the FTP server. This is automatically called
         when Python destroys the instance, but you can call it earlier if you
@@ -215,39 +333,16 @@ class Server(object):
         # Get a cursor to the cache.
         cursor = self.info_cache.cursor()
 
-        # Does the events table already exist in the cache?
-        cursor.execute('''select count(*) from sqlite_master where type='table'
-                       and name='events';''')
-        if not bool(cursor.fetchone()[0]):
-            # Create the table.
-            cursor.execute('''create table events (
-                id integer primary key autoincrement,
-                year integer not null,
-                month integer not null,
-                day integer not null,
-                hour integer not null,
-                minute integer not null,
-                second integer not null);''')
-
-        # How about the records table?
-        cursor.execute('''select count(*) from sqlite_master where type='table'
-                       and name='records';''')
-        if not bool(cursor.fetchone()[0]):
-            # Create the table.
-            cursor.execute('''create table records (
-                event_id integer not null,
-                site varchar not null,
-                ftp_directory varchar not null,
-                filename varchar not null,
-                foreign key(event_id) references events(id) on delete cascade);''')
+        # Make sure the tables exist.
+        self._create_event_tables(cursor)
 
         # We'll need to be connected to the FTP server for this.
         self.connect_ftp()
 
         # First, lets get a list of all the years data possibly exists for.
         base_dir = '/strong/processed/Proc'
-        self._ftpconnection.cwd(base_dir)
-        years = sorted(map(int, self._ftpconnection.nlst()))
+        self._ftp('cwd', base_dir)
+        years = sorted(map(int, self._ftp('nlst')))
 
         # Filter out years earlier than the requested update time.
         years = [year for year in years if year >= since.year]
@@ -258,10 +353,10 @@ class Server(object):
 
             # Move into the data directory for the year.
             year_dir = base_dir + '/' + str(year)
-            self._ftpconnection.cwd(year_dir)
+            self._ftp('cwd', year_dir)
 
             # Get all the months data exists for..
-            raw = self._ftpconnection.nlst()
+            raw = self._ftp('nlst')
 
             # Filter out the directories we know how to handle.
             months = sorted(map(int, (month[:2] for month in raw if month.endswith('_Prelim'))))
@@ -280,41 +375,18 @@ class Server(object):
 
                 # Move into the data directory for the month.
                 month_dir = year_dir + '/{0:02d}_Prelim'.format(month)
-                self._ftpconnection.cwd(month_dir)
+                self._ftp('cwd', month_dir)
 
                 # Get all the event directories.
-                events = self._ftpconnection.nlst()
+                events = self._ftp('nlst')
 
                 # And finally, we need to get the sites for each event.
                 for event in events:
-                    # Split the folder name into its component parts to get the
-                    # date of the event.
-                    date, time = event.split('_')
-                    y, m, d = date.split('-')
-                    h, mn, s = time[0:2], time[2:4], time[4:6]
-
-                    # Insert the event and get its ID.
-                    cursor.execute('''insert into events (year, month, day,
-                                   hour, minute, second) values (?, ?, ?, ?, ?,
-                                   ?);''', (y, m, d, h, mn, s))
-                    event_id = cursor.lastrowid
-
-                    # Move into the data directory.
-                    data_dir = month_dir + '/' + event + '/Vol1/data'
-                    self._ftpconnection.cwd(data_dir)
-
-                    # Get all filenames.
-                    sites = self._ftpconnection.nlst()
-
-                    # Get the site names.
-                    sites = [(event_id, site[16:-4], data_dir, site) for site in sites]
-
-                    # Insert it into the cache.
-                    cursor.executemany('''insert into records (event_id, site,
-                                       ftp_directory, filename) values(?, ?, ?,
-                                       ?);''', sites)
-
-                # Store the changes to this month.
+                    self._add_event(cursor, month_dir, event)
+
+                # Store the changes to this month, letting anybody caching
+                # information about events know it has changed.
+                self._bump_generation(cursor, 'events')
                 self.info_cache.commit()
 
         # Done. Shouldn't have to commit here but better safe than sorry. In the
@@ -323,9 +395,122 @@ class Server(object):
         self.info_cache.commit()
         cursor.close()
 
+    def _create_event_tables(self, cursor):
+        """Helper function to create the events, records and generations tables
+        if they do not exist yet. Creating a table commits any open
+        transaction, so this must be called before making any changes.
+
+        """
+        # Does the events table already exist in the cache?
+        cursor.execute('''select count(*) from sqlite_master where type='table'
+                       and name='events';''')
+        if not bool(cursor.fetchone()[0]):
+            # Create the table.
+            cursor.execute('''create table events (
+                id integer primary key autoincrement,
+                year integer not null,
+                month integer not null,
+                day integer not null,
+                hour integer not null,
+                minute integer not null,
+                second integer not null);''')
+
+        # How about the records table?
+        cursor.execute('''select count(*) from sqlite_master where type='table'
+                       and name='records';''')
+        if not bool(cursor.fetchone()[0]):
+            # Create the table.
+            cursor.execute('''create table records (
+                event_id integer not null,
+                site varchar not null,
+                ftp_directory varchar not null,
+                filename varchar not null,
+                foreign key(event_id) references events(id) on delete cascade);''')
+
+        # And the generation counters?
+        cursor.execute('''select count(*) from sqlite_master where type='table'
+                       and name='generations';''')
+        if not bool(cursor.fetchone()[0]):
+            # Create the table.
+            cursor.execute('''create table generations (
+                name varchar primary key not null,
+                value integer not null);''')
+
+    def _add_event(self, cursor, month_dir, event):
+        """Helper function to add an event and its records to the cache, given
+        the name of its directory on the FTP server. This is done within the
+        caller's transaction. A two element tuple of the new event ID and the
+        list of site codes with records is returned.
+
+        """
+        # Split the folder name into its component parts to get the date of the
+        # event.
+        date, time = event.split('_')
+        y, m, d = date.split('-')
+        h, mn, s = time[0:2], time[2:4], time[4:6]
+
+        # Insert the event and get its ID.
+        cursor.execute('''insert into events (year, month, day, hour, minute,
+                       second) values (?, ?, ?, ?, ?, ?);''', (y, m, d, h, mn, s))
+        event_id = cursor.lastrowid
+
+        # Move into the data directory.
+        data_dir = month_dir + '/' + event + '/Vol1/data'
+        self._ftp('cwd', data_dir)
+
+        # Get all filenames.
+        sites = self._ftp('nlst')
+
+        # Get the site names.
+        sites = [(event_id, site[16:-4], data_dir, site) for site in sites]
+
+        # Insert it into the cache.
+        cursor.executemany('''insert into records (event_id, site, ftp_directory,
+                           filename) values(?, ?, ?, ?);''', sites)
+        return event_id, [site[1] for site in sites]
+
+    def _bump_generation(self, cursor, name):
+        """Helper function to increment a generation counter. This is done
+        within the caller's transaction, so the table must already have been
+        created by :meth:`_create_event_tables`.
+
+        """
+        cursor.execute('''insert or ignore into generations (name, value)
+                       values (?, 0);''', (name,))
+        cursor.execute('''update generations set value=value+1 where
+                       name=?;''', (name,))
+
+    def get_generation(self, name='events'):
+        """Get the current value of a generation counter. The counter is
+        incremented every time the corresponding information in the cache
+        changes, so anything derived from the cache can be reused for as long as
+        the generation stays the same. Currently the only counter is
+        ``events``, which is changed by :meth:`update_events`.
+
+        :param name: The name of the counter.
+        :type name: string
+
+        """
+        cursor = self.info_cache.cursor()
+        cursor.execute('''select count(*) from sqlite_master where type='table'
+                       and name='generations';''')
+        if not bool(cursor.fetchone()[0]):
+            cursor.close()
+            return 0
+        cursor.execute('select value from generations where name=?;', (name,))
+        row = cursor.fetchone()
+        cursor.close()
+        return row['value'] if row is not None else 0
+
     def update_sites(self):
         """Update the list of sites to match the list on the GeoNet website.
 
+        The new list is compared against the cached one and only the sites
+        which have been added, changed or removed are written. All changes are
+        made in a single transaction, so anybody reading the cache while it is
+        being updated will see either the old list or the new list, but never an
+        empty or partial one.
+
         """
         # Get a cursor for the cache.
         cursor = self.info_cache.cursor()
@@ -340,12 +525,17 @@ class Server(object):
                            longitude float not null, opened timestamp not null,
                            status varchar not null, notes varchar);''')
 
-        # It does exist; empty it so we can refresh it.
-        else:
-            cursor.execute('delete from sites;')
+        # Load the current contents of the table so we can work out what has
+        # changed.
+        cursor.execute('''select code, name, latitude, longitude, opened, status,
+                       notes from sites;''')
+        existing = dict((row['code'], tuple(row)) for row in cursor)
+
+        import csv
+        import urllib2
 
         # Get the raw CSV file.
-        raw_csv = urllib2.urlopen("http://magma.geonet.org.nz/ws-delta/site?type=seismicSite&outputFormat=csv")
+        raw_csv = urllib2.urlopen(self.sites_url)
 
         # Skip the first line which is a note about what filtering was
         # performed to create the file.
@@ -354,39 +544,71 @@ class Server(object):
         # Let the CSV module parse the rest into a dictionary.
         sites = csv.DictReader(raw_csv)
 
-        # Add the entries to the cache. Note we throw away sites with
-        # duplicate codes as they refer to multiple sensors in the same site
-        # (e.g., Wellington Hospital). Although they are separated spatially
-        # its not by a huge amount, and we don't care *that* much that we
-        # want to come up with some scheme of differentiating between them.
-        # Unfortunately this means some currently operational sites are
-        # marked as closed because there has been more than one site there.
-        # Need to investigate if we can query the server with more than one
-        # status filter, otherwise we'll need to do some filtering of our
-        # own here.
+        # Codes of all sites in the new list.
         seen = set()
-        for site in sites:
-            # Filter duplicates.
-            if site['Code'] in seen:
-                continue
-
-            # Format the date, converting it from the NZ time it is given in to
-            # UTC.
-            opened = datetime.strptime(site['Opened'], '%Y-%m-%d %H:%M:%S.%f')
-            opened = pytz.timezone('NZ').localize(opened)
-            site['Opened'] = opened.astimezone(pytz.utc).replace(tzinfo=None)
 
-            # Insert the record.
-            cursor.execute('''insert into sites (code, name, latitude,
-                           longitude, opened, status, notes) values (:Code,
-                           :Name, :Latitude, :Longitude, :Opened, :Status,
-                           :Notes);''', site)
-            seen.add(site['Code'])
+        def changed_sites():
+            """Generator which streams the sites from the CSV file, yielding only
+            those which are new or differ from the cached version.
+
+            """
+            # Note we throw away sites with duplicate codes as they refer to
+            # multiple sensors in the same site (e.g., Wellington Hospital).
+            # Although they are separated spatially its not by a huge amount,
+            # and we don't care *that* much that we want to come up with some
+            # scheme of differentiating between them. Unfortunately this means
+            # some currently operational sites are marked as closed because
+            # there has been more than one site there. Need to investigate if
+            # we can query the server with more than one status filter,
+            # otherwise we'll need to do some filtering of our own here.
+            for site in sites:
+                # Filter duplicates.
+                if site['Code'] in seen:
+                    continue
+                seen.add(site['Code'])
+
+                # Format the date, converting it from the NZ time it is given
+                # in to UTC. This is stored in the same textual format SQLite
+                # uses so we can compare it against the cached value.
+                opened = datetime.strptime(site['Opened'], '%Y-%m-%d %H:%M:%S.%f')
+                opened = pytz.timezone('NZ').localize(opened)
+                opened = opened.astimezone(pytz.utc).replace(tzinfo=None)
+
+                # Build the row as it will be stored.
+                row = (site['Code'], site['Name'], float(site['Latitude']),
+                       float(site['Longitude']), str(opened), site['Status'],
+                       site['Notes'])
+
+                # Only yield it if it has changed.
+                if existing.get(row[0]) != row:
+                    yield row
+
+        # Write the new and changed sites. Note that the sqlite3 module starts
+        # a transaction before the first modification and it stays open until
+        # we commit below.
+        try:
+            cursor.executemany('''insert or replace into sites (code, name,
+                               latitude, longitude, opened, status, notes)
+                               values (?, ?, ?, ?, ?, ?, ?);''',
+                               changed_sites())
+
+            # And remove any sites which are no longer listed.
+            removed = [(code,) for code in existing if code not in seen]
+            cursor.executemany('delete from sites where code=?;', removed)
+        except:
+            self.info_cache.rollback()
+            raise
+        finally:
+            raw_csv.close()
+            cursor.close()
 
         # Done.
-        raw_csv.close()
         self.info_cache.commit()
 
+        # The in-memory site table is now out of date.
+        self._site_table = None
+
+    @instrument.timed('query.get_years')
     def get_years(self):
         """Get a list of years for which records exist.
 
@@ -397,6 +619,7 @@ class Server(object):
         cursor.close()
         return years
 
+    @instrument.timed('query.get_months')
     def get_months(self, year):
         """Get a list of months in the given year for which records exist.
 
@@ -410,6 +633,7 @@ class Server(object):
         cursor.close()
         return months
 
+    @instrument.timed('query.get_events')
     def get_events(self, year, month):
         """Get a list of events in the given year and month. Each event is
         returned as a two-element tuple, the first element of which is the event
@@ -429,6 +653,7 @@ class Server(object):
         cursor.close()
         return sorted(events, key=itemgetter(1))
 
+    @instrument.timed('query.events_at_site')
     def events_at_site(self, site):
         """Get a list of events for which a particular site has a record.  Each
         event is returned as a two-element tuple, the first element of which is
@@ -455,6 +680,7 @@ class Server(object):
         date = datetime(y, m, d, h, mn, s, tzinfo=pytz.utc)
         return date.astimezone(self.local_timezone)
 
+    @instrument.timed('query.get_sites')
     def get_sites(self, event):
         """Get a list of the sites which have records for the given event.
 
@@ -469,6 +695,7 @@ class Server(object):
         cursor.close()
         return sites
 
+    @instrument.timed('query.get_site_info')
     def get_site_info(self, site):
         """Find further information about a particular GeoNet site. This
         information is returned as a dictionary with the following keys:
@@ -486,28 +713,81 @@ class Server(object):
         :raise NoSuchSite:
 
         """
+        # Load the site table if we haven't already got it.
+        if self._site_table is None:
+            self._load_site_table()
+
+        # Invalid site code.
+        try:
+            info = self._site_table[site]
+        except KeyError:
+            raise NoSuchSite(site)
+
+        # Return a copy so the caller is free to modify it.
+        return dict(info)
+
+    def _load_site_table(self):
+        """Helper function to load the entire sites table into memory, with the
+        timestamps already converted to local datetime objects.
+
+        """
+        self._site_table = {}
+
         # Get a cursor for the cache.
         cursor = self.info_cache.cursor()
 
-        # Try to get the site.
-        cursor.execute('select * from sites where code=?;', (site,))
-        info = cursor.fetchone()
+        # If the table doesn't exist yet, then there are no sites.
+        cursor.execute('''select count(*) from sqlite_master where type='table'
+                       and name='sites';''')
+        if not bool(cursor.fetchone()[0]):
+            cursor.close()
+            return
+
+        # Convert each row to a dictionary and convert timestamp to a datetime.
+        cursor.execute('select * from sites;')
+        for row in cursor:
+            d = dict(row)
+            date = datetime.strptime(d['opened'], '%Y-%m-%d %H:%M:%S')
+            date = pytz.utc.localize(date)
+            d['opened'] = date.astimezone(self.local_timezone)
+            self._site_table[d['code']] = d
 
         # Done with the cursor.
         cursor.close()
 
-        # Invalid site code.
-        if not info:
-            raise NoSuchSite(site)
+    @instrument.timed('query.record_location')
+    def _record_location(self, event, site):
+        """Helper function to find the FTP directory and filename of a record,
+        raising NoSuchRecord if there is no such record.
+
+        """
+        cursor = self.info_cache.cursor()
+        cursor.execute('''select ftp_directory, filename from records where
+                       event_id=? and site=?;''', (event, site.upper()))
+        row = cursor.fetchone()
+        cursor.close()
+
+        # No such record.
+        if row is None:
+            raise NoSuchRecord(event, site)
+
+        return row['ftp_directory'], row['filename']
 
-        # Convert row to a dictionary and convert timestamp to a datetime.
-        d = dict(info)
-        date = datetime.strptime(d['opened'], '%Y-%m-%d %H:%M:%S')
-        date = pytz.utc.localize(date)
-        d['opened'] = date.astimezone(self.local_timezone)
-        return d
+    def get_record_filename(self, event, site):
+        """Get the name of the GeoNet data file holding the record of an event
+        from a particular site. The name is unique to the record and does not
+        change, so it can be used to identify the record without loading it.
 
-    def get_record(self, event, site, alignment=Record.Alignment.NORTH_AND_EAST, skip_cache=False):
+        :param event: The event ID to get the filename for.
+        :type event: integer
+        :param site: The GeoNet code for the site in question.
+        :type site: string
+        :raise NoSuchRecord:
+
+        """
+        return self._record_location(event, site)[1]
+
+    def get_record(self, event, site, alignment=None, skip_cache=False):
         """Get the record of an event from a particular site. This is returned
         as a Record instance.
 
@@ -517,59 +797,223 @@ class Server(object):
         :type site: string
         :param alignment: A constant from :class:`Record.Alignment` specifying
                           what alignment the measured values should be remapped
-                          to.
+                          to. If None, they are aligned to north and east.
         :param skip_cache: Ignore cached data and force a download.
         :type skip_cache: Boolean
 
         """
+        from sm.record import Record
+
+        if alignment is None:
+            alignment = Record.Alignment.NORTH_AND_EAST
+
         # Make sure the site name is uppercased.
         site = site.upper()
 
-        # See if there is a corresponding record.
-        cursor = self.info_cache.cursor()
-        cursor.execute('''select ftp_directory, filename from records where
-                       event_id=? and site=?;''', (event, site))
-        row = cursor.fetchone()
-        cursor.close()
+        # Make sure we have the data file.
+        cache_filename = self.fetch_record(event, site, skip_cache)
 
-        # No such record.
-        if row is None:
-            raise NoSuchRecord(event, site)
+        # Try to get the site info. In theory, the site must exist if we found
+        # a record. But this depends on (a) the sites cache being populated, and
+        # (b) the site list on the GeoNet website being processed correctly when
+        # the cache is populated.
+        try:
+            site_info = self.get_site_info(site)
+        except NoSuchSite:
+            site_info = {}
+
+        # Parse and return the data.
+        return Record(site_info, cache_filename, self.local_timezone,
+                      alignment=alignment)
+
+    def fetch_record(self, event, site, skip_cache=False):
+        """Make sure the data file of a record is in the cache, downloading it
+        if needed, and return its filename. This does not parse the file.
+
+        :param event: The event ID to get the record for.
+        :type event: integer
+        :param site: The GeoNet code for the site in question.
+        :type site: string
+        :param skip_cache: Ignore cached data and force a download.
+        :type skip_cache: Boolean
+        :raise NoSuchRecord:
 
-        # Retrieve the details.
-        ftp_directory = row['ftp_directory']
-        filename = row['filename']
+        """
+        # Find where the record is.
+        ftp_directory, filename = self._record_location(event, site)
         cache_filename = os.path.join(self.cache_dir, filename)
 
         # Do we need to download it?
         if skip_cache or not os.path.isfile(cache_filename):
+            instrument.count('record_cache.miss')
+
             # Ensure we are connected.
             self.connect_ftp()
 
             # Move to the directory.
-            self._ftpconnection.cwd(ftp_directory)
-
-            # Retrieve the data.
-            f = open(cache_filename, 'wb')
+            self._ftp('cwd', ftp_directory)
+
+            # Retrieve the data into a temporary file, counting the bytes if
+            # wanted. Other threads and processes may be using the cache, so
+            # the file is only renamed into place once it is complete.
+            handle, temporary = tempfile.mkstemp(prefix='.download-',
+                                                 dir=self.cache_dir)
+            f = os.fdopen(handle, 'wb')
+            callback = f.write
+            if instrument.enabled:
+                def callback(block):
+                    instrument.count('ftp.bytes', len(block))
+                    f.write(block)
             try:
-                self._ftpconnection.retrbinary('RETR {0}'.format(filename), f.write)
+                self._ftp('retrbinary', 'RETR {0}'.format(filename), callback)
             except:
                 # Close and remove the invalid file before propagating the
                 # exception.
                 f.close()
-                os.remove(cache_filename)
+                os.remove(temporary)
                 raise
             f.close()
 
-        # Try to get the site info. In theory, the site must exist if we found
-        # a record. But this depends on (a) the sites cache being populated, and
-        # (b) the site list on the GeoNet website being processed correctly when
-        # the cache is populated.
-        try:
-            site_info = self.get_site_info(site)
-        except NoSuchSite:
-            site_info = {}
+            # The temporary file is only readable by its owner, but the cache
+            # may be shared with other users.
+            os.chmod(temporary, 0644)
+            os.rename(temporary, cache_filename)
+        else:
+            instrument.count('record_cache.hit')
 
-        # Parse and return the data.
-        return Record(site_info, cache_filename, self.local_timezone,
-                      alignment=alignment)
+        return cache_filename
+
+    def get_event_stack(self, event, sites=None, timestep=None, window=None,
+                        alignment=None):
+        """Get the records of an event from many sites, resampled onto a common
+        time grid. A four element tuple is returned. The first element is a
+        list of the sites included, the second element is the time of the first
+        point of the grid, the third is the spacing of the grid in seconds and
+        the fourth is a numpy array of accelerations indexed by site, axis and
+        grid point. Grid points outside a site's record are NaN.
+
+        Records which cannot be parsed are left out.
+
+        :param event: The event ID to get the records for.
+        :type event: integer
+        :param sites: The GeoNet codes of the sites to include. If None, all
+                      sites with a record of the event are included.
+        :type sites: list of strings
+        :param timestep: The spacing of the grid in seconds. If None, the
+                         smallest timestep of the records is used.
+        :type timestep: float
+        :param window: The first and last times of the grid. If None, the grid
+                       covers all the records.
+        :type window: tuple of datetimes
+        :param alignment: A constant from :class:`Record.Alignment` specifying
+                          what alignment the measured values should be remapped
+                          to. If None, they are aligned to north and east.
+        :raise NoSuchRecord: If a requested site has no record of the event, or
+                             no records could be parsed.
+
+        """
+        from sm.stack import synchronise
+
+        if sites is None:
+            sites = self.get_sites(event)
+
+        # Load the records.
+        included = []
+        records = []
+        for site in sites:
+            try:
+                records.append(self.get_record(event, site, alignment))
+            except NoSuchRecord:
+                raise
+            except (ValueError, EOFError):
+                # The record could not be parsed. This includes
+                # TooFewComponents, and truncated or garbled files.
+                continue
+            included.append(site.upper())
+        if not records:
+            raise NoSuchRecord(event, sites)
+
+        # Naive dates are in the local timezone.
+        if window is not None:
+            window = [self._localise(date) for date in window]
+
+        start, timestep, data = synchronise(records, timestep, window)
+        return included, start.astimezone(self.local_timezone), timestep, data
+
+    def site_hvsr(self, site, band=(0.1, 20.0), points=100, bandwidth=40.0,
+                  taper=0.05):
+        """Calculate the mean horizontal to vertical spectral ratio over every
+        record from a site. See :func:`sm.hvsr.site_hvsr` for details. The
+        ratio of each record is kept in the info cache, so only records added
+        since the last call are loaded. A four element tuple is returned: the
+        frequencies in Hz, the geometric mean ratio, the standard deviation of
+        the base 10 logarithm of the ratios and the list of event IDs included.
+
+        :param site: The GeoNet code for the site.
+        :type site: string
+        :param band: The lowest and highest frequencies in Hz.
+        :type band: tuple of floats
+        :param points: The number of logarithmically spaced frequencies.
+        :type points: integer
+        :param bandwidth: The bandwidth coefficient of the Konno and Ohmachi
+                          smoothing window.
+        :type bandwidth: float
+        :param taper: The fraction of each record to taper at each end.
+        :type taper: float
+
+        """
+        from sm.hvsr import site_hvsr
+        return site_hvsr(self, site, band, points, bandwidth, taper)
+
+    def export_snapshot(self, filename, records=None, compress=True):
+        """Write a snapshot of the info cache and data files, which can be
+        imported into another cache with :meth:`import_snapshot`. See
+        :mod:`sm.snapshot` for details. The manifest of the snapshot is
+        returned.
+
+        :param filename: The filename to write the snapshot to.
+        :type filename: string
+        :param records: The (event ID, site code) pairs of the records whose
+                        data files are to be included, if they are cached. If
+                        None, every cached data file is included.
+        :param compress: Whether to gzip the snapshot.
+        :type compress: Boolean
+
+        """
+        from sm.snapshot import export_snapshot
+        return export_snapshot(self, filename, records, compress)
+
+    def import_snapshot(self, filename):
+        """Import a snapshot written by :meth:`export_snapshot`, replacing the
+        info cache and adding the data files to the cache. Nothing is changed
+        unless the whole snapshot is intact. Afterwards, the cache can be
+        brought up to date by updating events from the month of the newest
+        event in the snapshot. The event IDs may change, so the cached
+        shakemaps are removed; see :mod:`sm.snapshot` for other data which
+        must be rebuilt. The manifest of the snapshot is returned.
+
+        :param filename: The filename of the snapshot.
+        :type filename: string
+        :raise sm.snapshot.BadSnapshot: If the snapshot is incomplete or does
+                                        not match its manifest.
+
+        """
+        from sm.snapshot import import_snapshot
+        return import_snapshot(self, filename)
+
+    def stats(self):
+        """Get the counters and latency histograms collected so far. These are
+        only collected once instrumentation has been enabled, and cover every
+        server in the process. See :mod:`sm.instrument` for details of what is
+        measured and of the returned dictionary.
+
+        """
+        return instrument.snapshot()
+
+    def _localise(self, date):
+        """Helper function to attach the local timezone to naive datetimes.
+
+        """
+        if date.tzinfo is None:
+            return self.local_timezone.localize(date)
+        return date
@@ -0,0 +1,308 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Maps of ground motion intensity interpolated from the recording sites.
+
+The intensity measured at each site which recorded an event is interpolated
+onto a regular latitude/longitude grid by inverse distance weighting, using
+only the sites within a search radius of each grid point. The regular grid acts
+as the spatial index: each site only visits the block of grid points within its
+search radius, so the cost grows with the number of grid points near sites
+rather than with the number of grid points times the number of sites.
+
+"""
+
+import json
+import os
+import os.path
+import shutil
+import tempfile
+
+import numpy
+
+from sm.intensity import intensity_measures
+from sm.record import TooFewComponents
+from sm.server import NoSuchRecord, NoSuchSite
+
+#: The mean radius of the Earth in kilometres.
+EARTH_RADIUS = 6371.0
+
+# Kilometres per degree of latitude.
+_KM_PER_DEGREE = EARTH_RADIUS * numpy.pi / 180
+
+
+class SitePoints(object):
+    """The locations of a set of sites and the values measured at each of
+    them, ready to be interpolated onto any number of grids.
+
+    """
+
+    def __init__(self, latitudes, longitudes, values, codes=None):
+        """
+
+        :param latitudes: The latitude of each site in decimal degrees.
+        :param longitudes: The longitude of each site in decimal degrees.
+        :param values: The value measured at each site.
+        :param codes: The GeoNet code of each site, if known.
+        :type codes: list of strings
+
+        """
+        self.latitudes = numpy.asarray(latitudes, dtype=float)
+        self.longitudes = numpy.asarray(longitudes, dtype=float)
+        self.values = numpy.asarray(values, dtype=float)
+        self.codes = codes
+
+    @classmethod
+    def from_event(cls, server, event, measure='pga'):
+        """Create the point set for an event by calculating an intensity
+        measure for every record of the event. The value at each site is the
+        larger of the two horizontal components. Site locations are taken from
+        the site information in the cache, or from the record itself if the
+        site is not in the cache.
+
+        :param server: The server to get the records from.
+        :type server: :class:`sm.Server`
+        :param event: The event ID.
+        :type event: integer
+        :param measure: The name of the measure to use, as one of the fields
+                        of :data:`sm.intensity.MEASURES`.
+        :type measure: string
+        :raise NoSuchRecord: If none of the records of the event could be
+                             parsed.
+
+        """
+        codes = []
+        records = []
+        for site in server.get_sites(event):
+            try:
+                records.append(server.get_record(event, site))
+            except TooFewComponents:
+                continue
+            codes.append(site)
+        if not records:
+            raise NoSuchRecord(event, None)
+
+        # The location in the file header overrides the cached site
+        # information in the record, so look the cached location up again and
+        # only fall back to the header if the site is not in the cache.
+        latitudes = []
+        longitudes = []
+        for code, record in zip(codes, records):
+            try:
+                info = server.get_site_info(code)
+            except NoSuchSite:
+                info = record.site
+            latitudes.append(info['latitude'])
+            longitudes.append(info['longitude'])
+
+        values = intensity_measures(records)[measure][:, :2].max(axis=1)
+        return cls(latitudes, longitudes, values, codes)
+
+    def bounds(self, margin=0.5):
+        """Get the bounding box of the sites as a (south, north, west, east)
+        tuple of decimal degrees.
+
+        :param margin: The extra distance in degrees to add on each side.
+        :type margin: float
+
+        """
+        return (self.latitudes.min() - margin, self.latitudes.max() + margin,
+                self.longitudes.min() - margin, self.longitudes.max() + margin)
+
+    def interpolate(self, bounds=None, spacing=0.01, radius=50.0, power=2):
+        """Interpolate the values onto a regular grid by inverse distance
+        weighting, and return the result as a :class:`ShakeMap`. Grid points
+        with no site within the search radius are NaN.
+
+        :param bounds: The (south, north, west, east) extent of the grid in
+                       decimal degrees. If None, the bounding box of the sites
+                       plus a margin is used.
+        :type bounds: tuple of floats
+        :param spacing: The spacing of the grid in decimal degrees.
+        :type spacing: float
+        :param radius: The search radius in kilometres.
+        :type radius: float
+        :param power: The power of the distance in the weights.
+        :type power: float
+
+        """
+        if bounds is None:
+            bounds = self.bounds()
+        south, north, west, east = bounds
+        lat = south + numpy.arange(int(round((north - south) / spacing)) + 1) * spacing
+        lng = west + numpy.arange(int(round((east - west) / spacing)) + 1) * spacing
+
+        numerator = numpy.zeros((len(lat), len(lng)))
+        denominator = numpy.zeros((len(lat), len(lng)))
+
+        for site_lat, site_lng, value in zip(self.latitudes, self.longitudes,
+                                             self.values):
+            # The block of grid points within the search radius, using an
+            # equirectangular projection around the site.
+            scale = numpy.cos(numpy.radians(site_lat))
+            dlat = radius / _KM_PER_DEGREE
+            dlng = dlat / max(scale, 1e-6)
+            rows = slice(numpy.searchsorted(lat, site_lat - dlat),
+                         numpy.searchsorted(lat, site_lat + dlat, 'right'))
+            cols = slice(numpy.searchsorted(lng, site_lng - dlng),
+                         numpy.searchsorted(lng, site_lng + dlng, 'right'))
+            y = (lat[rows] - site_lat) * _KM_PER_DEGREE
+            x = (lng[cols] - site_lng) * _KM_PER_DEGREE * scale
+
+            # Squared distances and the corresponding weights. A small offset
+            # keeps the weight finite at the site itself.
+            d2 = y[:, numpy.newaxis]**2 + x[numpy.newaxis, :]**2
+            weight = (d2 + 1e-12)**(-power / 2.0)
+            weight[d2 > radius**2] = 0
+
+            numerator[rows, cols] += weight * value
+            denominator[rows, cols] += weight
+
+        values = numpy.empty((len(lat), len(lng)), dtype=numpy.float32)
+        values.fill(numpy.nan)
+        covered = denominator > 0
+        values[covered] = numerator[covered] / denominator[covered]
+        return ShakeMap(lat, lng, values)
+
+
+class ShakeMap(object):
+    """An interpolated intensity map on a regular latitude/longitude grid. The
+    instance has the following attributes:
+
+        * ``latitudes`` - the latitude of each row of the grid.
+        * ``longitudes`` - the longitude of each column of the grid.
+        * ``values`` - a float32 numpy array of the interpolated values,
+                       indexed by row and then column, with NaN where there
+                       is no data.
+
+    """
+
+    def __init__(self, latitudes, longitudes, values):
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.values = values
+
+    def save(self, basename):
+        """Save the map in a compact form that can be served directly to a
+        browser. Two files are written: ``<basename>.json`` describing the
+        grid, and ``<basename>.f32`` containing the values as little-endian
+        float32 numbers, row by row from the southernmost row.
+
+        :param basename: The filename to save to, without an extension.
+        :type basename: string
+
+        """
+        header = {
+            'rows': len(self.latitudes),
+            'columns': len(self.longitudes),
+            'south': float(self.latitudes[0]),
+            'north': float(self.latitudes[-1]),
+            'west': float(self.longitudes[0]),
+            'east': float(self.longitudes[-1]),
+            'minimum': None,
+            'maximum': None,
+        }
+        finite = self.values[numpy.isfinite(self.values)]
+        if len(finite):
+            header['minimum'] = float(finite.min())
+            header['maximum'] = float(finite.max())
+
+        # Write each file to a temporary file first, so a reader never sees a
+        # partial map. Several requests may save the same map at once, so each
+        # uses its own temporary file.
+        directory = os.path.dirname(os.path.abspath(basename))
+        f, temporary = _temporary(directory)
+        json.dump(header, f)
+        f.close()
+        os.rename(temporary, basename + '.json')
+        f, temporary = _temporary(directory)
+        f.write(self.values.astype('<f4').tostring())
+        f.close()
+        os.rename(temporary, basename + '.f32')
+
+
+def _temporary(directory):
+    """Helper function to create a uniquely named temporary file in a
+    directory, readable by everyone once renamed into place. The open file and
+    its filename are returned.
+
+    """
+    handle, filename = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    os.chmod(filename, 0644)
+    return os.fdopen(handle, 'wb'), filename
+
+
+def shakemap_basename(server, event, measure='pga'):
+    """Get the filename (without an extension) that the map of an event is
+    saved to by :func:`event_shakemap`. Maps are kept in the shakemaps/
+    directory of the server's cache, in a subdirectory named after the events
+    generation (see :meth:`sm.Server.get_generation`). Event IDs are reassigned
+    when the events are updated, so a map saved under an older generation may
+    be of a different event.
+
+    :param server: The server the event is from.
+    :type server: :class:`sm.Server`
+    :param event: The event ID.
+    :type event: integer
+    :param measure: The name of the intensity measure.
+    :type measure: string
+
+    """
+    return os.path.join(server.cache_dir, 'shakemaps',
+                        str(server.get_generation('events')),
+                        '{0}-{1}'.format(event, measure))
+
+
+def _remove_stale(directory):
+    """Helper function to remove the maps saved under older generations than
+    the one in the given directory.
+
+    """
+    parent, generation = os.path.split(directory)
+    for name in os.listdir(parent):
+        if name.isdigit() and int(name) < int(generation):
+            shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+
+
+def event_shakemap(server, event, measure='pga', **kwargs):
+    """Create the map of an intensity measure for an event, save it to the
+    server's cache (see :func:`shakemap_basename`) and return it.
+
+    :param server: The server to get the records from.
+    :type server: :class:`sm.Server`
+    :param event: The event ID.
+    :type event: integer
+    :param measure: The name of the measure to use, as one of the fields of
+                    :data:`sm.intensity.MEASURES`.
+    :type measure: string
+
+    Any other keyword arguments are passed on to
+    :meth:`SitePoints.interpolate`. Maps saved under older generations are
+    removed.
+
+    """
+    basename = shakemap_basename(server, event, measure)
+    shakemap = SitePoints.from_event(server, event, measure).interpolate(**kwargs)
+    directory = os.path.dirname(basename)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another thread or process may have just created it.
+            if not os.path.isdir(directory):
+                raise
+        _remove_stale(directory)
+    shakemap.save(basename)
+    return shakemap
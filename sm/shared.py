@@ -0,0 +1,210 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Pass records between processes through shared memory.
+
+Sending a :class:`Record` to another process normally pickles all of its data.
+Instead, :func:`share` copies the record once into a shared memory segment and
+returns a :class:`RecordHandle`, which is tiny and cheap to send. Each process
+that receives the handle opens it to get a :class:`SharedRecord`, whose
+acceleration is a read-only view of the shared memory rather than a copy.
+
+Segments are files in a memory backed filesystem (``/dev/shm`` where it exists,
+otherwise the temporary directory). Each segment starts with a reference count.
+The creator sets it to the number of consumers, each consumer releases its
+reference when it has finished, and the last one to do so removes the segment.
+A typical use with a process pool is:
+
+    >>> handle = sm.shared.share(record, references=len(tasks))
+    >>> pool.map(analyse, [(handle, task) for task in tasks])
+
+where ``analyse`` does:
+
+    >>> with handle.open() as record:
+    ...     return do_something(record.acceleration, task)
+
+"""
+
+import cPickle
+import fcntl
+import mmap
+import os
+import os.path
+import struct
+import tempfile
+
+import numpy
+
+# The header at the start of each segment: the reference count, and the length
+# of the pickled metadata which follows it.
+_HEADER = struct.Struct('=qq')
+
+# The data type of the shared acceleration.
+_DTYPE = numpy.dtype(float)
+
+# The attributes of a record which are stored as metadata.
+_METADATA = ('alignment', 'site', 'event', 'magnitudes', 'start', 'timestep',
+             'duration', 'data_length', 'digitised_samples')
+
+
+def _segment_directory():
+    """Helper function to choose where to create segments.
+
+    """
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def share(record, references=1):
+    """Copy a record into a new shared memory segment, and return a handle to
+    it.
+
+    :param record: The record to share. This can be a :class:`Record` or a
+                   :class:`SharedRecord`.
+    :param references: The number of times the segment will be released before
+                       it is removed. This is normally the number of consumers
+                       the handle will be sent to.
+    :type references: integer
+
+    """
+    metadata = cPickle.dumps(dict((name, getattr(record, name)) for name in
+                                  _METADATA), cPickle.HIGHEST_PROTOCOL)
+    acceleration = numpy.ascontiguousarray(record.acceleration, dtype=_DTYPE)
+
+    # Pad the metadata so the acceleration is aligned.
+    offset = _HEADER.size + len(metadata)
+    padding = -offset % _DTYPE.itemsize
+
+    fd, path = tempfile.mkstemp(prefix='sm-record-', dir=_segment_directory())
+    try:
+        f = os.fdopen(fd, 'wb')
+        f.write(_HEADER.pack(references, len(metadata)))
+        f.write(metadata)
+        f.write('\0' * padding)
+        f.write(acceleration.tostring())
+        f.close()
+    except:
+        os.remove(path)
+        raise
+    return RecordHandle(path)
+
+
+class RecordHandle(object):
+    """A handle to a record in a shared memory segment. This only holds the
+    location of the segment, so it can be pickled and sent to other processes
+    cheaply.
+
+    """
+    __slots__ = ('path',)
+
+    def __init__(self, path):
+        self.path = path
+
+    def __reduce__(self):
+        return (RecordHandle, (self.path,))
+
+    def __repr__(self):
+        return 'RecordHandle({0!r})'.format(self.path)
+
+    def _adjust(self, change):
+        """Change the reference count of the segment, removing the segment if
+        the count reaches zero. The new count is returned.
+
+        """
+        fd = os.open(self.path, os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            count, length = _HEADER.unpack(os.read(fd, _HEADER.size))
+            count += change
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, _HEADER.pack(count, length))
+            if count <= 0:
+                os.remove(self.path)
+        finally:
+            os.close(fd)
+        return count
+
+    def retain(self, references=1):
+        """Add references to the segment, for example before sending the handle
+        to more consumers than it was created for.
+
+        :param references: The number of references to add.
+        :type references: integer
+
+        """
+        self._adjust(references)
+
+    def release(self):
+        """Release one reference to the segment without opening it. If this was
+        the last reference, the segment is removed.
+
+        """
+        self._adjust(-1)
+
+    def open(self):
+        """Map the segment into this process and return it as a
+        :class:`SharedRecord`. The record should be released when it is no
+        longer needed, either explicitly or by using it as a context manager.
+
+        """
+        f = open(self.path, 'rb')
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        count, length = _HEADER.unpack(buf[:_HEADER.size])
+        metadata = cPickle.loads(buf[_HEADER.size:_HEADER.size + length])
+        offset = _HEADER.size + length
+        offset += -offset % _DTYPE.itemsize
+
+        record = SharedRecord()
+        for name in _METADATA:
+            setattr(record, name, metadata[name])
+        acceleration = numpy.frombuffer(buf, _DTYPE, 3 * record.data_length,
+                                        offset)
+        record.acceleration = acceleration.reshape(3, record.data_length)
+        record.handle = self
+        return record
+
+
+class SharedRecord(object):
+    """A compact, read-only record whose acceleration lives in a shared memory
+    segment. It has the same attributes as a :class:`Record`, except that the
+    ``time`` array is calculated when it is accessed rather than stored.
+    Instances are created with :meth:`RecordHandle.open`.
+
+    """
+    __slots__ = _METADATA + ('acceleration', 'handle')
+
+    @property
+    def time(self):
+        return numpy.arange(self.data_length) * self.timestep
+
+    def release(self):
+        """Release this process's reference to the shared memory segment. The
+        record must not be used afterwards.
+
+        """
+        if self.handle is not None:
+            self.handle.release()
+            self.handle = None
+            self.acceleration = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
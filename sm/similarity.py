@@ -0,0 +1,505 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Search for records with similar waveforms, such as repeating earthquakes.
+
+Comparing every pair of records by cross-correlating their accelerations is far
+too slow for the whole archive, so the work is split into two stages using
+features computed once for each record and stored in an index:
+
+    * A normalised waveform: the three axes resampled to a common rate, cut or
+      padded to a common length, and scaled so the total energy is one. The
+      cross-correlation of two of these, summed over the axes, is a
+      correlation coefficient between -1 and 1 at each lag.
+    * A normalised spectrum: the logarithm of the horizontal energy in a set
+      of logarithmically spaced frequency bands, with the mean removed and
+      scaled to unit length.
+
+A search first narrows the records down using their metadata (site, distance
+and magnitude) and then ranks those by the cosine similarity of their spectra,
+which is a single matrix product. Only the best of those candidates are cross
+correlated with the query, in batches using the FFT.
+
+The index is a directory containing three files:
+
+    * ``waveforms.f32`` - the normalised waveform of each record, as
+                          little-endian float32 values. Every waveform has the
+                          same size, so the waveform of the record in row ``i``
+                          of the index starts at ``i`` times that size.
+    * ``spectra.f32`` - the normalised spectrum of each record, likewise.
+    * ``index.sqlite`` - an SQLite database giving the row, filename,
+                         metadata and feature settings of each record.
+
+Records are indexed by event ID and site code, but :meth:`Server.update_events`
+renumbers the events. As with :class:`sm.archive.Archive`, each entry also
+stores the filename of the record on the FTP server. :meth:`SimilarityIndex.update`
+replaces the features of any entry whose filename has changed and drops entries
+for records the server no longer has, and :meth:`SimilarityIndex.similar` can
+check its query and results against a server.
+
+"""
+
+import math
+import os
+import os.path
+import sqlite3
+
+import numpy
+
+from sm.batch import all_records
+from sm.processing import next_fast_length
+
+# The data type of the stored features.
+_DTYPE = numpy.dtype('<f4')
+
+# The fraction of the retained frequency range which is tapered off when
+# resampling the waveforms, to limit ringing.
+_TAPER = 0.2
+
+
+def _magnitude(magnitudes):
+    """Helper function to choose a single magnitude for a record: the largest
+    of the magnitudes given in its header, most of which are usually zero.
+
+    """
+    values = [value for value in magnitudes.values() if value]
+    return max(values) if values else None
+
+
+def record_features(record, rate=20.0, length=2048, bands=32,
+                    band_range=(0.1, 10.0)):
+    """Calculate the normalised waveform and spectrum of a record. See the
+    module documentation for their definitions. A two element tuple of numpy
+    arrays is returned: the waveform, indexed by axis and then sample, and the
+    spectrum.
+
+    :param record: The record to calculate the features of.
+    :type record: :class:`Record`
+    :param rate: The sample rate of the waveform in Hz.
+    :type rate: float
+    :param length: The number of samples in the waveform.
+    :type length: integer
+    :param bands: The number of frequency bands in the spectrum.
+    :type bands: integer
+    :param band_range: The lowest and highest frequencies of the bands in Hz.
+    :type band_range: tuple of floats
+
+    """
+    acceleration = numpy.asarray(record.acceleration, dtype=float)
+    acceleration = acceleration - acceleration.mean(axis=-1)[:, numpy.newaxis]
+    samples = acceleration.shape[-1]
+    nfft = next_fast_length(samples)
+    spectrum = numpy.fft.rfft(acceleration, nfft)
+    frequencies = numpy.fft.rfftfreq(nfft, record.timestep)
+
+    # Energy of the horizontal axes in each band, using a cumulative sum so
+    # that empty bands come out as zero.
+    power = (abs(spectrum[:2])**2).sum(axis=0)
+    cumulative = numpy.concatenate(([0.0], numpy.cumsum(power)))
+    edges = numpy.searchsorted(frequencies, numpy.logspace(
+        math.log10(band_range[0]), math.log10(band_range[1]), bands + 1))
+    energy = cumulative[edges[1:]] - cumulative[edges[:-1]]
+    levels = numpy.log10(energy + 1e-12 * max(energy.max(), 1e-300))
+    levels -= levels.mean()
+    norm = numpy.sqrt((levels**2).sum())
+    if norm > 0:
+        levels /= norm
+
+    # Resample by keeping the part of the spectrum below the new Nyquist
+    # frequency, tapering off the top of it.
+    resampled = int(round(nfft * record.timestep * rate))
+    bins = resampled // 2 + 1
+    kept = numpy.zeros((3, bins), dtype=complex)
+    used = min(bins, spectrum.shape[-1])
+    kept[:, :used] = spectrum[:, :used]
+    start = int(bins * (1 - _TAPER))
+    kept[:, start:] *= 0.5 * (1 + numpy.cos(numpy.pi *
+                                            numpy.arange(bins - start) /
+                                            (bins - start)))
+    waveform = numpy.fft.irfft(kept, resampled) * (float(resampled) / nfft)
+
+    # Cut or pad to the common length, dropping the padding added for the FFT,
+    # and normalise.
+    valid = min(int(math.ceil(samples * record.timestep * rate)), length,
+                resampled)
+    features = numpy.zeros((3, length))
+    features[:, :valid] = waveform[:, :valid]
+    norm = numpy.sqrt((features**2).sum())
+    if norm > 0:
+        features /= norm
+    return features, levels
+
+
+def cross_correlate(query, candidates):
+    """Cross-correlate a normalised waveform with a batch of others using the
+    FFT, summing over the axes. A two element tuple is returned: the largest
+    correlation coefficient with each candidate, and the lag (in samples) at
+    which it occurs. A positive lag means the candidate is delayed relative to
+    the query.
+
+    :param query: The waveform to compare against, indexed by axis and then
+                  sample.
+    :type query: numpy array
+    :param candidates: The waveforms to compare, indexed by candidate, axis
+                       and then sample.
+    :type candidates: numpy array
+
+    """
+    length = query.shape[-1]
+    nfft = next_fast_length(2 * length - 1)
+    product = numpy.fft.rfft(candidates, nfft) * numpy.conj(numpy.fft.rfft(query, nfft))
+    correlation = numpy.fft.irfft(product.sum(axis=1), nfft)
+
+    # Lags from -(length - 1) to length - 1; negative lags wrap around to the
+    # end of the result.
+    correlation = numpy.concatenate((correlation[:, nfft - length + 1:],
+                                     correlation[:, :length]), axis=1)
+    best = correlation.argmax(axis=1)
+    return correlation[numpy.arange(len(best)), best], best - (length - 1)
+
+
+def _current_filename(server, event, site):
+    """Helper function to get the filename of a record from a server, or None
+    if the server does not have the record.
+
+    """
+    try:
+        return server.get_record_filename(event, site)
+    except ValueError:
+        return None
+
+
+class SimilarityIndex(object):
+    """An index of the features of many records, which can be searched for the
+    records most similar to any of them. See the module documentation for
+    details.
+
+    """
+
+    def __init__(self, path, rate=20.0, length=2048, bands=32,
+                 band_range=(0.1, 10.0)):
+        """
+
+        :param path: The directory containing the index. It will be created if
+                     it does not exist.
+        :type path: string
+
+        The remaining parameters are passed to :func:`record_features`. They
+        are only used when creating a new index; existing indexes keep the
+        settings they were created with.
+
+        """
+        self.path = os.path.normpath(os.path.abspath(path))
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.waveforms_filename = os.path.join(self.path, 'waveforms.f32')
+        self.spectra_filename = os.path.join(self.path, 'spectra.f32')
+
+        # Connect to the index, creating the tables if needed.
+        self.index = sqlite3.connect(os.path.join(self.path, 'index.sqlite'))
+        self.index.row_factory = sqlite3.Row
+        self.index.execute('''create table if not exists properties (
+            name varchar primary key not null,
+            value float not null);''')
+        self.index.execute('''create table if not exists records (
+            row integer primary key,
+            event_id integer not null,
+            site varchar not null,
+            filename varchar not null,
+            distance float,
+            magnitude float,
+            unique (event_id, site));''')
+        self.index.execute('''create index if not exists records_site on
+                           records (site);''')
+        self.index.execute('''create index if not exists records_magnitude on
+                           records (magnitude);''')
+        settings = [('rate', rate), ('length', length), ('bands', bands),
+                    ('low', band_range[0]), ('high', band_range[1])]
+        self.index.executemany('''insert or ignore into properties (name, value)
+                               values (?, ?);''', settings)
+
+        # Indexes created before filenames were stored get an empty filename
+        # for each record, so they are added again.
+        columns = [row['name'] for row in
+                   self.index.execute('pragma table_info(records);')]
+        if 'filename' not in columns:
+            self.index.execute('''alter table records add column filename
+                               varchar not null default '';''')
+        self.index.commit()
+
+        # Use the settings the index was created with.
+        properties = dict((row['name'], row['value']) for row in
+                          self.index.execute('select * from properties;'))
+        self.rate = properties['rate']
+        self.length = int(properties['length'])
+        self.bands = int(properties['bands'])
+        self.band_range = (properties['low'], properties['high'])
+
+    def __del__(self):
+        self.index.close()
+
+    def __len__(self):
+        return self.index.execute('select count(*) from records;').fetchone()[0]
+
+    def __contains__(self, key):
+        event, site = key
+        row = self.index.execute('''select 1 from records where event_id=? and
+                                 site=?;''', (event, site)).fetchone()
+        return row is not None
+
+    def keys(self):
+        """Get a list of the (event ID, site code) pairs in the index.
+
+        """
+        cursor = self.index.execute('select event_id, site from records;')
+        return [(row['event_id'], row['site']) for row in cursor]
+
+    def _filename(self, event, site):
+        """Helper function to get the filename stored for a record, or None if
+        the index does not contain it.
+
+        """
+        row = self.index.execute('''select filename from records where
+                                 event_id=? and site=?;''', (event, site)).fetchone()
+        return row['filename'] if row is not None else None
+
+    def _rows(self):
+        """Helper function to get the number of rows in the features files,
+        including any left unused by dropped entries.
+
+        """
+        row = self.index.execute('select max(row) from records;').fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def discard(self, event, site):
+        """Remove a record from the index, if it is there. Its row in the
+        features files is left unused.
+
+        :param event: The event ID of the record.
+        :type event: integer
+        :param site: The GeoNet code for the site of the record.
+        :type site: string
+
+        """
+        self.index.execute('delete from records where event_id=? and site=?;',
+                           (event, site))
+        self.index.commit()
+
+    def add(self, event, site, record, filename):
+        """Calculate the features of a record and add them to the index. If the
+        index already has this record for this event and site, nothing is done.
+        If it has a different record (as the events have been renumbered
+        since), the features of that entry are replaced.
+
+        :param event: The event ID of the record.
+        :type event: integer
+        :param site: The GeoNet code for the site of the record.
+        :type site: string
+        :param record: The record to add.
+        :type record: :class:`Record`
+        :param filename: The filename of the record on the FTP server, as given
+                         by :meth:`Server.get_record_filename`.
+        :type filename: string
+
+        """
+        if self._filename(event, site) == filename:
+            return
+        waveform, spectrum = record_features(record, self.rate, self.length,
+                                             self.bands, self.band_range)
+
+        # Every row has the same size, so a replaced entry keeps its row and a
+        # new one goes after the last row. If we were interrupted after writing
+        # the features but before indexing them, they are simply overwritten.
+        existing = self.index.execute('''select row from records where
+                                      event_id=? and site=?;''',
+                                      (event, site)).fetchone()
+        row = existing['row'] if existing is not None else self._rows()
+        for features, values in ((self.waveforms_filename, waveform),
+                                 (self.spectra_filename, spectrum)):
+            values = numpy.ascontiguousarray(values, dtype=_DTYPE)
+            f = open(features, 'r+b' if os.path.exists(features) else 'wb')
+            try:
+                f.seek(row * values.nbytes)
+                f.write(values.tostring())
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+
+        self.index.execute('''insert or replace into records (row, event_id,
+                           site, filename, distance, magnitude) values (?, ?,
+                           ?, ?, ?, ?);''', (row, event, site, filename,
+                           record.event.get('distance'),
+                           _magnitude(record.magnitudes)))
+        self.index.commit()
+
+    def update(self, server, pairs=None, download=False):
+        """Add the records of a server which are not yet in the index, and
+        replace those whose event has been renumbered. By default only records
+        whose data files are already in the cache are added, so this is cheap to
+        run after every update. Records which cannot be parsed are skipped. An
+        entry whose record cannot be added in its place is dropped, as are (if
+        no pairs are given) entries for records the server no longer has. The
+        number of records added is returned.
+
+        :param server: The server to get the records from.
+        :type server: :class:`sm.Server`
+        :param pairs: The (event ID, site code) pairs to consider. If None,
+                      every record known to the server is considered.
+        :param download: Whether to download records which are not cached.
+        :type download: Boolean
+
+        """
+        if pairs is None:
+            pairs = all_records(server)
+            current = set(pairs)
+            for key in self.keys():
+                if key not in current:
+                    self.discard(*key)
+
+        added = 0
+        for event, site in pairs:
+            stored = self._filename(event, site)
+            filename = _current_filename(server, event, site)
+            if stored == filename:
+                continue
+
+            # Load the record, if it is available.
+            record = None
+            if filename is not None and (download or os.path.isfile(
+                    os.path.join(server.cache_dir, filename))):
+                try:
+                    record = server.get_record(event, site)
+                except (ValueError, EOFError):
+                    pass
+            if record is None:
+                if stored is not None:
+                    self.discard(event, site)
+                continue
+            self.add(event, site, record, filename)
+            added += 1
+        return added
+
+    def _features(self, filename, size):
+        """Helper function to memory map a features file as an array with one
+        row per record.
+
+        """
+        count = self._rows()
+        if count == 0:
+            return numpy.zeros((0, size), dtype=_DTYPE)
+        return numpy.memmap(filename, dtype=_DTYPE, mode='r',
+                            shape=(count, size))
+
+    def similar(self, event, site, k=10, candidates=None, sites=None,
+                distance=None, magnitude=None, block=256, server=None):
+        """Find the records in the index most similar to one of them. A list of
+        up to k (event ID, site code, coefficient, lag) tuples is returned,
+        most similar first. The coefficient is the largest correlation
+        coefficient of the waveforms, and the lag is the delay in seconds of
+        the match relative to the query at which it occurs.
+
+        :param event: The event ID of the query record.
+        :type event: integer
+        :param site: The GeoNet code for the site of the query record.
+        :type site: string
+        :param k: The number of records to return.
+        :type k: integer
+        :param candidates: The number of records with the most similar spectra
+                           to cross-correlate. If None, ten times k (but at
+                           least 100) are used.
+        :type candidates: integer
+        :param sites: Only consider records from these sites.
+        :type sites: list of strings
+        :param distance: Only consider records whose epicentral distance in
+                         metres is within this (minimum, maximum) range.
+        :type distance: tuple of floats
+        :param magnitude: Only consider records whose magnitude is within this
+                          (minimum, maximum) range.
+        :type magnitude: tuple of floats
+        :param block: The number of candidates to cross-correlate at once.
+        :type block: integer
+        :param server: If given, the server whose current records the query
+                       and results must match. Entries which are for a
+                       different record than the server now has under their
+                       event ID and site are left out.
+        :type server: :class:`sm.Server`
+        :raise KeyError: If the query record is not in the index, or does not
+                         match the server's record.
+
+        """
+        row = self.index.execute('''select row, filename from records where
+                                 event_id=? and site=?;''', (event, site)).fetchone()
+        if row is None or (server is not None and
+                           row['filename'] != _current_filename(server, event, site)):
+            raise KeyError((event, site))
+        query = row['row']
+        if candidates is None:
+            candidates = max(10 * k, 100)
+
+        # Narrow the records down by their metadata.
+        sql = 'select row, event_id, site, filename from records where row != ?'
+        parameters = [query]
+        if sites is not None:
+            sites = list(sites)
+            sql += ' and site in ({0})'.format(','.join('?' * len(sites)))
+            parameters.extend(sites)
+        if distance is not None:
+            sql += ' and distance between ? and ?'
+            parameters.extend(distance)
+        if magnitude is not None:
+            sql += ' and magnitude between ? and ?'
+            parameters.extend(magnitude)
+        rows = self.index.execute(sql + ';', parameters).fetchall()
+        if not rows:
+            return []
+        numbers = numpy.array([r['row'] for r in rows])
+        keys = [(r['event_id'], r['site']) for r in rows]
+        filenames = [r['filename'] for r in rows]
+
+        # Rank them by the similarity of their spectra.
+        spectra = self._features(self.spectra_filename, self.bands)
+        scores = numpy.dot(spectra[numbers], spectra[query])
+        if len(numbers) > candidates:
+            chosen = numpy.argpartition(-scores, candidates - 1)[:candidates]
+        else:
+            chosen = numpy.arange(len(numbers))
+
+        # Cross-correlate the best of them with the query, in blocks. Reading
+        # the rows in order keeps the access to the memory map sequential.
+        chosen = chosen[numpy.argsort(numbers[chosen])]
+        waveforms = self._features(self.waveforms_filename, 3 * self.length)
+        reference = waveforms[query].reshape(3, self.length).astype(float)
+        coefficients = numpy.empty(len(chosen))
+        lags = numpy.empty(len(chosen), dtype=int)
+        for start in range(0, len(chosen), block):
+            part = numbers[chosen[start:start + block]]
+            batch = waveforms[part].reshape(len(part), 3, self.length)
+            c, l = cross_correlate(reference, batch.astype(float))
+            coefficients[start:start + block] = c
+            lags[start:start + block] = l
+
+        # Take the best, leaving out any which no longer match the server.
+        result = []
+        for i in numpy.argsort(-coefficients):
+            if len(result) == k:
+                break
+            event, site = keys[chosen[i]]
+            if (server is not None and filenames[chosen[i]] !=
+                    _current_filename(server, event, site)):
+                continue
+            result.append((event, site, float(coefficients[i]),
+                           lags[i] / self.rate))
+        return result
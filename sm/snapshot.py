@@ -0,0 +1,379 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Portable snapshots of a cache.
+
+Filling a new cache means downloading the list of sites, crawling the whole
+FTP server for events and then downloading every data file needed, which takes
+hours. A snapshot holds a copy of the info cache and any chosen data files
+from an existing cache, so a new cache can be started from it and then brought
+up to date with an update of the latest months only:
+
+    >>> server.export_snapshot('snapshot.tar.gz')
+    >>> # ...and on another machine...
+    >>> manifest = other.import_snapshot('snapshot.tar.gz')
+    >>> other.update_events(since=manifest_date(manifest))
+
+A snapshot is a tar file (optionally gzipped) holding a copy of
+``info_cache.sqlite``, the data files and a ``manifest.json`` file. The
+manifest gives the size and SHA-256 checksum of every other file, along with
+the generation of the events in the info cache and the date of the newest
+event. The info cache is copied within a single read transaction so it is
+consistent even if another process is updating the cache at the same time.
+
+Importing a snapshot replaces the info cache and adds the data files to any
+already in the cache. Everything is first extracted into a staging directory
+inside the cache and checked against the manifest; nothing in the cache is
+touched if any check fails. The data files are then moved into place, and the
+info cache replaced last of all with a single rename. Data files are never
+changed once written and are named after the record they hold, so an import
+interrupted part way through leaves the old info cache with some extra data
+files, which is still a valid cache. No other process should be using the
+cache while a snapshot is imported.
+
+The event IDs in the imported info cache need not match the old ones, so
+anything derived from the cache and keyed by event ID is stale afterwards. The
+maps in the shakemaps/ directory of the cache are removed by the import (the
+pyramids are named after the data files, so they stay valid). An
+:class:`sm.archive.Archive` or :class:`sm.similarity.SimilarityIndex` is kept
+outside the cache and is not touched: export to the archive and update the
+similarity index again to replace their stale entries.
+
+"""
+
+from datetime import datetime
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import sqlite3
+import tarfile
+import tempfile
+
+#: The version of the snapshot format written.
+FORMAT = 1
+
+# The names of the files within a snapshot.
+_MANIFEST = 'manifest.json'
+_INFO_CACHE = 'info_cache.sqlite'
+
+
+class BadSnapshot(ValueError):
+    """Exception raised by :func:`import_snapshot` when a snapshot is not
+    complete or does not match its manifest.
+
+    """
+    pass
+
+
+class _StringReader(object):
+    """Helper class to give tarfile a string to read.
+
+    """
+    def __init__(self, text):
+        self.text = text
+        self.position = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.text) - self.position
+        block = self.text[self.position:self.position + size]
+        self.position += len(block)
+        return block
+
+
+class _HashingReader(object):
+    """Helper class to find the checksum of a file as tarfile reads it.
+
+    """
+    def __init__(self, f):
+        self.f = f
+        self.checksum = hashlib.sha256()
+
+    def read(self, size=-1):
+        block = self.f.read(size)
+        self.checksum.update(block)
+        return block
+
+
+def _copy_info_cache(source, destination):
+    """Helper function to copy an info cache into a new database, within a
+    single read transaction.
+
+    """
+    connection = sqlite3.connect(destination, isolation_level=None)
+    try:
+        connection.execute('attach database ? as source;', (source,))
+        connection.execute('begin;')
+        schema = connection.execute('''select type, name, sql from
+                                    source.sqlite_master where sql is not null
+                                    order by type='table' desc;''').fetchall()
+        for kind, name, sql in schema:
+            if name.startswith('sqlite_'):
+                continue
+            connection.execute(sql)
+            if kind == 'table':
+                connection.execute('insert into main."{0}" select * from '
+                                   'source."{0}";'.format(name))
+
+        # Keep the autoincrement counters so IDs are not reused. Copying the
+        # rows has already set them to the largest IDs in use, which may be
+        # lower.
+        if any(name == 'sqlite_sequence' for kind, name, sql in schema):
+            connection.execute('delete from main.sqlite_sequence;')
+            connection.execute('''insert into main.sqlite_sequence select *
+                               from source.sqlite_sequence;''')
+        connection.execute('commit;')
+        connection.execute('detach database source;')
+    finally:
+        connection.close()
+
+
+def _add_file(archive, filename, name):
+    """Helper function to add a file to a snapshot, returning its manifest
+    entry.
+
+    """
+    info = archive.gettarinfo(filename, name)
+    info.uid = info.gid = 0
+    info.uname = info.gname = ''
+    f = _HashingReader(open(filename, 'rb'))
+    try:
+        archive.addfile(info, f)
+    finally:
+        f.f.close()
+    return {'size': info.size, 'sha256': f.checksum.hexdigest()}
+
+
+def export_snapshot(server, filename, records=None, compress=True):
+    """Write a snapshot of a cache. The manifest of the snapshot is returned.
+
+    :param server: The server whose cache is to be exported.
+    :type server: :class:`sm.Server`
+    :param filename: The filename of the snapshot. It is written to a temporary
+                     file which is renamed once complete.
+    :type filename: string
+    :param records: The (event ID, site code) pairs of the records whose data
+                    files are to be included. Records which are not in the
+                    cache are skipped. If None, every cached data file is
+                    included.
+    :param compress: Whether to gzip the snapshot.
+    :type compress: Boolean
+
+    """
+    # Don't leave any of our own changes out.
+    if server._info_cache is not None and not server.read_only:
+        server.info_cache.commit()
+
+    # Find the data files.
+    if records is None:
+        try:
+            names = [row['filename'] for row in server.info_cache.execute(
+                'select distinct filename from records;')]
+        except sqlite3.OperationalError:
+            names = []
+    else:
+        names = [server.get_record_filename(event, site) for event, site in
+                 records]
+    names = sorted(name for name in set(names) if os.path.isfile(
+        os.path.join(server.cache_dir, name)))
+
+    temporary = filename + '.part'
+    staging = tempfile.mkdtemp(prefix='.snapshot-', dir=server.cache_dir)
+    try:
+        # Copy the info cache.
+        copy = os.path.join(staging, _INFO_CACHE)
+        _copy_info_cache(os.path.join(server.cache_dir, _INFO_CACHE), copy)
+        manifest = {
+            'format': FORMAT,
+            'created': datetime.utcnow().isoformat(),
+            'files': {},
+        }
+        connection = sqlite3.connect(copy)
+        try:
+            row = connection.execute('''select value from generations where
+                                     name='events';''').fetchone()
+            manifest['generation'] = row[0] if row is not None else 0
+        except sqlite3.OperationalError:
+            manifest['generation'] = 0
+        try:
+            row = connection.execute('''select year, month, day from events
+                                     order by year desc, month desc, day desc
+                                     limit 1;''').fetchone()
+        except sqlite3.OperationalError:
+            row = None
+        manifest['newest_event'] = ('{0:04d}-{1:02d}-{2:02d}'.format(*row) if
+                                    row is not None else None)
+        connection.close()
+
+        # Write the snapshot, with the manifest last as it needs the checksums.
+        archive = tarfile.open(temporary, 'w:gz' if compress else 'w')
+        try:
+            manifest['files'][_INFO_CACHE] = _add_file(archive, copy,
+                                                       _INFO_CACHE)
+            for name in names:
+                manifest['files'][name] = _add_file(
+                    archive, os.path.join(server.cache_dir, name), name)
+            text = json.dumps(manifest, indent=1, sort_keys=True)
+            info = tarfile.TarInfo(_MANIFEST)
+            info.size = len(text)
+            info.mtime = os.path.getmtime(copy)
+            archive.addfile(info, _StringReader(text))
+        finally:
+            archive.close()
+        os.rename(temporary, filename)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+        if os.path.exists(temporary):
+            os.remove(temporary)
+    return manifest
+
+
+def _extract(archive, member, destination):
+    """Helper function to extract a file from a snapshot, returning its manifest
+    entry.
+
+    """
+    checksum = hashlib.sha256()
+    source = archive.extractfile(member)
+    f = open(destination, 'wb')
+    try:
+        while True:
+            block = source.read(1 << 20)
+            if not block:
+                break
+            checksum.update(block)
+            f.write(block)
+    finally:
+        f.close()
+        source.close()
+    return {'size': os.path.getsize(destination),
+            'sha256': checksum.hexdigest()}
+
+
+def import_snapshot(server, filename):
+    """Import a snapshot into a cache, replacing its info cache and adding to
+    its data files. The cached shakemaps are removed, as they are keyed by
+    event ID. The manifest of the snapshot is returned.
+
+    :param server: The server whose cache the snapshot is imported into. It
+                   must not be read only.
+    :type server: :class:`sm.Server`
+    :param filename: The filename of the snapshot.
+    :type filename: string
+    :raise BadSnapshot: If the snapshot is incomplete, has been modified or
+                        is in an unknown format.
+
+    """
+    if server.read_only:
+        raise ValueError('Cannot import a snapshot into a read only cache.')
+
+    staging = tempfile.mkdtemp(prefix='.snapshot-', dir=server.cache_dir)
+    try:
+        # Extract everything into the staging directory, noting the checksums
+        # as we go.
+        try:
+            archive = tarfile.open(filename, 'r:*')
+        except tarfile.TarError as e:
+            raise BadSnapshot('{0}: {1}'.format(filename, e))
+        extracted = {}
+        manifest = None
+        try:
+            for member in archive:
+                name = member.name
+                if (not member.isfile() or os.path.basename(name) != name or
+                        name.startswith('.') or name in extracted):
+                    raise BadSnapshot('Unexpected entry {0}.'.format(name))
+                if name == _MANIFEST:
+                    f = archive.extractfile(member)
+                    try:
+                        manifest = json.loads(f.read())
+                    except ValueError:
+                        raise BadSnapshot('The manifest cannot be read.')
+                    finally:
+                        f.close()
+                    continue
+                extracted[name] = _extract(archive, member,
+                                           os.path.join(staging, name))
+        except (tarfile.TarError, IOError, EOFError) as e:
+            raise BadSnapshot('{0}: {1}'.format(filename, e))
+        finally:
+            archive.close()
+
+        # Check everything against the manifest.
+        if manifest is None:
+            raise BadSnapshot('The snapshot has no manifest.')
+        if manifest.get('format') != FORMAT:
+            raise BadSnapshot('Unknown snapshot format {0}.'.format(
+                manifest.get('format')))
+        files = manifest.get('files', {})
+        if _INFO_CACHE not in files:
+            raise BadSnapshot('The snapshot has no info cache.')
+        for name in set(files) | set(extracted):
+            if name not in extracted:
+                raise BadSnapshot('{0} is missing.'.format(name))
+            if files.get(name) != extracted[name]:
+                raise BadSnapshot('{0} does not match the manifest.'.format(
+                    name))
+        connection = sqlite3.connect(os.path.join(staging, _INFO_CACHE))
+        try:
+            result = connection.execute('pragma quick_check;').fetchone()[0]
+        except sqlite3.DatabaseError as e:
+            result = str(e)
+        finally:
+            connection.close()
+        if result != 'ok':
+            raise BadSnapshot('The info cache is corrupt: {0}'.format(result))
+
+        # Close our connection, and make sure the old info cache is not left
+        # with a journal which would be applied to the new one.
+        if server._info_cache is not None:
+            server._info_cache.commit()
+            server._info_cache.close()
+            server._info_cache = None
+        info_cache = os.path.join(server.cache_dir, _INFO_CACHE)
+        if os.path.exists(info_cache):
+            connection = sqlite3.connect(info_cache)
+            connection.execute('select count(*) from sqlite_master;').fetchone()
+            connection.close()
+
+        # Move the data files into place, then swap the info cache.
+        for name in extracted:
+            if name != _INFO_CACHE:
+                os.rename(os.path.join(staging, name),
+                          os.path.join(server.cache_dir, name))
+        os.rename(os.path.join(staging, _INFO_CACHE), info_cache)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    # Anything loaded or derived from the old info cache is stale.
+    server._site_table = None
+    shutil.rmtree(os.path.join(server.cache_dir, 'shakemaps'), ignore_errors=True)
+    return manifest
+
+
+def manifest_date(manifest):
+    """Get the date to update events from after importing a snapshot, as a
+    datetime suitable for :meth:`sm.Server.update_events`. This is the date of
+    the newest event in the snapshot, or None if it has no events.
+
+    :param manifest: The manifest returned by :func:`import_snapshot`.
+    :type manifest: dictionary
+
+    """
+    if manifest.get('newest_event') is None:
+        return None
+    return datetime.strptime(manifest['newest_event'], '%Y-%m-%d')
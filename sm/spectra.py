@@ -0,0 +1,303 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Elastic response spectra of strong motion records.
+
+The response of each single degree of freedom (SDOF) oscillator is found using
+the exact recurrence of Nigam and Jennings (1969), which assumes the ground
+acceleration varies linearly between samples. The recurrence is sequential in
+time but independent for every oscillator, so each time step is evaluated for
+all axes, periods and damping ratios (and, for a batch, all records) at once.
+
+"""
+
+import numpy
+
+
+def stack(histories):
+    """Stack a sequence of histories with possibly different lengths into one
+    three-dimensional array, indexed by history, axis and then sample. Shorter
+    histories are padded with zeros at the end. A two element tuple is
+    returned, the first element of which is the stacked array and the second
+    an array of the original lengths.
+
+    :param histories: The histories to stack. Each entry should be a
+                      two-dimensional array indexed by axis and then sample. All
+                      entries must have the same number of axes.
+    :type histories: sequence of numpy arrays
+
+    """
+    lengths = numpy.array([h.shape[-1] for h in histories])
+    stacked = numpy.zeros((len(histories), histories[0].shape[0], lengths.max()))
+    for i, h in enumerate(histories):
+        stacked[i, :, :lengths[i]] = h
+    return stacked, lengths
+
+
+def _coefficients(omega, damping, timestep):
+    """Calculate the coefficients of the Nigam-Jennings recurrence. The inputs
+    may be arrays of any mutually broadcastable shape, and each of the eight
+    returned coefficients will have the broadcast shape.
+
+    :param omega: The natural angular frequencies of the oscillators.
+    :param damping: The damping ratios of the oscillators. These must be less
+                    than one.
+    :param timestep: The time between samples of the input.
+
+    """
+    # Common terms.
+    root = numpy.sqrt(1.0 - damping**2)
+    omega_d = omega * root
+    e = numpy.exp(-damping * omega * timestep)
+    s = numpy.sin(omega_d * timestep)
+    c = numpy.cos(omega_d * timestep)
+    w2 = omega**2
+    w3 = omega**3
+
+    # Free vibration part.
+    a11 = e * (damping / root * s + c)
+    a12 = e * s / omega_d
+    a21 = -omega / root * e * s
+    a22 = e * (c - damping / root * s)
+
+    # Forced part, for linearly varying acceleration over the step.
+    k1 = (2 * damping**2 - 1) / (w2 * timestep)
+    k2 = 2 * damping / (w3 * timestep)
+    b11 = e * ((k1 + damping / omega) * s / omega_d + (k2 + 1 / w2) * c) - k2
+    b12 = -e * (k1 * s / omega_d + k2 * c) - 1 / w2 + k2
+    b21 = (e * ((k1 + damping / omega) * (c - damping / root * s)
+                - (k2 + 1 / w2) * (omega_d * s + damping * omega * c))
+           + 1 / (w2 * timestep))
+    b22 = (-e * (k1 * (c - damping / root * s)
+                 - k2 * (omega_d * s + damping * omega * c))
+           - 1 / (w2 * timestep))
+
+    return a11, a12, a21, a22, b11, b12, b21, b22
+
+
+def _peak_displacements(acceleration, timesteps, lengths, periods, damping,
+                        rotation=None):
+    """Integrate every oscillator through every input and return the peak
+    absolute relative displacements, indexed by record, axis, period and
+    damping ratio.
+
+    If a rotation matrix is given, the peaks are instead taken of the responses
+    of the first two axes rotated by each row of the matrix, and the second
+    index of the result is the row of the matrix. As the oscillators are
+    linear, this is the same as the response to the rotated input but only
+    needs one small matrix product per time step.
+
+    :param acceleration: The input accelerations, with shape (records, axes,
+                         samples). Records shorter than the number of samples
+                         should be zero-padded.
+    :param timesteps: The timestep of each record.
+    :param lengths: The number of valid samples in each record.
+    :param periods: The positive natural periods, as a one-dimensional array.
+    :param damping: The damping ratios, as a one-dimensional array.
+    :param rotation: Optional matrix with two columns, each row of which gives
+                     the weights of the first two axes in one rotated axis.
+
+    """
+    records, axes, samples = acceleration.shape
+
+    # Work with shape (records, axes, periods, damping) throughout.
+    omega = (2 * numpy.pi / periods)[numpy.newaxis, numpy.newaxis, :, numpy.newaxis]
+    zeta = damping[numpy.newaxis, numpy.newaxis, numpy.newaxis, :]
+    dt = timesteps[:, numpy.newaxis, numpy.newaxis, numpy.newaxis]
+    a11, a12, a21, a22, b11, b12, b21, b22 = _coefficients(omega, zeta, dt)
+
+    # The oscillators start from rest.
+    shape = (records, axes, len(periods), len(damping))
+    x = numpy.zeros(shape)
+    v = numpy.zeros(shape)
+    temp = numpy.empty(shape)
+
+    # When rotating, the peaks are kept indexed by rotation first to match the
+    # output of the matrix product, and transposed at the end.
+    if rotation is None:
+        peak = numpy.zeros(shape)
+    else:
+        peak = numpy.zeros((len(rotation), records, len(periods), len(damping)))
+
+    # Index the input so each time slice broadcasts against the state.
+    acceleration = acceleration[:, :, :, numpy.newaxis, numpy.newaxis]
+
+    # Records which have run out of samples must stop contributing to their
+    # peaks. While every record is still active we can skip the masking.
+    shortest = lengths.min()
+
+    for i in range(samples - 1):
+        p0 = acceleration[:, :, i]
+        p1 = acceleration[:, :, i + 1]
+
+        # New displacement, held in the temporary until the velocity has been
+        # updated from the old one.
+        numpy.multiply(a11, x, temp)
+        temp += a12 * v
+        temp += b11 * p0
+        temp += b12 * p1
+
+        # New velocity.
+        v *= a22
+        v += a21 * x
+        v += b21 * p0
+        v += b22 * p1
+
+        # Swap the buffers over.
+        x, temp = temp, x
+
+        # The values to take the peaks of.
+        if rotation is None:
+            current = numpy.abs(x)
+        else:
+            current = numpy.abs(numpy.tensordot(rotation, x[:, :2], (1, 1)))
+
+        # Update the peaks.
+        if i + 1 < shortest:
+            numpy.maximum(peak, current, peak)
+        elif rotation is None:
+            active = lengths > i + 1
+            peak[active] = numpy.maximum(peak[active], current[active])
+        else:
+            active = lengths > i + 1
+            peak[:, active] = numpy.maximum(peak[:, active], current[:, active])
+
+    if rotation is not None:
+        return peak.swapaxes(0, 1)
+    return peak
+
+
+def _rotated_peaks(histories, rotation, block=4096):
+    """Find the peak absolute values of the first two axes of zero-padded
+    histories rotated by each row of a rotation matrix. The result is indexed
+    by history and then row of the matrix.
+
+    The histories are processed in blocks of samples so the rotated copies
+    never take more memory than one block for each rotation.
+
+    :param histories: The histories, indexed by history, axis and sample.
+    :param rotation: A matrix with two columns, each row of which gives the
+                     weights of the first two axes in one rotated axis.
+    :param block: The number of samples to rotate at a time.
+
+    """
+    peak = numpy.zeros((histories.shape[0], len(rotation)))
+    for start in range(0, histories.shape[2], block):
+        chunk = histories[:, :2, start:start + block]
+        rotated = numpy.abs(numpy.tensordot(rotation, chunk, (1, 1)))
+        numpy.maximum(peak, rotated.max(axis=2).T, peak)
+    return peak
+
+
+def acceleration_spectra(accelerations, timesteps, periods, damping=0.05,
+                         rotation=None):
+    """Calculate the elastic response spectra of a batch of acceleration
+    histories in one go. The histories may have different lengths and
+    timesteps.
+
+    Three arrays are returned: the spectral displacement, the pseudo-spectral
+    velocity and the pseudo-spectral acceleration. Each has the shape (records,
+    axes) + shape of periods + shape of damping, so a scalar damping ratio
+    gives arrays indexed by (record, axis, period). A period of zero gives the
+    peak ground acceleration as the pseudo-spectral acceleration and zero for
+    the other two values.
+
+    If a rotation matrix is given, the second index of the arrays is the row
+    of the matrix rather than the axis, and the values are the spectra of the
+    first two axes rotated by that row. This is used by :mod:`sm.rotd`.
+
+    :param accelerations: The acceleration histories. Each entry should be a
+                          two-dimensional array indexed by axis and then
+                          sample, such as :attr:`Record.acceleration`. All
+                          entries must have the same number of axes.
+    :type accelerations: sequence of numpy arrays
+    :param timesteps: The timestep of each record.
+    :type timesteps: sequence of floats
+    :param periods: The natural periods, in seconds, to evaluate the spectra
+                    at.
+    :type periods: float or array of floats
+    :param damping: The damping ratio(s) as a fraction of critical. These must
+                    be non-negative and less than one.
+    :type damping: float or array of floats
+    :param rotation: A matrix with two columns, each row of which gives the
+                     weights of the first two axes in one rotated axis.
+    :type rotation: numpy array
+
+    """
+    # Sanitise the periods and damping ratios, remembering their original
+    # shapes so we can restore them at the end.
+    periods = numpy.asarray(periods, dtype=float)
+    damping = numpy.asarray(damping, dtype=float)
+    if numpy.any(periods < 0):
+        raise ValueError('Periods cannot be negative.')
+    if numpy.any(damping < 0) or numpy.any(damping >= 1):
+        raise ValueError('Damping ratios must be in the range [0, 1).')
+    flat_periods = periods.ravel()
+    flat_damping = damping.ravel()
+
+    # Stack the records into one zero-padded array.
+    stacked, lengths = stack(accelerations)
+    axes = stacked.shape[1]
+    timesteps = numpy.asarray(timesteps, dtype=float)
+
+    # The number of output axes.
+    if rotation is not None:
+        axes = len(rotation)
+
+    # Integrate the oscillators with a non-zero period.
+    positive = flat_periods > 0
+    sd = numpy.zeros((len(accelerations), axes, len(flat_periods), len(flat_damping)))
+    if positive.any():
+        sd[:, :, positive] = _peak_displacements(stacked, timesteps, lengths,
+                                                 flat_periods[positive],
+                                                 flat_damping, rotation)
+
+    # Convert to the pseudo-spectral values.
+    omega = numpy.zeros(len(flat_periods))
+    omega[positive] = 2 * numpy.pi / flat_periods[positive]
+    omega = omega[:, numpy.newaxis]
+    psv = sd * omega
+    psa = sd * omega**2
+
+    # Zero period oscillators follow the ground exactly.
+    if not positive.all():
+        if rotation is None:
+            pga = numpy.abs(stacked).max(axis=2)
+        else:
+            pga = _rotated_peaks(stacked, rotation)
+        psa[:, :, ~positive] = pga[:, :, numpy.newaxis, numpy.newaxis]
+
+    # Restore the requested shapes.
+    shape = (len(accelerations), axes) + periods.shape + damping.shape
+    return sd.reshape(shape), psv.reshape(shape), psa.reshape(shape)
+
+
+def response_spectra(records, periods, damping=0.05):
+    """Calculate the elastic response spectra of a batch of :class:`Record`
+    instances in one go. See :func:`acceleration_spectra` for details of the
+    returned values.
+
+    :param records: The records to calculate the spectra of.
+    :type records: sequence of :class:`Record`
+    :param periods: The natural periods, in seconds, to evaluate the spectra
+                    at.
+    :type periods: float or array of floats
+    :param damping: The damping ratio(s) as a fraction of critical.
+    :type damping: float or array of floats
+
+    """
+    return acceleration_spectra([r.acceleration for r in records],
+                                [r.timestep for r in records], periods,
+                                damping)
@@ -0,0 +1,98 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Resample a set of records onto a common absolute time grid.
+
+Each record has its own start time, timestep and length. To compare records of
+the same event from different sites they are linearly interpolated onto one
+time grid, with all records being interpolated in a single array operation.
+
+"""
+
+from datetime import timedelta
+
+import numpy
+
+from sm.spectra import stack
+
+
+def _seconds(delta):
+    """Helper function to convert a timedelta to a number of seconds.
+
+    """
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+def synchronise(records, timestep=None, window=None):
+    """Linearly interpolate the acceleration of a set of records onto a common
+    time grid. A three element tuple is returned. The first element is the
+    time of the first point of the grid, the second element is the spacing of
+    the grid in seconds, and the third element is a numpy array of the
+    interpolated accelerations indexed by record, axis and then grid point.
+    Grid points before the start or after the end of a record are set to NaN
+    for that record.
+
+    :param records: The records to synchronise.
+    :type records: sequence of :class:`Record`
+    :param timestep: The spacing of the grid in seconds. If None, the smallest
+                     timestep of the records is used.
+    :type timestep: float
+    :param window: The first and last times of the grid as timezone-aware
+                   datetimes. If None, the grid covers all the records from the
+                   earliest start to the latest end.
+    :type window: tuple of datetimes
+
+    """
+    if timestep is None:
+        timestep = min(r.timestep for r in records)
+
+    # The start time of every record relative to the earliest one.
+    reference = min(r.start for r in records)
+    starts = numpy.array([_seconds(r.start - reference) for r in records])
+    steps = numpy.array([r.timestep for r in records])
+    data, lengths = stack([r.acceleration for r in records])
+
+    # Work out the extent of the grid, relative to the reference.
+    if window is None:
+        first = 0.0
+        last = (starts + (lengths - 1) * steps).max()
+    else:
+        first = _seconds(window[0] - reference)
+        last = _seconds(window[1] - reference)
+    points = int(numpy.floor((last - first) / timestep + 1e-9)) + 1
+    grid = first + numpy.arange(points) * timestep
+
+    # The fractional sample index of each grid point in each record.
+    position = (grid[numpy.newaxis, :] - starts[:, numpy.newaxis]) / steps[:, numpy.newaxis]
+    valid = (position >= 0) & (position <= (lengths - 1)[:, numpy.newaxis])
+
+    # The samples either side of each grid point. Invalid points are clipped so
+    # the indexing works, and then overwritten afterwards.
+    lower = numpy.clip(numpy.floor(position).astype(int), 0,
+                       numpy.maximum(lengths - 2, 0)[:, numpy.newaxis])
+    upper = numpy.minimum(lower + 1, (lengths - 1)[:, numpy.newaxis])
+    weight = numpy.clip(position - lower, 0, 1)
+
+    # Interpolate every record and axis at once.
+    rows = numpy.arange(len(records))[:, numpy.newaxis, numpy.newaxis]
+    axes = numpy.arange(data.shape[1])[numpy.newaxis, :, numpy.newaxis]
+    lower = lower[:, numpy.newaxis, :]
+    upper = upper[:, numpy.newaxis, :]
+    weight = weight[:, numpy.newaxis, :]
+    result = data[rows, axes, lower] * (1 - weight)
+    result += data[rows, axes, upper] * weight
+    result = numpy.where(valid[:, numpy.newaxis, :], result, numpy.nan)
+
+    return reference + timedelta(seconds=first), timestep, result
@@ -0,0 +1,97 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import os.path
+import sys
+import unittest
+
+import numpy
+
+from sm.archive import Archive
+from sm.batch import all_records
+from sm.server import Server
+from sm.tests.util import TemporaryDirectoryTestCase, add_event, component
+
+
+class ArchiveTest(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        TemporaryDirectoryTestCase.setUp(self)
+        self.mirror = self.path('mirror')
+        add_event(self.mirror, '2009-11-20_020304', ['AAAA', 'BBBB'], samples=300)
+        self.server = Server(self.path('cache'), mirror=self.mirror)
+        self.update()
+        self.archive = Archive(self.path('archive'))
+
+    def update(self):
+        # update_events prints its progress.
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            self.server.update_events()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    def test_export(self):
+        self.assertEqual(self.archive.export(self.server), 2)
+        self.assertEqual(self.archive.export(self.server), 0)
+        for event, site in all_records(self.server):
+            record = self.server.get_record(event, site)
+            numpy.testing.assert_array_equal(
+                self.archive.get(event, site),
+                record.acceleration.astype(numpy.float32))
+            filename = self.server.get_record_filename(event, site)
+            self.assertEqual(self.archive.info(event, site)['filename'], filename)
+            self.archive.get(event, site, filename)
+            self.assertRaises(KeyError, self.archive.get, event, site, 'other.V1A')
+
+    def test_unparseable_skipped(self):
+        # A record with only two components.
+        data_dir = add_event(self.mirror, '2009-11-25_111111', [], samples=300)
+        f = open(os.path.join(data_dir, '20091125_111111_CCCC.V1A'), 'w')
+        f.write(component(0, numpy.zeros(300)) + component(90, numpy.zeros(300)))
+        f.close()
+        self.update()
+        self.assertEqual(self.archive.export(self.server), 2)
+        self.assertEqual(len(self.archive), 2)
+
+    def test_renumbered(self):
+        self.archive.export(self.server)
+
+        # Make the entries look like they are of another event, as they would
+        # if the events had been renumbered since they were exported.
+        self.archive.index.execute('''update records set
+                                   filename='20091105_101010_' || site || '.V1A';''')
+        self.archive.index.commit()
+        pairs = all_records(self.server)
+        for event, site in pairs:
+            filename = self.server.get_record_filename(event, site)
+            self.assertRaises(KeyError, self.archive.get, event, site, filename)
+
+        # Exporting again replaces them.
+        self.assertEqual(self.archive.export(self.server), 2)
+        self.assertEqual(len(self.archive), 2)
+        for event, site in pairs:
+            filename = self.server.get_record_filename(event, site)
+            self.assertEqual(self.archive.info(event, site, filename)['filename'],
+                             filename)
+            self.assertEqual(self.archive.get(event, site).shape[1],
+                             self.server.get_record(event, site).data_length)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import unittest
+
+import numpy
+
+from sm.batch import all_records, map_records
+from sm.server import Server
+from sm.tests.util import TemporaryDirectoryTestCase, add_event
+
+
+def peak(record):
+    """The peak acceleration of each axis of a record."""
+    return list(abs(record.acceleration).max(axis=-1))
+
+
+def fail_short(record):
+    """The peak accelerations, failing for records shorter than 500 samples."""
+    if record.data_length < 500:
+        raise RuntimeError('failed')
+    return peak(record)
+
+
+class MapRecordsTest(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        TemporaryDirectoryTestCase.setUp(self)
+        mirror = self.path('mirror')
+        add_event(mirror, '2009-11-20_020304', ['AAAA', 'BBBB', 'CCCC'],
+                  samples=500)
+        add_event(mirror, '2010-01-05_101010', ['AAAA', 'DDDD'], samples=400,
+                  seed=1)
+        self.cache_dir = self.path('cache')
+        self.server = Server(self.cache_dir, mirror=mirror)
+
+        # update_events prints its progress.
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            self.server.update_events()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+        # The workers cannot download, so cache every record first, working
+        # out the expected results directly.
+        self.pairs = all_records(self.server)
+        self.expected = {}
+        for event, site in self.pairs:
+            self.expected[event, site] = peak(self.server.get_record(event, site))
+
+    def run_map(self, func, query, **kwargs):
+        return list(map_records(func, query, processes=2,
+                                cache_dir=self.cache_dir, **kwargs))
+
+    def test_all_records(self):
+        # In date order, so the records from 2010 are last.
+        self.assertEqual(len(set(self.pairs)), 5)
+        self.assertEqual(sorted(site for event, site in self.pairs[:3]),
+                         ['AAAA', 'BBBB', 'CCCC'])
+        self.assertEqual(sorted(site for event, site in self.pairs[3:]),
+                         ['AAAA', 'DDDD'])
+
+    def test_results(self):
+        results = self.run_map(peak, all_records)
+        self.assertEqual(sorted((event, site) for event, site, result, error in results),
+                         sorted(self.pairs))
+        for event, site, result, error in results:
+            self.assertIsNone(error)
+            numpy.testing.assert_allclose(result, self.expected[event, site])
+
+    def test_errors(self):
+        # Failures are reported, but do not stop the run.
+        failing = set(self.pairs[3:]) | set([(self.pairs[0][0], 'ZZZZ')])
+        results = self.run_map(fail_short, self.pairs + [(self.pairs[0][0], 'ZZZZ')])
+        self.assertEqual(len(results), 6)
+        for event, site, result, error in results:
+            if (event, site) in failing:
+                self.assertIsNone(result)
+                self.assertTrue(error.startswith('Traceback'))
+            else:
+                self.assertIsNone(error)
+                numpy.testing.assert_allclose(result, self.expected[event, site])
+
+    def test_checkpoint(self):
+        # Stop after the first result. It must already be in the checkpoint.
+        checkpoint = self.path('checkpoint')
+        for first in map_records(fail_short, self.pairs, processes=1,
+                                 cache_dir=self.cache_dir, checkpoint=checkpoint):
+            break
+        f = open(checkpoint)
+        self.assertEqual(f.read().split(), [str(first[0]), first[1]])
+        f.close()
+
+        # Resuming skips it, and the failed records are tried again each time.
+        results = self.run_map(fail_short, self.pairs, checkpoint=checkpoint)
+        resumed = sorted((event, site) for event, site, result, error in results)
+        self.assertEqual(resumed, sorted(set(self.pairs) - set([first[:2]])))
+        results = self.run_map(fail_short, self.pairs, checkpoint=checkpoint)
+        self.assertEqual(sorted((event, site) for event, site, result, error in results),
+                         sorted(self.pairs[3:]))
+
+
+if __name__ == '__main__':
+    unittest.main()
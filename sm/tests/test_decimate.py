@@ -0,0 +1,102 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+import numpy
+
+from sm.decimate import bucket_edges, lttb, minmax
+
+
+def reference_lttb(values, points):
+    """The Largest-Triangle-Three-Buckets algorithm as given by Steinarsson
+    (2013), for a single list of values at unit spacing. The bucket
+    boundaries use integer arithmetic so they are exact. A list of the chosen
+    indices is returned.
+
+    """
+    length = len(values)
+    chosen = [0]
+    a = 0
+    for i in range(points - 2):
+        # The average of the next bucket, which for the last bucket is just
+        # the last sample.
+        start = (i + 1) * (length - 2) // (points - 2) + 1
+        end = min((i + 2) * (length - 2) // (points - 2) + 1, length)
+        cx = sum(range(start, end)) / float(end - start)
+        cy = sum(values[start:end]) / float(end - start)
+
+        # The point of this bucket making the largest triangle with the last
+        # chosen point and the average.
+        largest = -1
+        for j in range(i * (length - 2) // (points - 2) + 1, start):
+            area = abs((a - cx) * (values[j] - values[a]) -
+                       (a - j) * (cy - values[a])) * 0.5
+            if area > largest:
+                largest = area
+                best = j
+        chosen.append(best)
+        a = best
+    chosen.append(length - 1)
+    return chosen
+
+
+class DecimateTest(unittest.TestCase):
+
+    def test_bucket_edges(self):
+        self.assertEqual(list(bucket_edges(10, 3)), [0, 3, 6])
+        self.assertEqual(list(bucket_edges(2, 5)), [0, 1])
+
+    def test_minmax(self):
+        data = numpy.random.RandomState(0).randn(3, 1003)
+        edges, low, high = minmax(data, 17)
+        bounds = list(edges) + [data.shape[1]]
+        for axis in range(3):
+            for b in range(17):
+                bucket = list(data[axis, bounds[b]:bounds[b + 1]])
+                self.assertEqual(low[axis, b], min(bucket))
+                self.assertEqual(high[axis, b], max(bucket))
+
+    def test_lttb_against_reference(self):
+        rng = numpy.random.RandomState(1)
+        data = numpy.cumsum(rng.randn(3, 1000), axis=1)
+        for points in (3, 4, 50, 333, 999):
+            indices, values = lttb(data, points)
+            self.assertEqual(indices.shape, (3, points))
+            for axis in range(3):
+                expected = reference_lttb(list(data[axis]), points)
+                self.assertEqual(list(indices[axis]), expected)
+                numpy.testing.assert_array_equal(values[axis],
+                                                 data[axis, expected])
+
+    def test_lttb_short(self):
+        data = numpy.arange(10.0).reshape(2, 5)
+        indices, values = lttb(data, 5)
+        numpy.testing.assert_array_equal(values, data)
+        self.assertEqual(list(indices[1]), range(5))
+
+    def test_lttb_few_points(self):
+        # Only the first and last samples are kept.
+        data = numpy.random.RandomState(2).randn(3, 100)
+        for points in (2, 1, 0):
+            indices, values = lttb(data, points)
+            self.assertEqual(indices.tolist(), [[0, 99]] * 3)
+            numpy.testing.assert_array_equal(values, data[:, [0, 99]])
+        indices, values = lttb(data[:, :1], 1)
+        numpy.testing.assert_array_equal(values, data[:, :1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import os
+import shutil
+import sys
+import unittest
+
+import numpy
+
+from sm.hvsr import frequencies, konno_ohmachi, site_hvsr, spectral_ratios
+from sm.server import Server
+from sm.tests.util import TemporaryDirectoryTestCase, add_event, component
+
+
+class Accelerations(object):
+    """Stand-in for a record, holding just what
+    :func:`sm.hvsr.spectral_ratios` uses.
+
+    """
+
+    def __init__(self, acceleration, timestep):
+        self.acceleration = acceleration
+        self.timestep = timestep
+
+
+def reference_ratios(acceleration, timestep, centres, bandwidth=40.0,
+                     taper=0.05):
+    """The spectral ratios of a single record, using a direct Fourier
+    transform and the smoothing window written out for each frequency.
+
+    """
+    length = len(acceleration[0])
+    nfft = 1
+    while nfft < length:
+        nfft *= 2
+    width = max(int(taper * length), 1)
+    k = numpy.arange(nfft // 2 + 1)
+    transform = numpy.exp(-2j * numpy.pi * numpy.outer(k, numpy.arange(length))
+                          / nfft)
+
+    amplitudes = []
+    for axis in acceleration:
+        mean = sum(axis) / length
+        tapered = []
+        for i, value in enumerate(axis):
+            ramp = min(min(i, length - 1 - i) / float(width), 1.0)
+            tapered.append((value - mean) * 0.5 * (1 - math.cos(math.pi * ramp)))
+        amplitudes.append(abs(numpy.dot(transform, tapered)))
+    horizontal = numpy.sqrt((amplitudes[0]**2 + amplitudes[1]**2) / 2)
+    fft_frequencies = k / (nfft * timestep)
+
+    ratios = []
+    for centre in centres:
+        if centre >= 0.5 / timestep or centre < 10.0 / (length * timestep):
+            ratios.append(numpy.nan)
+            continue
+        h = v = 0.0
+        for f, a, b in zip(fft_frequencies[1:], horizontal[1:], amplitudes[2][1:]):
+            x = bandwidth * math.log10(f / centre)
+            weight = 1.0 if x == 0 else (math.sin(x) / x)**4
+            h += weight * a
+            v += weight * b
+        ratios.append(h / v)
+    return numpy.array(ratios)
+
+
+def records(seed):
+    """Records of different lengths and timesteps, some sharing a padded
+    length.
+
+    """
+    rng = numpy.random.RandomState(seed)
+    return [Accelerations(rng.randn(3, n) * scale[:, numpy.newaxis], timestep)
+            for n, timestep, scale in ((300, 0.01, numpy.array([1, 2, 1])),
+                                       (500, 0.01, numpy.array([3, 1, 1])),
+                                       (256, 0.01, numpy.array([1, 1, 2])),
+                                       (700, 0.005, numpy.array([1, 1, 1])),
+                                       (257, 0.02, numpy.array([2, 2, 1])))]
+
+
+class SpectralRatiosTest(unittest.TestCase):
+
+    def test_konno_ohmachi(self):
+        fft_frequencies = numpy.arange(0, 50.0, 0.1)
+        centres = numpy.array([1.0, 5.0])
+        weights = konno_ohmachi(fft_frequencies, centres)
+        numpy.testing.assert_allclose(weights.sum(axis=1), 1)
+        self.assertEqual(weights[:, 0].tolist(), [0, 0])
+        self.assertEqual(weights.argmax(axis=1).tolist(), [10, 50])
+
+    def test_against_reference(self):
+        centres = frequencies((0.5, 40.0), 30)
+        batch = records(0)
+        ratios = spectral_ratios(batch, centres)
+        self.assertEqual(ratios.shape, (5, 30))
+        for record, result in zip(batch, ratios):
+            expected = reference_ratios(record.acceleration.tolist(),
+                                        record.timestep, centres)
+            numpy.testing.assert_array_equal(numpy.isnan(result),
+                                             numpy.isnan(expected))
+            self.assertTrue(numpy.isfinite(expected).any())
+            valid = numpy.isfinite(expected)
+            numpy.testing.assert_allclose(result[valid], expected[valid],
+                                          rtol=1e-10)
+
+    def test_batch_matches_individual(self):
+        centres = frequencies((0.5, 40.0), 30)
+        batch = records(1)
+        ratios = spectral_ratios(batch, centres, bandwidth=20.0, taper=0.1)
+        for record, result in zip(batch, ratios):
+            single = spectral_ratios([record], centres, bandwidth=20.0,
+                                     taper=0.1)[0]
+            # The stacked FFTs and matrix products only differ in rounding.
+            numpy.testing.assert_allclose(result, single, rtol=1e-14)
+
+
+class SiteHVSRTest(TemporaryDirectoryTestCase):
+
+    def test_site_hvsr(self):
+        mirror = self.path('mirror')
+        for i, name in enumerate(['2009-11-05_101010', '2009-11-20_020304',
+                                  '2009-12-01_121212']):
+            add_event(mirror, name, ['AAAA', 'BBBB'], samples=600 + 100 * i,
+                      seed=i)
+
+        # A record cut off part way through its first header is left out.
+        data_dir = add_event(mirror, '2009-12-24_235959', [], samples=600)
+        f = open(os.path.join(data_dir, '20091224_235959_AAAA.V1A'), 'w')
+        f.write(''.join(component(0, numpy.zeros(600)).splitlines(True)[:17]))
+        f.close()
+
+        server = Server(self.path('cache'), mirror=mirror)
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            server.update_events()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+        centres, mean, spread, included = site_hvsr(server, 'aaaa',
+                                                    band=(1.0, 50.0), points=20)
+        events = [event for event, date in server.events_at_site('AAAA')]
+        self.assertEqual(len(events), 4)
+        events = [event for event in events
+                  if event != server.get_events(2009, 12)[-1][0]]
+        self.assertEqual(included, events)
+
+        # The geometric mean and spread of the individual ratios at each
+        # frequency, leaving out the records which do not cover it.
+        ratios = spectral_ratios([server.get_record(event, 'AAAA')
+                                  for event in events], centres)
+        self.assertTrue(numpy.isnan(ratios).any())
+        for i in range(len(centres)):
+            logs = [math.log10(r) for r in ratios[:, i] if not numpy.isnan(r)]
+            if not logs:
+                self.assertTrue(numpy.isnan(mean[i]))
+                continue
+            average = sum(logs) / len(logs)
+            self.assertAlmostEqual(mean[i] / 10**average, 1, 12)
+            deviation = math.sqrt(sum((l - average)**2 for l in logs) / len(logs))
+            self.assertAlmostEqual(spread[i], deviation, 12)
+
+        # The ratios are stored, so the records are not needed again.
+        stored = server.info_cache.execute('select count(*) from hvsr;')
+        self.assertEqual(stored.fetchone()[0], 4)
+        shutil.rmtree(mirror)
+        for name in os.listdir(self.path('cache')):
+            if name.endswith('.V1A'):
+                os.remove(self.path('cache', name))
+        again = site_hvsr(server, 'AAAA', band=(1.0, 50.0), points=20)
+        numpy.testing.assert_array_equal(again[1], mean)
+        self.assertEqual(again[3], included)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import unittest
+
+import numpy
+import pytz
+
+from sm.intensity import GRAVITY, acceleration_measures, intensity_measures
+from sm.record import Record
+from sm.tests.util import TemporaryDirectoryTestCase, write_record
+
+
+def reference_measures(acceleration, timestep):
+    """The intensity measures of a single axis, integrating sample by sample.
+    The result is a dictionary keyed by the fields of
+    :data:`sm.intensity.MEASURES`.
+
+    """
+    velocity = displacement = cav = squared = 0.0
+    pgv = pgd = 0.0
+    cumulative = [0.0]
+    for i in range(1, len(acceleration)):
+        a0, a1 = acceleration[i - 1], acceleration[i]
+        previous = velocity
+        velocity += (a0 + a1) / 2 * timestep
+        displacement += (previous + velocity) / 2 * timestep
+        cav += (abs(a0) + abs(a1)) / 2 * timestep
+        squared += (a0 * a0 + a1 * a1) / 2 * timestep
+        cumulative.append(squared)
+        pgv = max(pgv, abs(velocity))
+        pgd = max(pgd, abs(displacement))
+
+    # The significant duration runs from the first sample at 5% of the total
+    # to the first at 95%.
+    start = min(i for i, c in enumerate(cumulative) if c >= 0.05 * squared)
+    end = min(i for i, c in enumerate(cumulative) if c >= 0.95 * squared)
+    return {
+        'pga': max(abs(a) for a in acceleration),
+        'pgv': pgv,
+        'pgd': pgd,
+        'arias': math.pi / (2 * GRAVITY) * squared,
+        'cav': cav,
+        'd5_95': (end - start) * timestep,
+    }
+
+
+class AccelerationMeasuresTest(unittest.TestCase):
+
+    def test_against_reference(self):
+        # Histories of different lengths and timesteps, so the shorter ones
+        # are padded in the batch.
+        rng = numpy.random.RandomState(0)
+        accelerations = [rng.randn(2, n) for n in (150, 400, 250)]
+        timesteps = [0.01, 0.005, 0.02]
+        result = acceleration_measures(accelerations, timesteps)
+        self.assertEqual(result.shape, (3, 2))
+        for k, (acceleration, timestep) in enumerate(zip(accelerations,
+                                                         timesteps)):
+            for axis in range(2):
+                expected = reference_measures(list(acceleration[axis]), timestep)
+                for name, value in expected.items():
+                    self.assertAlmostEqual(result[name][k, axis] / value, 1, 12,
+                                           name)
+
+    def test_constant(self):
+        # A constant acceleration, for which the trapezoidal rule is exact.
+        # The length is chosen so the 5% and 95% points fall between samples.
+        samples = 108
+        timestep = 0.01
+        duration = (samples - 1) * timestep
+        result = acceleration_measures([numpy.ones((1, samples)) * 2.0],
+                                       [timestep])[0, 0]
+        self.assertAlmostEqual(result['pga'], 2.0)
+        self.assertAlmostEqual(result['pgv'], 2.0 * duration)
+        self.assertAlmostEqual(result['pgd'], duration**2)
+        self.assertAlmostEqual(result['cav'], 2.0 * duration)
+        self.assertAlmostEqual(result['arias'],
+                               math.pi / (2 * GRAVITY) * 4.0 * duration)
+        steps = samples - 1
+        self.assertAlmostEqual(result['d5_95'], (math.ceil(0.95 * steps) -
+                                                 math.ceil(0.05 * steps)) * timestep)
+
+
+class IntensityMeasuresTest(TemporaryDirectoryTestCase):
+
+    def test_records(self):
+        rng = numpy.random.RandomState(1)
+        records = []
+        for i, samples in enumerate((200, 300)):
+            filename = self.path('{0}.V1A'.format(i))
+            write_record(filename, rng.randn(3, samples) * 0.1, timestep=0.01)
+            records.append(Record({}, filename, pytz.utc))
+        result = intensity_measures(records)
+        self.assertEqual(result.shape, (2, 3))
+        for k, record in enumerate(records):
+            single = acceleration_measures([record.acceleration], [0.01])
+            for name in result.dtype.names:
+                numpy.testing.assert_allclose(result[name][k], single[name][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+from cStringIO import StringIO
+import os
+import os.path
+import subprocess
+import sys
+import unittest
+
+import numpy
+
+import sm
+from sm.__main__ import main
+from sm.server import Server
+from sm.tests.util import TemporaryDirectoryTestCase, add_event
+
+
+class MainTest(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        TemporaryDirectoryTestCase.setUp(self)
+        self.mirror = self.path('mirror')
+        add_event(self.mirror, '2009-11-20_020304', ['AAAA', 'BBBB'], samples=300)
+        add_event(self.mirror, '2010-01-05_101010', ['AAAA'], samples=300, seed=1)
+        self.cache = self.path('cache')
+
+    def run_main(self, *argv):
+        """Run the command line interface, returning what it printed."""
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            main(['--cache', self.cache, '--mirror', self.mirror] + list(argv))
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def assertExits(self, message, *argv):
+        try:
+            self.run_main(*argv)
+        except SystemExit as e:
+            self.assertIn(message, str(e))
+        else:
+            self.fail('SystemExit not raised')
+
+    def test_empty_cache(self):
+        for argv in (['years'], ['events', '--site', 'AAAA'], ['record', '1', 'AAAA']):
+            self.assertExits('run update first', *argv)
+
+    def test_listing(self):
+        self.run_main('update', '--events-only')
+        server = Server(self.cache, mirror=self.mirror)
+        event, date = server.get_events(2009, 11)[0]
+        self.assertEqual(self.run_main('years'), '2009\n2010\n')
+        self.assertEqual(self.run_main('months', '2009'), '11\n')
+        self.assertEqual(self.run_main('events', '2009', '11'),
+                         '{0}\t{1}\n'.format(event, date.isoformat()))
+        self.assertEqual(len(self.run_main('events', '--site', 'aaaa').splitlines()), 2)
+        self.assertEqual(sorted(self.run_main('sites', str(event)).split()),
+                         ['AAAA', 'BBBB'])
+        self.assertExits('give a year and month, or a site', 'events')
+
+    def test_record(self):
+        self.run_main('update', '--events-only')
+        server = Server(self.cache, mirror=self.mirror)
+        event = server.get_events(2009, 11)[0][0]
+        record = server.get_record(event, 'AAAA')
+
+        filename = self.path('aaaa.csv')
+        self.run_main('record', str(event), 'aaaa', '-o', filename)
+        values = numpy.loadtxt(filename)
+        numpy.testing.assert_allclose(values[:, 0], record.time, rtol=1e-5)
+        numpy.testing.assert_allclose(values[:, 1:], record.acceleration.T,
+                                      rtol=1e-5, atol=1e-9)
+
+        filename = self.path('aaaa.npy')
+        self.run_main('record', str(event), 'AAAA', '--format', 'npy', '-o', filename)
+        numpy.testing.assert_array_equal(numpy.load(filename),
+                                         numpy.vstack((record.time, record.acceleration)))
+
+        self.assertExits('no record of event {0} at ZZZZ'.format(event),
+                         'record', str(event), 'ZZZZ')
+
+    def test_snapshot(self):
+        self.run_main('update', '--events-only')
+        server = Server(self.cache, mirror=self.mirror)
+        event = server.get_events(2009, 11)[0][0]
+        server.get_record(event, 'AAAA')
+        filename = self.path('snapshot.tar.gz')
+        self.assertEqual(self.run_main('export', filename), 'Exported 1 data files\n')
+
+        self.cache = self.path('imported')
+        output = self.run_main('import', filename)
+        self.assertTrue(output.startswith('Imported 1 data files\n'))
+        self.assertEqual(self.run_main('years'), '2009\n2010\n')
+
+    def test_lazy_imports(self):
+        # Listing does not load numpy.
+        self.run_main('update', '--events-only')
+        script = ('import sys\n'
+                  'from sm.__main__ import main\n'
+                  'main(["--cache", sys.argv[1], "years"])\n'
+                  'sys.exit("numpy" in sys.modules)\n')
+        root = os.path.dirname(os.path.dirname(os.path.abspath(sm.__file__)))
+        process = subprocess.Popen([sys.executable, '-c', script, self.cache],
+                                   cwd=root, stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        self.assertEqual(output, '2009\n2010\n')
+        self.assertEqual(process.returncode, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import unittest
+
+import numpy
+
+from sm.processing import (Bandpass, Detrend, Integrate, Pipeline, Taper,
+                           fourier_spectra, next_fast_length)
+
+
+class Accelerations(object):
+    """Stand-in for a record, holding just what a pipeline uses."""
+
+    def __init__(self, acceleration, timestep):
+        self.acceleration = acceleration
+        self.data_length = acceleration.shape[-1]
+        self.timestep = timestep
+
+
+class CountingTaper(Taper):
+    """A taper which counts how many times it has been prepared."""
+
+    prepared = 0
+
+    def prepare(self, length, timestep):
+        CountingTaper.prepared += 1
+        return Taper.prepare(self, length, timestep)
+
+
+def reference_fast_length(n):
+    """The smallest number of at least n with no prime factors other than 2, 3
+    and 5, checking each number in turn.
+
+    """
+    m = max(n, 1)
+    while True:
+        remainder = m
+        for factor in (2, 3, 5):
+            while remainder % factor == 0:
+                remainder //= factor
+        if remainder == 1:
+            return m
+        m += 1
+
+
+def reference_frequency(data, timestep, steps, padding=1.0):
+    """Apply frequency domain steps to a single axis of data using the full
+    complex FFT, evaluating the combined response one frequency at a time.
+
+    """
+    length = len(data)
+    nfft = reference_fast_length(int(length * (1 + padding)))
+    spectrum = numpy.fft.fft(data, nfft)
+    for k in range(nfft):
+        # Negative frequencies get the conjugate response, keeping the output
+        # real.
+        frequency = min(k, nfft - k) / (nfft * timestep)
+        response = 1.0
+        for step in steps:
+            if isinstance(step, Bandpass):
+                if step.low:
+                    if frequency == 0:
+                        response = 0.0
+                    else:
+                        response /= math.sqrt(1 + (step.low / frequency)**(2 * step.order))
+                if step.high:
+                    response /= math.sqrt(1 + (frequency / step.high)**(2 * step.order))
+            else:
+                if frequency == 0:
+                    response = 0.0
+                else:
+                    response *= (2j * math.pi * frequency)**-step.times
+        if k > nfft - k:
+            response = numpy.conj(response)
+        spectrum[k] *= response
+    return numpy.fft.ifft(spectrum).real[:length]
+
+
+class NextFastLengthTest(unittest.TestCase):
+
+    def test_against_reference(self):
+        for n in list(range(1, 1200)) + [4097, 10007, 65537, 123457]:
+            self.assertEqual(next_fast_length(n), reference_fast_length(n))
+
+
+class StepTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = numpy.random.RandomState(0)
+        self.data = numpy.cumsum(rng.randn(3, 301), axis=-1) + 5.0
+
+    def test_detrend(self):
+        t = numpy.arange(301)
+        for order in (0, 1):
+            result = Pipeline([Detrend(order)]).process(self.data, 0.01)
+            for axis in range(3):
+                fit = numpy.polyval(numpy.polyfit(t, self.data[axis], order), t)
+                numpy.testing.assert_allclose(result[axis],
+                                              self.data[axis] - fit, atol=1e-9)
+        self.assertRaises(ValueError, Detrend, 2)
+
+    def test_taper(self):
+        result = Pipeline([Taper(0.1)]).process(self.data, 0.01)
+        width = 30
+        for i in range(301):
+            if i < width:
+                weight = 0.5 * (1 - math.cos(math.pi * i / width))
+            elif i >= 301 - width:
+                weight = 0.5 * (1 - math.cos(math.pi * (300 - i) / width))
+            else:
+                weight = 1.0
+            numpy.testing.assert_allclose(result[:, i], self.data[:, i] * weight)
+        numpy.testing.assert_array_equal(Pipeline([Taper(0)]).process(self.data, 0.01),
+                                         self.data)
+        self.assertRaises(ValueError, Taper, 0.6)
+
+    def test_frequency(self):
+        for steps in ([Bandpass(low=0.5, high=10.0)], [Bandpass(high=5.0, order=2)],
+                      [Bandpass(low=0.2), Integrate(1)], [Integrate(2)]):
+            result = Pipeline(steps).process(self.data, 0.01)
+            for axis in range(3):
+                expected = reference_frequency(self.data[axis], 0.01, steps)
+                numpy.testing.assert_allclose(result[axis], expected, rtol=1e-7,
+                                              atol=1e-9 * abs(expected).max())
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = numpy.random.RandomState(1)
+        self.steps = [Detrend(), CountingTaper(0.05), Bandpass(low=0.1, high=20.0),
+                      Integrate(2), Detrend(0)]
+        self.pipeline = Pipeline(self.steps)
+        self.records = [Accelerations(rng.randn(3, 400), 0.01),
+                        Accelerations(rng.randn(3, 250), 0.01),
+                        Accelerations(rng.randn(3, 400), 0.005),
+                        Accelerations(rng.randn(3, 400), 0.01)]
+
+    def reference(self, record):
+        """Apply the steps to a single record one at a time."""
+        data = record.acceleration.copy()
+        for axis in data:
+            axis -= numpy.polyval(numpy.polyfit(numpy.arange(len(axis)), axis, 1),
+                                  numpy.arange(len(axis)))
+            axis *= Taper(0.05).prepare(len(axis), record.timestep)
+            axis[:] = reference_frequency(axis, record.timestep, self.steps[2:4])
+            axis -= axis.mean()
+        return data
+
+    def test_stages(self):
+        # Neighbouring frequency domain steps are combined.
+        self.assertEqual(self.pipeline._stages,
+                         [self.steps[0], self.steps[1], self.steps[2:4], self.steps[4]])
+
+    def test_process_record(self):
+        for record in self.records:
+            original = record.acceleration.copy()
+            result = self.pipeline.process_record(record)
+            numpy.testing.assert_allclose(result, self.reference(record),
+                                          atol=1e-9 * abs(result).max())
+            numpy.testing.assert_array_equal(record.acceleration, original)
+
+        # Processing in place replaces the acceleration.
+        record = self.records[0]
+        expected = self.pipeline.process_record(record)
+        self.assertIs(self.pipeline.process_record(record, in_place=True),
+                      record.acceleration)
+        numpy.testing.assert_array_equal(record.acceleration, expected)
+
+    def test_process_records(self):
+        originals = [record.acceleration.copy() for record in self.records]
+        results = self.pipeline.process_records(self.records)
+        for record, original, result in zip(self.records, originals, results):
+            numpy.testing.assert_array_equal(record.acceleration, original)
+            numpy.testing.assert_allclose(result, self.pipeline.process_record(record),
+                                          atol=1e-12 * abs(result).max())
+
+    def test_plans(self):
+        # Everything is prepared once per length and timestep.
+        CountingTaper.prepared = 0
+        for repeat in range(3):
+            self.pipeline.process_records(self.records)
+            for record in self.records:
+                self.pipeline.process_record(record)
+        self.assertEqual(sorted(self.pipeline._plans),
+                         [(250, 0.01), (400, 0.005), (400, 0.01)])
+        self.assertEqual(CountingTaper.prepared, 3)
+
+        # The FFT length of the combined frequency domain stage.
+        nfft, response = self.pipeline._plans[400, 0.01][2]
+        self.assertEqual(nfft, 800)
+        self.assertEqual(len(response), 401)
+
+
+class FourierSpectraTest(unittest.TestCase):
+
+    def test_against_fft(self):
+        data = numpy.random.RandomState(2).randn(2, 3, 1001)
+        frequencies, amplitudes = fourier_spectra(data, 0.02)
+        nfft = reference_fast_length(1001)
+        self.assertEqual(nfft, 1024)
+        numpy.testing.assert_allclose(frequencies,
+                                      numpy.arange(nfft // 2 + 1) / (nfft * 0.02))
+        for index in numpy.ndindex(2, 3):
+            padded = numpy.append(data[index], numpy.zeros(nfft - 1001))
+            expected = numpy.abs(numpy.fft.fft(padded))[:nfft // 2 + 1] * 0.02
+            numpy.testing.assert_allclose(amplitudes[index], expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import datetime
+import json
+import os
+import unittest
+
+import numpy
+
+import sm.pyramid
+from sm.pyramid import Pyramid, build_pyramid
+from sm.tests.util import TemporaryDirectoryTestCase
+
+
+class StandInRecord(object):
+    """Just the attributes of a record which a pyramid is built from.
+
+    """
+
+    def __init__(self, acceleration, timestep=0.005):
+        self.acceleration = acceleration
+        self.data_length = acceleration.shape[-1]
+        self.timestep = timestep
+        self.start = datetime(2009, 11, 20, 2, 3, 4)
+
+
+class PyramidTest(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        TemporaryDirectoryTestCase.setUp(self)
+        generator = numpy.random.RandomState(0)
+        self.raw = generator.randn(3, 10000).astype('<f4')
+        self.basename = self.path('pyramids', 'record')
+        build_pyramid(StandInRecord(self.raw), self.basename)
+        self.pyramid = Pyramid(self.basename)
+
+    def reference(self, first, last, width):
+        """The scale of the level a tile should be drawn from, and the minimum
+        and maximum of each of its buckets computed directly from the raw
+        samples.
+
+        """
+        # The coarsest power of the factor leaving at least one bucket per
+        # pixel, stopping once a level has 256 buckets or fewer.
+        scale, length = 1, self.raw.shape[-1]
+        while length > 256 and (last - first) // (scale * 4) >= width:
+            scale *= 4
+            length = -(-length // 4)
+
+        # Buckets are whole level buckets, so start and end on multiples of
+        # the scale.
+        lo = first // scale
+        hi = min(-(-last // scale), length)
+        edges = list((hi - lo) * numpy.arange(min(width, hi - lo)) //
+                     min(width, hi - lo)) + [hi - lo]
+        low = numpy.empty((3, len(edges) - 1))
+        high = numpy.empty((3, len(edges) - 1))
+        for j in range(len(edges) - 1):
+            bucket = self.raw[:, (lo + edges[j]) * scale:(lo + edges[j + 1]) * scale]
+            low[:, j] = bucket.min(axis=-1)
+            high[:, j] = bucket.max(axis=-1)
+        return scale, (lo + numpy.array(edges[:-1])) * scale, low, high
+
+    def check(self, start, end, width, first, last):
+        times, low, high = self.pyramid.tile(start, end, width)
+        scale, indices, expected_low, expected_high = self.reference(first, last, width)
+        numpy.testing.assert_allclose(times, indices * 0.005)
+        numpy.testing.assert_array_equal(low, expected_low)
+        numpy.testing.assert_array_equal(high, expected_high)
+        return scale
+
+    def test_levels(self):
+        self.assertEqual([level['scale'] for level in self.pyramid.levels],
+                         [1, 4, 16, 64])
+        self.assertEqual([level['length'] for level in self.pyramid.levels],
+                         [10000, 2500, 625, 157])
+
+    def test_whole(self):
+        self.assertEqual(self.check(None, None, 100, 0, 10000), 64)
+        self.assertEqual(self.check(None, None, 500, 0, 10000), 16)
+        self.assertEqual(self.check(None, None, 3000, 0, 10000), 1)
+
+    def test_range(self):
+        # 10.0 to 20.0 seconds is samples 2000 to 4000 inclusive.
+        self.assertEqual(self.check(10.0, 20.0, 100, 2000, 4001), 16)
+        self.assertEqual(self.check(10.0, 20.0, 1000, 2000, 4001), 1)
+        self.assertEqual(self.check(1.234, 7.891, 37, 246, 1580), 16)
+
+    def test_few_samples(self):
+        # Each sample gets its own bucket.
+        times, low, high = self.pyramid.tile(1.0, 1.02, 100)
+        numpy.testing.assert_array_equal(low, self.raw[:, 200:205])
+        numpy.testing.assert_array_equal(high, self.raw[:, 200:205])
+
+    def test_outside(self):
+        self.check(-5.0, 1.0, 50, 0, 201)
+        self.check(45.0, 100.0, 50, 9000, 10000)
+
+    def test_concurrent(self):
+        # Pyramids may be built by several threads at once, so build the same
+        # one again while the first build is writing its description. Both must
+        # succeed and leave a complete pyramid and no temporary files.
+        basename = self.path('concurrent', 'record')
+        record = StandInRecord(self.raw)
+        dump = json.dump
+        def nested(*args, **kwargs):
+            sm.pyramid.json.dump = dump
+            build_pyramid(record, basename)
+            dump(*args, **kwargs)
+        sm.pyramid.json.dump = nested
+        try:
+            build_pyramid(record, basename)
+        finally:
+            sm.pyramid.json.dump = dump
+        self.assertEqual(sorted(os.listdir(self.path('concurrent'))),
+                         ['record.f32', 'record.json'])
+        tile = Pyramid(basename).tile(None, None, 100)
+        for values, expected in zip(tile, self.pyramid.tile(None, None, 100)):
+            numpy.testing.assert_array_equal(values, expected)
+
+if __name__ == '__main__':
+    unittest.main()
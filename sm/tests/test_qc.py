@@ -0,0 +1,212 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import os
+import sys
+import unittest
+
+import numpy
+
+from sm import qc
+from sm.batch import all_records
+from sm.server import Server
+from sm.tests.util import (TemporaryDirectoryTestCase, add_event, component,
+                           write_record)
+
+
+class Accelerations(object):
+    """Stand-in for a record, holding just what :func:`sm.qc.screen` uses."""
+
+    def __init__(self, acceleration, digitised_samples=None):
+        self.acceleration = acceleration
+        self.data_length = acceleration.shape[-1]
+        self.digitised_samples = digitised_samples
+
+
+def longest_run(values):
+    """The length of the longest run of true values in a list."""
+    run = longest = 0
+    for value in values:
+        run = run + 1 if value else 0
+        longest = max(longest, run)
+    return longest
+
+
+def reference_flags(record, clip_run=8, clip_minimum=0.1, spike_factor=20.0,
+                    spike_window=200, flat_fraction=0.5):
+    """The flags of a single record, checking one sample at a time."""
+    acceleration = [[float(v) for v in axis] for axis in record.acceleration]
+    length = len(acceleration[0])
+    flags = 0
+
+    # Missing values.
+    limit = 0.999 * qc.MISSING_VALUE
+    for axis in acceleration:
+        for i, value in enumerate(axis):
+            if math.isnan(value) or math.isinf(value):
+                flags |= qc.SENTINEL
+                axis[i] = 0.0
+    for i in range(length):
+        if (math.hypot(acceleration[0][i], acceleration[1][i]) >= limit or
+                abs(acceleration[2][i]) >= limit):
+            flags |= qc.SENTINEL
+
+    for x in acceleration:
+        # Clipping.
+        peak = max(abs(v) for v in x)
+        if (longest_run([abs(v) >= 0.999 * peak for v in x]) >= clip_run and
+                peak >= clip_minimum):
+            flags |= qc.CLIPPED
+
+        # Spikes. The median bend of each block counts the missing samples of
+        # the last block as zero.
+        bends = [abs(2 * x[i + 1] - x[i] - x[i + 2]) for i in range(length - 2)]
+        medians = []
+        for start in range(0, len(bends), spike_window):
+            block = sorted(bends[start:start + spike_window] +
+                           [0.0] * max(0, start + spike_window - len(bends)))
+            medians.append((block[(spike_window - 1) // 2] +
+                            block[spike_window // 2]) / 2)
+        for i in range(length - 2):
+            b = i // spike_window
+            typical = max(medians[max(b - 1, 0):b + 2])
+            before = x[i + 1] - x[i]
+            after = x[i + 1] - x[i + 2]
+            if (before * after > 0 and min(abs(before), abs(after)) >
+                    spike_factor * (typical + qc.RESOLUTION)):
+                flags |= qc.SPIKE
+
+        # Flat-lining.
+        unchanged = [x[i + 1] == x[i] for i in range(length - 1)]
+        if longest_run(unchanged) + 1 >= flat_fraction * length:
+            flags |= qc.FLATLINE
+
+    if any(count != length for count in record.digitised_samples or []):
+        flags |= qc.COUNT_MISMATCH
+    return flags
+
+
+def noise(rng, samples, scale=0.05):
+    """A smooth three axis acceleration history."""
+    return numpy.array([numpy.convolve(rng.randn(samples), numpy.hanning(5),
+                                       'same') * scale for axis in range(3)])
+
+
+class ScreenTest(unittest.TestCase):
+
+    def batch(self):
+        """A batch of records of different lengths, some with problems."""
+        rng = numpy.random.RandomState(0)
+        records = []
+        for i in range(12):
+            acceleration = noise(rng, rng.randint(300, 900))
+            length = acceleration.shape[1]
+            problem = i % 6
+            axis = rng.randint(3)
+            at = rng.randint(10, length - 10)
+            if problem == 1:
+                acceleration[axis, at] += 2.0
+            elif problem == 2:
+                acceleration[axis, at:at + 10] = 1.0
+            elif problem == 3:
+                acceleration[axis, length // 3:] = 0.01
+            elif problem == 4:
+                acceleration[axis, at] = numpy.nan if i < 6 else qc.MISSING_VALUE
+            digitised = [length + 1] * 3 if problem == 5 else [length] * 3
+            records.append(Accelerations(acceleration, digitised))
+        return records
+
+    def test_against_reference(self):
+        records = self.batch()
+        flags = qc.screen(records)
+        expected = [reference_flags(r) for r in records]
+        self.assertEqual(list(flags), expected)
+
+        # Every problem was found somewhere, and not in the clean records.
+        self.assertEqual(expected[0], 0)
+        for flag in (qc.SPIKE, qc.CLIPPED, qc.FLATLINE, qc.SENTINEL,
+                     qc.COUNT_MISMATCH):
+            self.assertTrue(any(e & flag for e in expected), qc.describe(flag))
+
+        # And with other settings.
+        settings = {'clip_run': 4, 'spike_factor': 5.0, 'spike_window': 64,
+                    'flat_fraction': 0.2}
+        flags = qc.screen(records, **settings)
+        self.assertEqual(list(flags), [reference_flags(r, **settings)
+                                       for r in records])
+
+    def test_batch_independent(self):
+        records = self.batch()
+        flags = qc.screen(records)
+        for record, expected in zip(records, flags):
+            self.assertEqual(qc.screen([record])[0], expected)
+
+    def test_describe(self):
+        self.assertEqual(qc.describe(0), [])
+        self.assertEqual(qc.describe(qc.SPIKE | qc.UNPARSEABLE),
+                         ['spike', 'unparseable'])
+
+
+class ScreenCacheTest(TemporaryDirectoryTestCase):
+
+    def test_screen_cache(self):
+        mirror = self.path('mirror')
+        data_dir = add_event(mirror, '2009-11-20_020304', ['AAAA', 'BBBB'],
+                             samples=300)
+
+        # A record whose headers give the wrong number of samples, and one
+        # with only two components.
+        rng = numpy.random.RandomState(1)
+        write_record(os.path.join(data_dir, '20091120_020304_CCCC.V1A'),
+                     noise(rng, 300), digitised=[301, 300, 300])
+        f = open(os.path.join(data_dir, '20091120_020304_DDDD.V1A'), 'w')
+        f.write(component(0, numpy.zeros(300)) + component(90, numpy.zeros(300)))
+        f.close()
+
+        # And one cut off part way through its first header.
+        f = open(os.path.join(data_dir, '20091120_020304_EEEE.V1A'), 'w')
+        f.write(''.join(component(0, numpy.zeros(300)).splitlines(True)[:17]))
+        f.close()
+
+        server = Server(self.path('cache'), mirror=mirror)
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            server.update_events()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        event = server.get_events(2009, 11)[0][0]
+        self.assertEqual(qc.get_flags(server, event, 'AAAA'), None)
+        self.assertEqual(qc.passed_records(server), [])
+
+        # Nothing is downloaded unless asked for.
+        self.assertEqual(qc.screen_cache(server), 0)
+        self.assertEqual(qc.screen_cache(server, download=True, batch=2), 5)
+        self.assertEqual(qc.screen_cache(server), 0)
+        self.assertEqual(qc.get_flags(server, event, 'cccc'), qc.COUNT_MISMATCH)
+        self.assertEqual(qc.get_flags(server, event, 'DDDD'), qc.UNPARSEABLE)
+        self.assertEqual(qc.get_flags(server, event, 'EEEE'), qc.UNPARSEABLE)
+        self.assertEqual(sorted(qc.passed_records(server)),
+                         [(event, 'AAAA'), (event, 'BBBB')])
+        self.assertEqual(sorted(qc.passed_records(server, qc.UNPARSEABLE)),
+                         [(event, 'AAAA'), (event, 'BBBB'), (event, 'CCCC')])
+        self.assertEqual(qc.screen_cache(server, rescreen=True), 5)
+        self.assertEqual(len(all_records(server)), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
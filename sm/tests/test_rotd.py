@@ -0,0 +1,106 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import unittest
+
+import numpy
+import pytz
+
+from sm.record import Record
+from sm.rotd import rotation_matrix, rotd_peaks, rotd_pga, rotd_spectra
+from sm.tests.test_spectra import ground_motion, reference_peak
+from sm.tests.util import TemporaryDirectoryTestCase, write_record
+
+
+def percentile(values, nn):
+    """The nn'th percentile of a list of values, interpolating linearly
+    between the sorted values.
+
+    """
+    values = sorted(values)
+    position = (len(values) - 1) * nn / 100.0
+    below = int(math.floor(position))
+    above = min(below + 1, len(values) - 1)
+    return values[below] + (values[above] - values[below]) * (position - below)
+
+
+def rotated(history, angle):
+    """Rotate the two horizontal components of a history through an angle in
+    degrees, one sample at a time.
+
+    """
+    c = math.cos(math.radians(angle))
+    s = math.sin(math.radians(angle))
+    return [c * x + s * y for x, y in zip(history[0], history[1])]
+
+
+class RotDPeaksTest(unittest.TestCase):
+
+    def test_rotation_matrix(self):
+        matrix = rotation_matrix(4)
+        numpy.testing.assert_allclose(matrix, [[1, 0], [0.5**0.5, 0.5**0.5],
+                                               [0, 1], [-0.5**0.5, 0.5**0.5]],
+                                      atol=1e-15)
+
+    def test_against_loop(self):
+        rng = numpy.random.RandomState(0)
+        histories = [rng.randn(3, n) for n in (150, 400, 250)]
+        percentiles = (0, 30, 50, 100)
+        angles = 36
+        result = rotd_peaks(histories, percentiles, angles)
+        self.assertEqual(result.shape, (3, 4))
+        for k, history in enumerate(histories):
+            peaks = [max(abs(v) for v in rotated(history, i * 180.0 / angles))
+                     for i in range(angles)]
+            for j, nn in enumerate(percentiles):
+                self.assertAlmostEqual(result[k, j], percentile(peaks, nn), 12)
+
+    def test_orientation_independent(self):
+        # Rotating the record itself by a multiple of the angle step only
+        # reorders the angles.
+        history = numpy.random.RandomState(1).randn(2, 300)
+        turned = numpy.array([rotated(history, 30), rotated(history, 120)])
+        numpy.testing.assert_allclose(rotd_peaks([turned], angles=12),
+                                      rotd_peaks([history], angles=12))
+
+
+class RotDSpectraTest(TemporaryDirectoryTestCase):
+
+    def test_against_loop(self):
+        acceleration = numpy.vstack((ground_motion(200, 2), numpy.zeros(200)))
+        filename = self.path('record.V1A')
+        write_record(filename, acceleration, timestep=0.01)
+        record = Record({}, filename, pytz.utc)
+        periods = numpy.array([0.1, 0.5, 2.0])
+        angles = 8
+        sd, psv, psa = rotd_spectra([record], periods, angles=angles)
+        self.assertEqual(sd.shape, (1, 2, 3))
+        for i, period in enumerate(periods):
+            peaks = [reference_peak(rotated(record.acceleration, a * 180.0 / angles),
+                                    0.01, period, 0.05) for a in range(angles)]
+            for j, nn in enumerate((50, 100)):
+                expected = percentile(peaks, nn)
+                self.assertAlmostEqual(sd[0, j, i] / expected, 1, 5)
+                omega = 2 * math.pi / period
+                self.assertAlmostEqual(psa[0, j, i] / (expected * omega**2), 1, 5)
+
+        numpy.testing.assert_allclose(rotd_pga([record], angles=angles),
+                                      rotd_peaks([record.acceleration],
+                                                 angles=angles))
+
+
+if __name__ == '__main__':
+    unittest.main()
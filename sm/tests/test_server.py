@@ -0,0 +1,99 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import os.path
+import sys
+import threading
+import unittest
+
+from sm.server import Server
+from sm.tests.util import TemporaryDirectoryTestCase, add_event
+
+
+class FetchRecordTest(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        TemporaryDirectoryTestCase.setUp(self)
+        self.mirror = self.path('mirror')
+        self.data_dir = add_event(self.mirror, '2009-11-20_020304',
+                                  ['AAAA', 'BBBB'], samples=300)
+        self.cache = self.path('cache')
+        server = Server(self.cache, mirror=self.mirror)
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            server.update_events()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        self.event = server.get_events(2009, 11)[0][0]
+
+    def test_complete(self):
+        # Several threads, each with their own server, fetch the same record.
+        filenames = []
+
+        def fetch():
+            server = Server(self.cache, mirror=self.mirror)
+            filenames.append(server.fetch_record(self.event, 'AAAA'))
+        threads = [threading.Thread(target=fetch) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(filenames)), 1)
+        f = open(filenames[0], 'rb')
+        cached = f.read()
+        f.close()
+        f = open(os.path.join(self.data_dir, os.path.basename(filenames[0])), 'rb')
+        self.assertEqual(cached, f.read())
+        f.close()
+        self.assertEqual(sorted(os.listdir(self.cache)),
+                         sorted(['info_cache.sqlite', os.path.basename(filenames[0])]))
+
+    def test_not_visible_while_downloading(self):
+        server = Server(self.cache, mirror=self.mirror)
+        final = os.path.join(self.cache,
+                             server.get_record_filename(self.event, 'AAAA'))
+        seen = []
+        ftp = server._ftp
+
+        # Note whether the record is in the cache as each block arrives.
+        def watched(command, *args):
+            if command == 'retrbinary':
+                callback = args[1]
+
+                def check(block):
+                    seen.append(os.path.exists(final))
+                    callback(block)
+                args = (args[0], check) + args[2:]
+            return ftp(command, *args)
+        server._ftp = watched
+        server.fetch_record(self.event, 'AAAA')
+        self.assertTrue(seen)
+        self.assertFalse(any(seen))
+        self.assertTrue(os.path.isfile(final))
+
+    def test_failed(self):
+        # A record which has gone from the FTP server leaves nothing behind.
+        server = Server(self.cache, mirror=self.mirror)
+        filename = server.get_record_filename(self.event, 'BBBB')
+        os.remove(os.path.join(self.data_dir, filename))
+        self.assertRaises(IOError, server.fetch_record, self.event, 'BBBB')
+        self.assertEqual(os.listdir(self.cache), ['info_cache.sqlite'])
+
+
+if __name__ == '__main__':
+    unittest.main()
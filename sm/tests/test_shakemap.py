@@ -0,0 +1,103 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import os.path
+import sys
+import unittest
+
+import numpy
+
+import sm.shakemap
+from sm.server import Server
+from sm.shakemap import event_shakemap, shakemap_basename
+from sm.tests.util import TemporaryDirectoryTestCase, add_event
+
+
+class EventShakeMapTest(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        TemporaryDirectoryTestCase.setUp(self)
+        self.mirror = self.path('mirror')
+        add_event(self.mirror, '2009-11-20_020304', ['AAAA', 'BBBB'], samples=300)
+        self.server = Server(self.path('cache'), mirror=self.mirror)
+        self.update()
+
+    def update(self):
+        # update_events prints its progress.
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            self.server.update_events()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    def test_saved(self):
+        event = self.server.get_events(2009, 11)[0][0]
+        shakemap = event_shakemap(self.server, event, spacing=0.05)
+        basename = shakemap_basename(self.server, event)
+        f = open(basename + '.json')
+        header = json.load(f)
+        f.close()
+        self.assertEqual((header['rows'], header['columns']), shakemap.values.shape)
+        values = numpy.fromfile(basename + '.f32', dtype='<f4')
+        numpy.testing.assert_array_equal(values, shakemap.values.ravel())
+        self.assertEqual(sorted(os.listdir(os.path.dirname(basename))),
+                         [os.path.basename(basename) + '.f32',
+                          os.path.basename(basename) + '.json'])
+
+    def test_concurrent(self):
+        # Several requests may save the same map at once, so save it again
+        # while the first save is writing its description. Both must succeed
+        # and leave a complete map and no temporary files.
+        event = self.server.get_events(2009, 11)[0][0]
+        dump = json.dump
+        def nested(*args, **kwargs):
+            sm.shakemap.json.dump = dump
+            event_shakemap(self.server, event, spacing=0.05)
+            dump(*args, **kwargs)
+        sm.shakemap.json.dump = nested
+        try:
+            shakemap = event_shakemap(self.server, event, spacing=0.05)
+        finally:
+            sm.shakemap.json.dump = dump
+        basename = shakemap_basename(self.server, event)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(basename))),
+                         [os.path.basename(basename) + '.f32',
+                          os.path.basename(basename) + '.json'])
+        values = numpy.fromfile(basename + '.f32', dtype='<f4')
+        numpy.testing.assert_array_equal(values, shakemap.values.ravel())
+
+    def test_generation(self):
+        # Updating the events renumbers them, so an existing map must not be
+        # reused for whichever event now has its ID.
+        event = self.server.get_events(2009, 11)[0][0]
+        old = shakemap_basename(self.server, event)
+        event_shakemap(self.server, event, spacing=0.05)
+        add_event(self.mirror, '2009-11-05_101010', ['CCCC'], samples=300, seed=1)
+        self.update()
+        for event, date in self.server.get_events(2009, 11):
+            self.assertNotEqual(shakemap_basename(self.server, event), old)
+
+        # Maps of the old generation are removed once a new one is saved.
+        event_shakemap(self.server, event, spacing=0.05)
+        self.assertTrue(os.path.isfile(shakemap_basename(self.server, event) + '.f32'))
+        self.assertFalse(os.path.exists(os.path.dirname(old)))
+
+
+if __name__ == '__main__':
+    unittest.main()
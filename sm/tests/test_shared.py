@@ -0,0 +1,138 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing
+import os
+import os.path
+import unittest
+
+import numpy
+import pytz
+
+from sm.record import Record
+from sm.shared import _HEADER, _METADATA, SharedRecord, share
+from sm.tests.util import TemporaryDirectoryTestCase, write_record
+
+
+def peak(handle):
+    """Open a shared record in a worker process and find its peak
+    acceleration, releasing it afterwards.
+
+    """
+    with handle.open() as record:
+        return abs(record.acceleration).max(axis=-1).tolist()
+
+
+def churn(handle, times=1000):
+    """Repeatedly add and release a reference to a segment."""
+    for i in range(times):
+        handle.retain()
+        handle.release()
+
+
+def references(handle):
+    """Read the reference count of a segment."""
+    f = open(handle.path, 'rb')
+    count, length = _HEADER.unpack(f.read(_HEADER.size))
+    f.close()
+    return count
+
+
+class SharedRecordTest(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        TemporaryDirectoryTestCase.setUp(self)
+        filename = self.path('record.V1A')
+        write_record(filename, numpy.random.RandomState(0).randn(3, 500) * 0.1)
+        self.record = Record({}, filename, pytz.timezone('NZ'))
+        self.handles = []
+
+    def tearDown(self):
+        for handle in self.handles:
+            if os.path.exists(handle.path):
+                os.remove(handle.path)
+        TemporaryDirectoryTestCase.tearDown(self)
+
+    def share(self, record, references=1):
+        handle = share(record, references)
+        self.handles.append(handle)
+        return handle
+
+    def check(self, shared, record):
+        for name in _METADATA:
+            self.assertEqual(getattr(shared, name), getattr(record, name))
+        numpy.testing.assert_array_equal(shared.acceleration, record.acceleration)
+        numpy.testing.assert_array_equal(shared.time, record.time)
+
+    def test_round_trip(self):
+        handle = self.share(self.record)
+        if os.path.isdir('/dev/shm'):
+            self.assertEqual(os.path.dirname(handle.path), '/dev/shm')
+        with handle.open() as shared:
+            self.assertIsInstance(shared, SharedRecord)
+            self.check(shared, self.record)
+            self.assertFalse(shared.acceleration.flags.writeable)
+
+            # A shared record can be shared again.
+            again = self.share(shared)
+            with again.open() as copy:
+                self.check(copy, self.record)
+        self.assertIsNone(shared.acceleration)
+        self.assertFalse(os.path.exists(handle.path))
+        self.assertFalse(os.path.exists(again.path))
+
+    def test_references(self):
+        handle = self.share(self.record, references=3)
+        self.assertEqual(references(handle), 3)
+        handle.retain(2)
+        self.assertEqual(references(handle), 5)
+        for remaining in (4, 3, 2, 1):
+            handle.release()
+            self.assertEqual(references(handle), remaining)
+        handle.open().release()
+        self.assertFalse(os.path.exists(handle.path))
+
+    def test_child_processes(self):
+        # The handle is pickled to each worker, which opens it and releases it.
+        # The last one to do so removes the segment.
+        handle = self.share(self.record, references=4)
+        self.assertEqual(repr(handle), 'RecordHandle({0!r})'.format(handle.path))
+        pool = multiprocessing.Pool(2)
+        try:
+            results = pool.map(peak, [handle] * 4, 1)
+        finally:
+            pool.terminate()
+            pool.join()
+        expected = abs(self.record.acceleration).max(axis=-1).tolist()
+        self.assertEqual(results, [expected] * 4)
+        self.assertFalse(os.path.exists(handle.path))
+
+    def test_concurrent_references(self):
+        # The reference count is locked, so no changes are lost when several
+        # processes change it at once.
+        handle = self.share(self.record)
+        processes = [multiprocessing.Process(target=churn, args=(handle,))
+                     for i in range(8)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertEqual(references(handle), 1)
+        handle.release()
+        self.assertFalse(os.path.exists(handle.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,235 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import os
+import os.path
+import sys
+import unittest
+
+import numpy
+
+from sm.processing import next_fast_length
+from sm.server import Server
+from sm.similarity import SimilarityIndex, cross_correlate, record_features
+from sm.tests.util import TemporaryDirectoryTestCase, add_event, write_record
+
+
+class Accelerations(object):
+    """Stand-in for a record, holding just what
+    :func:`sm.similarity.record_features` uses.
+
+    """
+
+    def __init__(self, acceleration, timestep):
+        self.acceleration = acceleration
+        self.timestep = timestep
+
+
+def smooth_signal(timestep, samples, frequencies):
+    """Three axes of sinusoids under a Hann window, so the signal and its
+    zero padding join smoothly.
+
+    """
+    t = numpy.arange(samples) * timestep
+    window = numpy.hanning(samples)
+    return t, numpy.array([window * sum(math.cos(axis + 1) * numpy.sin(
+        2 * numpy.pi * f * t + axis) for f in frequencies) for axis in range(3)])
+
+
+class RecordFeaturesTest(unittest.TestCase):
+
+    def test_spectrum_against_loop(self):
+        rng = numpy.random.RandomState(0)
+        record = Accelerations(rng.randn(3, 1500), 0.01)
+        waveform, levels = record_features(record, bands=12,
+                                           band_range=(0.2, 20.0))
+
+        # The energy of the horizontal axes in each band, bin by bin.
+        data = record.acceleration - record.acceleration.mean(axis=1)[:, numpy.newaxis]
+        nfft = next_fast_length(1500)
+        spectrum = numpy.fft.rfft(data, nfft)
+        edges = [10**(math.log10(0.2) + i * 2.0 / 12) for i in range(13)]
+        energy = []
+        for low, high in zip(edges[:-1], edges[1:]):
+            total = 0.0
+            for k in range(spectrum.shape[1]):
+                if low <= k / (nfft * 0.01) < high:
+                    total += abs(spectrum[0, k])**2 + abs(spectrum[1, k])**2
+            energy.append(total)
+        expected = [math.log10(e + 1e-12 * max(energy)) for e in energy]
+        mean = sum(expected) / len(expected)
+        expected = [e - mean for e in expected]
+        norm = math.sqrt(sum(e * e for e in expected))
+        numpy.testing.assert_allclose(levels, [e / norm for e in expected],
+                                      rtol=1e-10, atol=1e-12)
+        self.assertEqual(waveform.shape, (3, 2048))
+
+    def test_same_rate(self):
+        # At the waveform's own rate, a signal well below the tapered part of
+        # the spectrum is only normalised.
+        t, signal = smooth_signal(0.05, 1000, [0.5, 1.3])
+        waveform, levels = record_features(Accelerations(signal, 0.05))
+        expected = signal - signal.mean(axis=1)[:, numpy.newaxis]
+        expected /= numpy.sqrt((expected**2).sum())
+        numpy.testing.assert_allclose(waveform[:, :1000], expected, atol=1e-6)
+        self.assertTrue((waveform[:, 1000:] == 0).all())
+
+    def test_resampled(self):
+        # Resampling from 100 Hz to 20 Hz gives the signal at the new rate.
+        t, signal = smooth_signal(0.01, 3000, [0.7, 2.1])
+        waveform, levels = record_features(Accelerations(signal, 0.01))
+        expected = signal[:, ::5] - signal.mean(axis=1)[:, numpy.newaxis]
+        expected /= numpy.sqrt((expected**2).sum())
+        numpy.testing.assert_allclose(waveform[:, :600], expected, atol=1e-4)
+        self.assertAlmostEqual((waveform**2).sum(), 1)
+
+
+class CrossCorrelateTest(unittest.TestCase):
+
+    def test_against_loop(self):
+        rng = numpy.random.RandomState(1)
+        length = 50
+        query = rng.randn(3, length)
+        candidates = rng.randn(4, 3, length)
+        candidates[2] = numpy.roll(query, 7, axis=1)
+        candidates[2][:, :7] = 0
+        coefficients, lags = cross_correlate(query, candidates)
+        for c, candidate in enumerate(candidates):
+            # The correlation at each lag, with the candidate delayed by the
+            # lag relative to the query.
+            best = None
+            for lag in range(-(length - 1), length):
+                total = 0.0
+                for axis in range(3):
+                    for t in range(length):
+                        if 0 <= t + lag < length:
+                            total += query[axis, t] * candidate[axis, t + lag]
+                if best is None or total > best[0]:
+                    best = (total, lag)
+            self.assertAlmostEqual(coefficients[c], best[0], 10)
+            self.assertEqual(lags[c], best[1])
+        self.assertEqual(lags[2], 7)
+
+
+class SimilarityIndexTest(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        TemporaryDirectoryTestCase.setUp(self)
+        self.mirror = self.path('mirror')
+
+        # Two events of random records, one of which has a record which is a
+        # copy of another delayed by 0.2 seconds.
+        data_dir = add_event(self.mirror, '2009-11-20_020304', ['BBBB'],
+                             samples=1000)
+        rng = numpy.random.RandomState(2)
+        acceleration = rng.randn(3, 1000) * 0.1
+        write_record(os.path.join(data_dir, '20091120_020304_AAAA.V1A'),
+                     acceleration)
+        delayed = numpy.zeros((3, 1000))
+        delayed[:, 40:] = acceleration[:, :-40]
+        write_record(os.path.join(data_dir, '20091120_020304_CCCC.V1A'),
+                     delayed)
+        add_event(self.mirror, '2009-12-01_121212', ['AAAA', 'DDDD'],
+                  samples=1000, seed=3)
+
+        self.server = Server(self.path('cache'), mirror=self.mirror)
+        self.update_events()
+        self.index = SimilarityIndex(self.path('index'))
+
+    def update_events(self):
+        # update_events prints its progress.
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            self.server.update_events()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    def event(self, month):
+        return self.server.get_events(2009, month)[0][0]
+
+    def test_similar(self):
+        self.assertEqual(self.index.update(self.server), 0)
+        self.assertEqual(self.index.update(self.server, download=True), 5)
+        self.assertEqual(self.index.update(self.server), 0)
+        self.assertEqual(len(self.index), 5)
+
+        results = self.index.similar(self.event(11), 'AAAA', k=2)
+        self.assertEqual(len(results), 2)
+        event, site, coefficient, lag = results[0]
+        self.assertEqual((event, site), (self.event(11), 'CCCC'))
+        self.assertTrue(coefficient > 0.95)
+        self.assertAlmostEqual(lag, 0.2)
+        self.assertTrue(results[1][2] < 0.5)
+        self.assertEqual(self.index.similar(self.event(11), 'AAAA',
+                                            sites=['DDDD'])[0][:2],
+                         (self.event(12), 'DDDD'))
+        self.assertRaises(KeyError, self.index.similar, 1000, 'AAAA')
+
+    def test_renumbered(self):
+        self.index.update(self.server, download=True)
+        old = self.index.keys()
+
+        # An earlier event renumbers the others, and the index follows.
+        add_event(self.mirror, '2009-11-05_101010', ['EEEE'], samples=1000,
+                  seed=4)
+        self.update_events()
+        self.assertRaises(KeyError, self.index.similar, self.event(11), 'EEEE',
+                          server=self.server)
+        self.assertEqual(self.index.update(self.server, download=True), 6)
+        self.assertEqual(len(self.index), 6)
+        self.assertTrue(set(old).isdisjoint(self.index.keys()))
+        event = self.server.get_events(2009, 11)[1][0]
+        results = self.index.similar(event, 'AAAA', k=1, server=self.server)
+        self.assertEqual(results[0][:2], (event, 'CCCC'))
+
+    def test_stale_entries(self):
+        self.index.update(self.server, download=True)
+        event = self.event(11)
+
+        # Make the entries of the November event look like they are of another
+        # event, as they would be if its ID had been reused.
+        self.index.index.execute('''update records set
+                                 filename='20091105_101010_' || site || '.V1A'
+                                 where event_id=?;''', (event,))
+        self.index.index.commit()
+        self.assertRaises(KeyError, self.index.similar, event, 'AAAA',
+                          server=self.server)
+        results = self.index.similar(self.event(12), 'AAAA', server=self.server)
+        self.assertEqual([r[:2] for r in results], [(self.event(12), 'DDDD')])
+
+        # Updating replaces them in their rows.
+        self.assertEqual(self.index.update(self.server), 3)
+        self.assertEqual(len(self.index), 5)
+        self.assertEqual(self.index._rows(), 5)
+        self.assertEqual(self.index.similar(event, 'AAAA', k=1,
+                                            server=self.server)[0][:2],
+                         (event, 'CCCC'))
+
+        # An entry whose record is gone is dropped.
+        os.remove(os.path.join(self.server.cache_dir,
+                               self.server.get_record_filename(event, 'BBBB')))
+        self.index.index.execute('''update records set filename='' where
+                                 event_id=? and site='BBBB';''', (event,))
+        self.index.index.commit()
+        self.assertEqual(self.index.update(self.server), 0)
+        self.assertFalse((event, 'BBBB') in self.index)
+        self.assertEqual(len(self.index.similar(event, 'AAAA')), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
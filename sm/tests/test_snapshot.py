@@ -0,0 +1,97 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import os.path
+import sys
+import unittest
+
+import numpy
+
+from sm.batch import all_records
+from sm.server import Server
+from sm.shakemap import event_shakemap, shakemap_basename
+from sm.snapshot import BadSnapshot
+from sm.tests.util import TemporaryDirectoryTestCase, add_event
+
+
+class SnapshotTest(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        TemporaryDirectoryTestCase.setUp(self)
+        self.mirror = self.path('mirror')
+        add_event(self.mirror, '2009-11-20_020304', ['AAAA', 'BBBB'], samples=300)
+        self.source = self.update(Server(self.path('source'), mirror=self.mirror))
+
+    def update(self, server):
+        # update_events prints its progress.
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            server.update_events()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        return server
+
+    def test_round_trip(self):
+        for event, site in all_records(self.source):
+            self.source.get_record(event, site)
+        filename = self.path('snapshot.tar.gz')
+        self.source.export_snapshot(filename)
+
+        destination = Server(self.path('destination'))
+        manifest = destination.import_snapshot(filename)
+        self.assertEqual(len(manifest['files']), 3)
+        self.assertEqual(all_records(destination), all_records(self.source))
+        for event, site in all_records(destination):
+            numpy.testing.assert_array_equal(
+                destination.get_record(event, site).acceleration,
+                self.source.get_record(event, site).acceleration)
+
+    def test_shakemaps_removed(self):
+        filename = self.path('snapshot.tar')
+        self.source.export_snapshot(filename, compress=False)
+
+        # A cache whose events have different IDs to those in the snapshot.
+        add_event(self.mirror, '2009-11-05_101010', ['CCCC'], samples=300, seed=1)
+        destination = self.update(Server(self.path('destination'),
+                                         mirror=self.mirror))
+        event = destination.get_events(2009, 11)[0][0]
+        event_shakemap(destination, event, spacing=0.05)
+        basename = shakemap_basename(destination, event)
+        self.assertTrue(os.path.isfile(basename + '.f32'))
+
+        destination.import_snapshot(filename)
+        self.assertFalse(os.path.exists(self.path('destination', 'shakemaps')))
+
+    def test_bad_snapshot(self):
+        filename = self.path('snapshot.tar')
+        self.source.export_snapshot(filename, compress=False)
+        # Overwrite part of the info cache, which is the last file before the
+        # manifest and the padding at the end of the tar file.
+        f = open(filename, 'r+b')
+        f.seek(-1024 * 12, os.SEEK_END)
+        f.write('x' * 1024)
+        f.close()
+        destination = self.update(Server(self.path('destination'),
+                                         mirror=self.mirror))
+        before = all_records(destination)
+        self.assertRaises(BadSnapshot, destination.import_snapshot, filename)
+        self.assertEqual(all_records(destination), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import unittest
+
+import numpy
+import pytz
+
+from sm.record import Record
+from sm.spectra import acceleration_spectra, response_spectra
+from sm.tests.util import TemporaryDirectoryTestCase, write_record
+
+
+def reference_peak(acceleration, timestep, period, damping):
+    """The peak relative displacement of a single oscillator, found by fourth
+    order Runge-Kutta integration with the input varying linearly between
+    samples and at least 200 steps per period. Like the recurrence, the peak is
+    taken at the samples.
+
+    """
+    omega = 2 * math.pi / period
+    substeps = max(4, int(math.ceil(200 * timestep / period)))
+    h = timestep / substeps
+    x = v = peak = 0.0
+    for i in range(len(acceleration) - 1):
+        a0 = acceleration[i]
+        slope = (acceleration[i + 1] - a0) / timestep
+
+        def derivative(t, x, v):
+            return v, -(a0 + slope * t) - 2 * damping * omega * v - omega**2 * x
+
+        for k in range(substeps):
+            t = k * h
+            k1x, k1v = derivative(t, x, v)
+            k2x, k2v = derivative(t + h / 2, x + h / 2 * k1x, v + h / 2 * k1v)
+            k3x, k3v = derivative(t + h / 2, x + h / 2 * k2x, v + h / 2 * k2v)
+            k4x, k4v = derivative(t + h, x + h * k3x, v + h * k3v)
+            x += h / 6 * (k1x + 2 * k2x + 2 * k3x + k4x)
+            v += h / 6 * (k1v + 2 * k2v + 2 * k3v + k4v)
+        peak = max(peak, abs(x))
+    return peak
+
+
+def ground_motion(samples, seed):
+    """A random but smooth two axis acceleration history."""
+    rng = numpy.random.RandomState(seed)
+    return numpy.array([numpy.convolve(rng.randn(samples), numpy.hanning(7),
+                                       'same') for axis in range(2)])
+
+
+class AccelerationSpectraTest(unittest.TestCase):
+
+    periods = numpy.array([0.05, 0.2, 1.0, 3.0])
+    damping = numpy.array([0.0, 0.02, 0.05, 0.2])
+
+    def test_against_reference(self):
+        acceleration = ground_motion(300, 0)
+        timestep = 0.01
+        sd, psv, psa = acceleration_spectra([acceleration], [timestep],
+                                            self.periods, self.damping)
+        self.assertEqual(sd.shape, (1, 2, 4, 4))
+        for axis in range(2):
+            for i, period in enumerate(self.periods):
+                for j, damping in enumerate(self.damping):
+                    expected = reference_peak(acceleration[axis], timestep,
+                                              period, damping)
+                    self.assertAlmostEqual(sd[0, axis, i, j] / expected, 1, 5)
+
+    def test_pseudo_values(self):
+        sd, psv, psa = acceleration_spectra([ground_motion(200, 1)], [0.005],
+                                            self.periods)
+        omega = 2 * numpy.pi / self.periods
+        numpy.testing.assert_allclose(psv, sd * omega)
+        numpy.testing.assert_allclose(psa, sd * omega**2)
+
+    def test_zero_period(self):
+        acceleration = ground_motion(200, 2)
+        sd, psv, psa = acceleration_spectra([acceleration], [0.01], [0.0, 1.0])
+        numpy.testing.assert_allclose(psa[0, :, 0], abs(acceleration).max(axis=1))
+        self.assertTrue((sd[:, :, 0] == 0).all())
+        self.assertTrue((psv[:, :, 0] == 0).all())
+
+    def test_batch_matches_individual(self):
+        accelerations = [ground_motion(n, n) for n in (150, 400, 250)]
+        timesteps = [0.01, 0.005, 0.02]
+        batch = acceleration_spectra(accelerations, timesteps, self.periods,
+                                     self.damping)
+        for k, (acceleration, timestep) in enumerate(zip(accelerations,
+                                                         timesteps)):
+            single = acceleration_spectra([acceleration], [timestep],
+                                          self.periods, self.damping)
+            for b, s in zip(batch, single):
+                numpy.testing.assert_allclose(b[k], s[0], rtol=1e-12)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, acceleration_spectra,
+                          [ground_motion(10, 0)], [0.01], [-1.0])
+        self.assertRaises(ValueError, acceleration_spectra,
+                          [ground_motion(10, 0)], [0.01], [1.0], 1.0)
+
+
+class RecordSpectraTest(TemporaryDirectoryTestCase):
+
+    def test_record(self):
+        rng = numpy.random.RandomState(3)
+        filename = self.path('record.V1A')
+        write_record(filename, rng.randn(3, 300) * 0.1, timestep=0.01)
+        record = Record({}, filename, pytz.utc)
+        periods = [0.1, 0.5, 2.0]
+        sd, psv, psa = record.response_spectrum(periods)
+        self.assertEqual(sd.shape, (3, 3))
+        for axis in range(3):
+            for i, period in enumerate(periods):
+                expected = reference_peak(record.acceleration[axis], 0.01,
+                                          period, 0.05)
+                self.assertAlmostEqual(sd[axis, i] / expected, 1, 5)
+        batch = response_spectra([record, record], periods)
+        numpy.testing.assert_allclose(batch[2][1], psa)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import datetime, timedelta
+import os
+import sys
+import unittest
+
+import numpy
+import pytz
+
+from sm.server import NoSuchRecord, Server
+from sm.stack import synchronise
+from sm.tests.util import TemporaryDirectoryTestCase, add_event, component
+
+
+class Accelerations(object):
+    """Stand-in for a record, holding just what :func:`sm.stack.synchronise`
+    uses.
+
+    """
+
+    def __init__(self, acceleration, timestep, start):
+        self.acceleration = acceleration
+        self.timestep = timestep
+        self.start = start
+
+
+def seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+class SynchroniseTest(unittest.TestCase):
+
+    def setUp(self):
+        # Records of different lengths and timesteps, starting at different
+        # times.
+        rng = numpy.random.RandomState(0)
+        base = datetime(2009, 11, 21, 23, 51, 42, tzinfo=pytz.utc)
+        self.records = [
+            Accelerations(rng.randn(3, 400), 0.01, base + timedelta(seconds=1.5)),
+            Accelerations(rng.randn(3, 300), 0.005, base),
+            Accelerations(rng.randn(3, 120), 0.02, base + timedelta(seconds=0.73)),
+        ]
+
+    def check(self, start, timestep, data, points):
+        """Compare the result with each record and axis interpolated on its
+        own.
+
+        """
+        self.assertEqual(data.shape, (len(self.records), 3, points))
+        for record, result in zip(self.records, data):
+            times = (seconds(start - record.start) +
+                     numpy.arange(points) * timestep)
+            for axis in range(3):
+                samples = numpy.arange(record.acceleration.shape[1]) * record.timestep
+                expected = numpy.interp(times, samples, record.acceleration[axis],
+                                        left=numpy.nan, right=numpy.nan)
+                numpy.testing.assert_array_equal(numpy.isnan(result[axis]),
+                                                 numpy.isnan(expected))
+                valid = ~numpy.isnan(expected)
+                numpy.testing.assert_allclose(result[axis][valid],
+                                              expected[valid], rtol=1e-9,
+                                              atol=1e-12)
+
+    def test_whole(self):
+        start, timestep, data = synchronise(self.records)
+        self.assertEqual(start, self.records[1].start)
+        self.assertEqual(timestep, 0.005)
+
+        # The grid runs to the end of the record which ends last.
+        self.check(start, timestep, data, 1099)
+        self.assertFalse(numpy.isnan(data[0, :, -1]).any())
+        self.assertTrue(numpy.isnan(data[1, :, -1]).all())
+
+    def test_window(self):
+        window = (self.records[1].start + timedelta(seconds=1.0),
+                  self.records[1].start + timedelta(seconds=3.0))
+        start, timestep, data = synchronise(self.records, 0.0125, window)
+        self.assertEqual(start, window[0])
+        self.assertEqual(timestep, 0.0125)
+        self.check(start, timestep, data, 161)
+
+    def test_window_outside(self):
+        # A window extending beyond every record is NaN at both ends.
+        window = (self.records[1].start - timedelta(seconds=1),
+                  self.records[1].start + timedelta(seconds=7))
+        start, timestep, data = synchronise(self.records, 0.05, window)
+        self.check(start, timestep, data, 161)
+        self.assertTrue(numpy.isnan(data[:, :, 0]).all())
+        self.assertTrue(numpy.isnan(data[:, :, -1]).all())
+
+
+class EventStackTest(TemporaryDirectoryTestCase):
+
+    def test_event_stack(self):
+        mirror = self.path('mirror')
+        data_dir = add_event(mirror, '2009-11-20_020304', ['AAAA', 'BBBB'],
+                             samples=300)
+
+        # A record cut off part way through its first header.
+        f = open(os.path.join(data_dir, '20091120_020304_CCCC.V1A'), 'w')
+        f.write(''.join(component(0, numpy.zeros(300)).splitlines(True)[:17]))
+        f.close()
+
+        server = Server(self.path('cache'), mirror=mirror)
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            server.update_events()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        event = server.get_events(2009, 11)[0][0]
+
+        sites, start, timestep, data = server.get_event_stack(event)
+        self.assertEqual(sites, ['AAAA', 'BBBB'])
+        self.assertEqual(data.shape, (2, 3, 300))
+        for i, site in enumerate(sites):
+            numpy.testing.assert_allclose(data[i],
+                                          server.get_record(event, site).acceleration)
+        self.assertRaises(NoSuchRecord, server.get_event_stack, event,
+                          ['AAAA', 'ZZZZ'])
+        self.assertRaises(NoSuchRecord, server.get_event_stack, event, ['CCCC'])
+
+
+if __name__ == '__main__':
+    unittest.main()
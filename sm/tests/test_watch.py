@@ -0,0 +1,111 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+import ftplib
+import os
+import shutil
+import sys
+import unittest
+
+from sm.server import Server
+from sm.tests.util import TemporaryDirectoryTestCase, add_event
+from sm.watch import Watcher
+
+
+class WatcherTest(TemporaryDirectoryTestCase):
+
+    def setUp(self):
+        TemporaryDirectoryTestCase.setUp(self)
+        self.mirror = self.path('mirror')
+        self.cache = self.path('cache')
+        self.sites = ['AAAA', 'BBBB', 'CCCC']
+        for i, name in enumerate(['2009-11-05_101010', '2009-11-20_020304',
+                                  '2009-12-01_121212', '2009-12-24_235959']):
+            add_event(self.mirror, name, self.sites, samples=500, seed=i)
+
+        # The watcher and update_events print their progress.
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        TemporaryDirectoryTestCase.tearDown(self)
+
+    def server(self):
+        return Server(self.cache, mirror=self.mirror)
+
+    def counts(self):
+        server = self.server()
+        return [server.info_cache.execute('select count(*) from {0};'.format(
+            table)).fetchone()[0] for table in ('events', 'records')]
+
+    def watcher(self):
+        return Watcher(self.cache, mirror=self.mirror, downloaders=2, parsers=1)
+
+    def test_new_events(self):
+        watcher = self.watcher()
+        self.assertEqual(watcher.poll(), 12)
+        self.assertEqual(self.counts(), [4, 12])
+        self.assertEqual(watcher.poll(), 0)
+
+        add_event(self.mirror, '2009-12-30_010203', self.sites[:2])
+        generation = self.server().get_generation()
+        self.assertEqual(watcher.poll(), 2)
+        self.assertEqual(self.counts(), [5, 14])
+        self.assertEqual(self.server().get_generation(), generation + 1)
+
+    def test_after_update_events(self):
+        self.server().update_events()
+        self.assertEqual(self.counts(), [4, 12])
+        generation = self.server().get_generation()
+
+        # The events are reused rather than added again.
+        watcher = self.watcher()
+        self.assertEqual(watcher.poll(), 12)
+        self.assertEqual(self.counts(), [4, 12])
+        server = self.server()
+        for month in (11, 12):
+            events = [event for event, date in server.get_events(2009, month)]
+            self.assertEqual(len(events), 2)
+            self.assertEqual(len(set(events)), 2)
+        self.assertEqual(server.get_generation(), generation)
+
+        # And their records are only processed once.
+        self.assertEqual(watcher.poll(), 0)
+        summaries = server.info_cache.execute(
+            'select count(*) from summaries;').fetchone()[0]
+        self.assertEqual(summaries, 12)
+
+    def test_failed_event_rolled_back(self):
+        watcher = self.watcher()
+        watcher.poll()
+        generation = self.server().get_generation()
+
+        # An event directory without any data makes adding it fail after the
+        # event has been inserted.
+        os.makedirs(os.path.join(self.mirror, 'strong/processed/Proc/2009/12_Prelim',
+                                 '2009-12-31_000000'))
+        self.assertRaises(ftplib.error_perm, watcher.poll)
+        self.assertEqual(self.counts(), [4, 12])
+        self.assertEqual(self.server().get_generation(), generation)
+
+        shutil.rmtree(os.path.join(self.mirror, 'strong/processed/Proc/2009/12_Prelim',
+                                   '2009-12-31_000000'))
+        self.assertEqual(watcher.poll(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
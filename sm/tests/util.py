@@ -0,0 +1,112 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Helpers for the tests: synthetic data files and local mirrors of the GeoNet
+FTP tree.
+
+"""
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+# The base directory of the processed data on the FTP server.
+BASE_DIR = 'strong/processed/Proc'
+
+
+def component(axis, acceleration, timestep=0.005, digitised=None):
+    """Create the text of one component of a Volume 1 data file, which holds
+    accelerations only.
+
+    :param axis: The axis of the component in degrees, or 999 for vertical.
+    :param acceleration: The accelerations in m/s/s.
+    :param timestep: The time between samples.
+    :param digitised: The number of digitised samples to give in the header.
+                      If None, the number of accelerations is used.
+
+    """
+    samples = len(acceleration)
+    if digitised is None:
+        digitised = samples
+    lines = ['Synthetic record for testing\n'] * 16
+    lines.append('2009   11   21   23   51  420    0    0 2009   11\n')
+    lines.append('  43   35    0  172   41    0    5    5   21   23\n')
+    lines.append('  43   30    0  172   38    0    0 {0:4d}  100   10\n'.format(axis))
+    lines.append('{0:6d}    0    0 {1:6d}    0    0    0    0   51 30500\n'.format(
+        digitised, samples))
+    lines.append(' 0.0' * 10 + '\n')
+    lines.append(' 0.0 0.0 0.0 0.0 6.3 0.0 6.2 0.0 0.0 0.0\n')
+    lines.append(' {0:.3f} 0.0 0.0 0.0 0.0 {1} 0.0 0.0 0.0 9810.0\n'.format(
+        samples * timestep, timestep))
+    lines.extend([' 0.0' * 10 + '\n'] * 3)
+    values = numpy.asarray(acceleration) * 1000
+    for i in range(0, samples, 10):
+        lines.append(''.join('{0:8.1f}'.format(v) for v in values[i:i + 10]) + '\n')
+    return ''.join(lines)
+
+
+def write_record(filename, acceleration, timestep=0.005, digitised=None):
+    """Write a Volume 1 data file holding north, east and vertical components.
+
+    :param acceleration: The accelerations in m/s/s, indexed by axis and then
+                         sample.
+    :param digitised: The number of digitised samples to give in the header of
+                      each component, or None to use the number of samples.
+
+    """
+    if digitised is None:
+        digitised = [None] * 3
+    f = open(filename, 'w')
+    try:
+        for axis, values, count in zip((0, 90, 999), acceleration, digitised):
+            f.write(component(axis, values, timestep, count))
+    finally:
+        f.close()
+
+
+def add_event(root, name, sites, samples=2000, seed=0):
+    """Add an event to a local mirror of the FTP tree, with a record of random
+    accelerations from each of the given sites. The name is the event
+    directory name, in the form YYYY-MM-DD_HHMMSS.
+
+    """
+    rng = numpy.random.RandomState(seed)
+    data_dir = os.path.join(root, BASE_DIR, name[:4],
+                            '{0}_Prelim'.format(name[5:7]), name, 'Vol1', 'data')
+    os.makedirs(data_dir)
+    prefix = name.replace('-', '')[:8] + name[10:] + '_'
+    for site in sites:
+        write_record(os.path.join(data_dir, prefix + site + '.V1A'),
+                     rng.randn(3, samples) * 0.1)
+    return data_dir
+
+
+class TemporaryDirectoryTestCase(unittest.TestCase):
+    """Test case with a temporary directory, removed after each test.
+
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='sm-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def path(self, *parts):
+        return os.path.join(self.directory, *parts)
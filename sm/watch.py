@@ -0,0 +1,336 @@
+# This file is part of geomotion, a library to work with strong motion data from
+# the GeoNet project.  Copyright (C) 2011 Blair Bonnett
+#
+# geomotion is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# geomotion is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# geomotion.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Continuously ingest new events as they appear on the GeoNet server.
+
+New events are added to the directory of the current month, so rather than
+crawling the whole archive with :meth:`Server.update_events`, a
+:class:`Watcher` polls only the newest few month directories. Each new event
+and its records flow through a pipeline of four stages:
+
+    1. Listing - find event directories which have not been seen before, and
+       add the events and their records to the info cache. Events which were
+       already added by :meth:`Server.update_events` are reused.
+    2. Download - fetch the data files into the cache.
+    3. Parse - parse the data files into records.
+    4. Indexing - calculate the intensity measures of each record and store
+       them in the ``summaries`` table of the info cache, then pass the record
+       to an optional callback.
+
+The stages are connected by bounded queues and each has its own number of
+worker threads, so a slow stage holds up the ones before it rather than
+letting work pile up in memory. Each worker has its own :class:`Server`
+instance, as SQLite connections and FTP connections cannot be shared.
+
+Progress is kept in the info cache. The ``watched`` table holds the data
+directories of the events which have been listed, and a record is finished
+once it has a row in the ``summaries`` table. At the start of each poll, any
+record in a listed directory without a summary is fed back into the pipeline,
+so a watcher which is stopped or crashes resumes where it left off, and
+records which failed to download are retried.
+
+"""
+
+import Queue
+import sys
+import threading
+import time
+import traceback
+
+import pytz
+
+from sm.server import Server
+
+# Marks the end of the work in a queue.
+_DONE = object()
+
+# The base directory of the processed data on the FTP server.
+_BASE_DIR = '/strong/processed/Proc'
+
+
+class Watcher(object):
+    """Poll the GeoNet server for new events and process their records. See
+    the module documentation for details.
+
+    """
+
+    def __init__(self, cache_dir='cache', local_timezone=pytz.timezone('NZ'),
+                 mirror=None, months=2, downloaders=4, parsers=2,
+                 queue_size=32, callback=None):
+        """
+
+        :param cache_dir: The directory of the cache to add to.
+        :type cache_dir: string
+        :param local_timezone: The timezone to give the records.
+        :type local_timezone: pytz.timezone
+        :param mirror: A local copy of the GeoNet FTP tree to read from instead
+                       of the FTP server.
+        :type mirror: string
+        :param months: The number of the newest month directories to poll.
+                       Two (the current and previous months) allows for events
+                       added to a month just after it ends.
+        :type months: integer
+        :param downloaders: The number of threads downloading data files.
+        :type downloaders: integer
+        :param parsers: The number of threads parsing data files.
+        :type parsers: integer
+        :param queue_size: The largest number of items waiting between any
+                           two stages.
+        :type queue_size: integer
+        :param callback: A function to call with the event ID, site code and
+                         :class:`Record` of every new record, after its
+                         summary has been stored. It is called from a single
+                         thread.
+        :type callback: function
+
+        """
+        self.cache_dir = cache_dir
+        self.local_timezone = local_timezone
+        self.mirror = mirror
+        self.months = months
+        self.downloaders = downloaders
+        self.parsers = parsers
+        self.queue_size = queue_size
+        self.callback = callback
+
+        # Create the tables we need.
+        server = self._server()
+        cursor = server.info_cache.cursor()
+        server._create_event_tables(cursor)
+        cursor.execute('''create table if not exists watched (directory
+                       varchar primary key not null, event_id integer not
+                       null);''')
+        cursor.execute('''create table if not exists summaries (
+            event_id integer not null,
+            site varchar not null,
+            pga float,
+            pgv float,
+            pgd float,
+            arias float,
+            cav float,
+            d5_95 float,
+            primary key (event_id, site),
+            foreign key(event_id) references events(id) on delete cascade);''')
+        cursor.execute('''create index if not exists records_ftp_directory on
+                       records (ftp_directory);''')
+        server.info_cache.commit()
+        cursor.close()
+
+    def _server(self):
+        """Helper function to create a server for a worker thread.
+
+        """
+        return Server(self.cache_dir, self.local_timezone, mirror=self.mirror)
+
+    def run(self, interval=300, polls=None):
+        """Poll for new events repeatedly, until interrupted.
+
+        :param interval: The time between the start of each poll in seconds.
+        :type interval: float
+        :param polls: Stop after this many polls. If None, keep going forever.
+        :type polls: integer
+
+        """
+        count = 0
+        while polls is None or count < polls:
+            start = time.time()
+            self.poll()
+            count += 1
+            if polls is None or count < polls:
+                time.sleep(max(0, interval - (time.time() - start)))
+
+    def poll(self):
+        """Check the newest month directories for new events once, and process
+        their records along with any left unfinished by an earlier poll. The
+        number of records processed is returned.
+
+        """
+        listed = Queue.Queue(self.queue_size)
+        downloaded = Queue.Queue(self.queue_size)
+        parsed = Queue.Queue(self.queue_size)
+        processed = [0]
+
+        # Start the consumers before the producer so the queues drain as they
+        # are filled.
+        stages = [
+            (self._stage(self._download, listed, downloaded, self.downloaders),
+             downloaded, self.parsers),
+            (self._stage(self._parse, downloaded, parsed, self.parsers),
+             parsed, 1),
+            (self._stage(self._index, parsed, None, 1, processed), None, 0),
+        ]
+
+        # The listing stage runs in this thread. Putting items in the first
+        # queue blocks while the downloaders are busy.
+        try:
+            self._list(listed)
+        finally:
+            # Shut each stage down once the one before it has finished.
+            for i in range(self.downloaders):
+                listed.put(_DONE)
+            for threads, outbox, consumers in stages:
+                for thread in threads:
+                    thread.join()
+                for i in range(consumers):
+                    outbox.put(_DONE)
+        return processed[0]
+
+    def _stage(self, func, inbox, outbox, workers, counter=None):
+        """Helper function to start the worker threads of a stage. Each worker
+        takes items from the inbox until it gets the end marker, calls the
+        function with its own server and the item, and puts the result (if not
+        None) in the outbox. Errors are reported and the item dropped; it will
+        be retried on the next poll.
+
+        """
+        def worker():
+            server = self._server()
+            while True:
+                item = inbox.get()
+                if item is _DONE:
+                    break
+                try:
+                    result = func(server, item)
+                except Exception:
+                    sys.stderr.write('Error processing {0}:\n{1}'.format(
+                        item[:2], traceback.format_exc()))
+                    continue
+                if result is not None and outbox is not None:
+                    outbox.put(result)
+                if counter is not None:
+                    counter[0] += 1
+
+        threads = [threading.Thread(target=worker) for i in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        return threads
+
+    def _list(self, outbox):
+        """The listing stage: queue the unfinished records from earlier polls,
+        then add any new events in the newest month directories and queue
+        their records.
+
+        """
+        server = self._server()
+        cursor = server.info_cache.cursor()
+
+        # Records which were listed but never finished.
+        cursor.execute('''select records.event_id, records.site from records
+                       join watched on records.ftp_directory=watched.directory
+                       left join summaries on
+                       summaries.event_id=records.event_id and
+                       summaries.site=records.site where summaries.event_id is
+                       null;''')
+        for row in cursor.fetchall():
+            outbox.put((row['event_id'], row['site']))
+
+        # Find the newest month directories. Looking in the last two years is
+        # enough for any sensible number of months around new year.
+        server.connect_ftp()
+        server._ftp('cwd', _BASE_DIR)
+        years = sorted(map(int, server._ftp('nlst')))[-2:]
+        months = []
+        for year in years:
+            server._ftp('cwd', '{0}/{1}'.format(_BASE_DIR, year))
+            months.extend('{0}/{1}/{2}'.format(_BASE_DIR, year, month) for
+                          month in sorted(server._ftp('nlst')) if
+                          month.endswith('_Prelim'))
+        months = months[-self.months:]
+
+        for month_dir in months:
+            server._ftp('cwd', month_dir)
+            for event in server._ftp('nlst'):
+                directory = month_dir + '/' + event + '/Vol1/data'
+                cursor.execute('select 1 from watched where directory=?;',
+                               (directory,))
+                if cursor.fetchone() is not None:
+                    continue
+
+                # The event may already have been added by update_events, in
+                # which case we just start watching it.
+                cursor.execute('''select event_id, site from records where
+                               ftp_directory=?;''', (directory,))
+                rows = cursor.fetchall()
+                if rows:
+                    event_id = rows[0]['event_id']
+                    sites = [row['site'] for row in rows]
+                    cursor.execute('''insert into watched (directory, event_id)
+                                   values (?, ?);''', (directory, event_id))
+                    server.info_cache.commit()
+                    for site in sites:
+                        outbox.put((event_id, site))
+                    continue
+
+                # Add the event and mark it as listed in one transaction, so it
+                # is never added twice.
+                try:
+                    event_id, sites = server._add_event(cursor, month_dir, event)
+                    cursor.execute('''insert into watched (directory, event_id)
+                                   values (?, ?);''', (directory, event_id))
+                    server._bump_generation(cursor, 'events')
+                except:
+                    server.info_cache.rollback()
+                    raise
+                server.info_cache.commit()
+                print 'New event {0} with {1} records'.format(event, len(sites))
+
+                for site in sites:
+                    outbox.put((event_id, site))
+        cursor.close()
+
+    def _download(self, server, item):
+        """The download stage.
+
+        """
+        event, site = item
+        server.fetch_record(event, site)
+        return item
+
+    def _parse(self, server, item):
+        """The parse stage. Records which cannot be parsed are passed on with
+        None in place of the record, so they are marked as finished.
+
+        """
+        from sm.record import TooFewComponents
+
+        event, site = item
+        try:
+            record = server.get_record(event, site)
+        except TooFewComponents:
+            record = None
+        return event, site, record
+
+    def _index(self, server, item):
+        """The indexing stage. The summary of each record is the larger value
+        of each intensity measure over the two horizontal axes.
+
+        """
+        from sm.intensity import MEASURES, acceleration_measures
+
+        event, site, record = item
+        values = [None] * len(MEASURES.names)
+        if record is not None:
+            measures = acceleration_measures([record.acceleration],
+                                             [record.timestep])[0]
+            values = [float(measures[name][:2].max()) for name in MEASURES.names]
+        server.info_cache.execute('''insert or replace into summaries (event_id,
+                                  site, {0}) values (?, ?, {1});'''.format(
+                                  ', '.join(MEASURES.names),
+                                  ', '.join('?' * len(MEASURES.names))),
+                                  [event, site] + values)
+        server.info_cache.commit()
+        if record is not None and self.callback is not None:
+            self.callback(event, site, record)
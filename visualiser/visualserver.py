@@ -16,22 +16,115 @@
 # You should have received a copy of the GNU General Public License along with
 # geomotion.  If not, see <http://www.gnu.org/licenses/>.
 
+import argparse
+import functools
+import os
 import os.path
-from wsgiref.simple_server import make_server
+import Queue
+import threading
+from wsgiref.simple_server import make_server, WSGIServer
 
 import sys
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../'))
 
 from wsgi import Application
 
+
+class PooledWSGIServer(WSGIServer):
+    """A WSGI server which hands each request to one of a fixed pool of worker
+    threads, so one slow request (such as a record being downloaded) does not
+    hold up the rest. As the threads live as long as the server, each keeps its
+    own sm.Server (and its SQLite and FTP connections) from one request to the
+    next.
+
+    """
+
+    def __init__(self, server_address, handler_class, threads=8):
+        WSGIServer.__init__(self, server_address, handler_class)
+
+        # Accepted requests wait here for a free worker. Once it is full, no
+        # more requests are accepted until a worker frees up.
+        self._requests = Queue.Queue(threads)
+        for i in range(threads):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def _work(self):
+        while True:
+            request, client_address = self._requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+# Parse the command line.
+parser = argparse.ArgumentParser(description='Serve the strong motion visualiser.')
+parser.add_argument('--host', default='localhost',
+                    help='the address to listen on (default: %(default)s)')
+parser.add_argument('--port', type=int, default=8080,
+                    help='the port to listen on (default: %(default)s)')
+parser.add_argument('--mode', choices=('single', 'threaded', 'prefork'),
+                    default='threaded',
+                    help='handle requests in a single thread, a pool of '
+                         'threads, or in several pre-forked processes '
+                         '(default: %(default)s)')
+parser.add_argument('--threads', type=int, default=8,
+                    help='the number of threads in threaded mode '
+                         '(default: %(default)s)')
+parser.add_argument('--workers', type=int, default=4,
+                    help='the number of processes in prefork mode '
+                         '(default: %(default)s)')
+parser.add_argument('--metrics', action='store_true',
+                    help='collect timings and counters and serve them at '
+                         '/metrics')
+args = parser.parse_args()
+
 cache_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
                           '../cache')
 
-server = make_server('localhost', 8080, Application(cache_path))
+# The application creates a separate sm.Server for each thread and process that
+# uses it, so it is safe to share between them.
+application = Application(cache_path, metrics=args.metrics)
+server_class = WSGIServer
+if args.mode == 'threaded':
+    server_class = functools.partial(PooledWSGIServer, threads=args.threads)
+server = make_server(args.host, args.port, application, server_class=server_class)
+
+# In prefork mode, the listening socket has been created so fork the workers
+# which all accept connections from it.
+children = []
+if args.mode == 'prefork':
+    for i in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            children = None
+            break
+        children.append(pid)
+
+if children is None:
+    # A worker process.
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    os._exit(0)
+
 print 'Starting server, use <Ctrl-C> to stop it.'
-print 'Open http://localhost:8080/ in your browser to access it.'
+print 'Open http://{0}:{1}/ in your browser to access it.'.format(args.host, args.port)
 try:
-    server.serve_forever()
+    if children:
+        # The parent just waits for the workers.
+        for pid in children:
+            os.waitpid(pid, 0)
+    else:
+        server.serve_forever()
 except KeyboardInterrupt:
     print
     print 'Stopping server.'
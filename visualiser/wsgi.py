@@ -14,12 +14,24 @@
 # You should have received a copy of the GNU General Public License along with
 # geomotion.  If not, see <http://www.gnu.org/licenses/>.
 
+import email.utils
+import hashlib
 import json
+import mimetypes
 import os
 import os.path
+import threading
+import urlparse
 import wsgiref.util
+import zlib
 
 import sm
+import sm.decimate
+import sm.instrument
+import sm.intensity
+import sm.pyramid
+import sm.record
+import sm.shakemap
 
 # The status code definitions specified in RFC2616.
 # See http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html
@@ -67,13 +79,71 @@ STATUS_CODE = {
     505: '505 HTTP VERSION NOT SUPPORTED',
 }
 
+# How long clients may cache record data before checking it again.
+RECORD_MAX_AGE = 86400
+
+# How many opened pyramids to keep for reuse.
+PYRAMID_CACHE_SIZE = 256
+
+# How many event listing responses to keep.
+EVENTS_CACHE_SIZE = 1024
+
+
+def etag_matches(environment, etag):
+    """Check whether a request's If-None-Match header matches an entity tag,
+    meaning the client already has the current version.
+
+    :param environment: The WSGI environment containing the request.
+    :type environment: dictionary
+    :param etag: The (quoted) entity tag of the current version.
+    :type etag: string
+
+    """
+    header = environment.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(',')]
+    tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+    return '*' in tags or etag in tags
+
+
+def accepts_gzip(environment):
+    """Check whether a request's Accept-Encoding header allows a gzip encoded
+    response.
+
+    :param environment: The WSGI environment containing the request.
+    :type environment: dictionary
+
+    """
+    for coding in environment.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        parts = [part.strip() for part in coding.split(';')]
+        if parts[0].lower() not in ('gzip', 'x-gzip'):
+            continue
+        for parameter in parts[1:]:
+            if parameter.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                return False
+        return True
+    return False
+
+
+def gzip_compress(content):
+    """Compress a string into the gzip format.
+
+    :param content: The string to compress.
+    :type content: string
+
+    """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(content) + compressor.flush()
+
+
 class Application(object):
     """A WSGI application to provide access to the strong motion data along with
     various ways to visualise it.
 
     """
 
-    def __init__(self, cache_path, media_path=None):
+    def __init__(self, cache_path, media_path=None, metrics=False):
         """
 
         :param cache_path: The path to the strong motion data cache to retrieve
@@ -83,6 +153,12 @@ class Application(object):
                            to ``None``, the media/ directory under the directory
                            containing this module will be used.
         :type media_path: string
+        :param metrics: Enable instrumentation (see :mod:`sm.instrument`) and
+                        serve the measurements at /metrics in the Prometheus
+                        text format. Measurements are kept per process, so
+                        with pre-forked workers each response only covers the
+                        worker which handled it.
+        :type metrics: Boolean
 
         """
         # The directory containing this module.
@@ -97,8 +173,41 @@ class Application(object):
         else:
             self.media_path = os.path.normpath(os.path.abspath(media_path))
 
-        # Start an instance of the server.
-        self.server = sm.Server(cache_dir=self.cache_path)
+        # Each thread (and each process, if the application is shared by
+        # pre-forked workers) gets its own instance of the server, as SQLite
+        # connections cannot be shared between them. See the server property.
+        self._local = threading.local()
+
+        # Pyramids which have been opened, keyed by their basename.
+        self._pyramids = {}
+
+        # Guards the pyramids and the event listings below, which are shared by
+        # the threads.
+        self._lock = threading.Lock()
+
+        # Responses to event listing requests, keyed by the normalised path.
+        # Each entry is a tuple of the entity tag, the JSON content and the
+        # gzipped content. These are all discarded when the generation of the
+        # event information in the cache changes.
+        self._events_cache = {}
+        self._events_generation = None
+
+        # Whether to serve the instrumentation measurements.
+        self.metrics = metrics
+        if metrics:
+            sm.instrument.enable()
+
+    @property
+    def server(self):
+        """The :class:`sm.Server` instance for the current thread, created the
+        first time it is used in each thread and process.
+
+        """
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.server = sm.Server(cache_dir=self.cache_path)
+            local.pid = os.getpid()
+        return local.server
 
     def __call__(self, environment, start_response):
         """Handle a WSGI request. This is the entry point for the WSGI
@@ -122,17 +231,34 @@ class Application(object):
 
         # Strong motion events.
         if path.startswith('/events'):
-            return self.serve_events(path[8:], start_response)
+            return self.serve_events(path[8:], environment, start_response)
+
+        # Record waveforms.
+        if path.startswith('/records/'):
+            return self.serve_record(path[9:], environment, start_response)
+
+        # Zoomable waveform tiles.
+        if path.startswith('/tiles/'):
+            return self.serve_tile(path[7:], environment, start_response)
+
+        # Intensity maps.
+        if path.startswith('/shakemaps/'):
+            return self.serve_shakemap(path[11:], start_response)
 
         # Static media files.
         if path.startswith('/media/'):
-            return self.serve_media(path[7:], start_response)
+            return self.serve_media(path[7:], environment, start_response)
+
+        # Instrumentation measurements.
+        if path == '/metrics' and self.metrics:
+            return self.serve_metrics(start_response)
 
         # No idea what they were after.
         start_response(STATUS_CODE[404], [])
         return ('File not found',)
 
-    def serve_events(self, path, start_response):
+    @sm.instrument.timed('wsgi.events')
+    def serve_events(self, path, environment, start_response):
         """Serve event information encoded as JSON (and with the corresponding
         application/json content type). This uses the following path formats:
 
@@ -146,21 +272,79 @@ class Application(object):
 
         If an invalid path is used, a 404 error is raised.
 
+        The listings only change when the events in the cache are updated, so
+        each response is built once and reused until the cache's ``events``
+        generation changes. Responses carry an entity tag so clients can
+        revalidate them cheaply, and are gzipped if the client accepts it.
+
         :param path: The path detailing the requested information.
         :type path: string
+        :param environment: The WSGI environment containing the request.
+        :type environment: dictionary
         :param start_response: The WSGI function to start a response.
         :type start_response: function
 
         """
-        # The headers to use.
-        headers = [('Content-type', 'application/json')]
-
         # Split the path up into chunks.
         chunks = [c for c in path.split('/') if c]
 
+        # Throw away any responses built from another version of the cache.
+        generation = self.server.get_generation('events')
+        key = '/'.join(chunks)
+        with self._lock:
+            if generation != self._events_generation:
+                self._events_cache.clear()
+                self._events_generation = generation
+            entry = self._events_cache.get(key)
+
+        # Build the response if we haven't already.
+        if entry is None:
+            content = self._events_content(chunks)
+            if content is None:
+                start_response(STATUS_CODE[404], [('Content-type', 'application/json')])
+                return ('File not found',)
+            etag = '{0}-{1}'.format(generation, hashlib.md5(content).hexdigest())
+            entry = (etag, content, gzip_compress(content))
+
+            # Another thread may have seen a new generation while this was
+            # built, in which case the response is not kept.
+            with self._lock:
+                if generation == self._events_generation:
+                    if len(self._events_cache) >= EVENTS_CACHE_SIZE:
+                        self._events_cache.clear()
+                    self._events_cache[key] = entry
+
+        # Pick the representation.
+        etag, content, compressed = entry
+        headers = [
+            ('Content-type', 'application/json'),
+            ('Cache-Control', 'no-cache'),
+            ('Vary', 'Accept-Encoding'),
+        ]
+        if accepts_gzip(environment):
+            etag = '"{0}-gzip"'.format(etag)
+            content = compressed
+            headers.append(('Content-Encoding', 'gzip'))
+        else:
+            etag = '"{0}"'.format(etag)
+        headers.append(('ETag', etag))
+
+        # The client already has it.
+        if etag_matches(environment, etag):
+            start_response(STATUS_CODE[304], headers)
+            return ()
+
+        headers.append(('Content-Length', str(len(content))))
+        start_response(STATUS_CODE[200], headers)
+        return (content,)
+
+    def _events_content(self, chunks):
+        """Helper function to build the JSON content of an event listing
+        request, returning None if the request is invalid.
+
+        """
         # No chunks: return a list of event years.
         if len(chunks) == 0:
-            start_response(STATUS_CODE[200], headers)
             return json.dumps(self.server.get_years())
 
         # One chunk - a year to return a list of months for.
@@ -168,9 +352,7 @@ class Application(object):
             try:
                 year = int(chunks[0])
             except ValueError:
-                start_response(STATUS_CODE[404], headers)
-                return ('File not found',)
-            start_response(STATUS_CODE[200], headers)
+                return None
             return json.dumps(self.server.get_months(year))
 
         # Two chunks - a year and month to return event dates for.
@@ -178,23 +360,300 @@ class Application(object):
             try:
                 year, month = map(int, chunks)
             except ValueError:
-                start_response(STATUS_CODE[404], headers)
-                return ('File not found',)
-            start_response(STATUS_CODE[200], headers)
+                return None
             events = self.server.get_events(year, month)
             events = [(event[0], event[1].ctime()) for event in events]
             return json.dumps(events)
 
         # Invalid number of arguments.
-        start_response(STATUS_CODE[404], headers)
-        return ('File not found',)
+        return None
+
+    def precompute_events(self):
+        """Build the responses to every valid event listing request ahead of
+        time, so the first request for each is as fast as the rest. This can be
+        called after updating the cache.
 
-    def serve_media(self, path, start_response):
-        """Serve a static media request.
+        """
+        start_response = lambda status, headers: None
+        self.serve_events('', {}, start_response)
+        for year in self.server.get_years():
+            self.serve_events('/{0}'.format(year), {}, start_response)
+            for month in self.server.get_months(year):
+                self.serve_events('/{0}/{1}'.format(year, month), {},
+                                  start_response)
+
+    @sm.instrument.timed('wsgi.record')
+    def serve_record(self, path, environment, start_response):
+        """Serve the acceleration of a record. This uses the path format
+        /<event>/<site>, with the following query parameters:
+
+            * ``format`` - either ``json`` (the default) or ``binary``.
+            * ``width`` - for JSON, the number of pixels the waveform will be
+                          drawn across. The data is decimated to suit. Defaults
+                          to 1000.
+            * ``method`` - for JSON, the decimation method. Either ``minmax``
+                           (the default), which returns the minimum and maximum
+                           of each pixel, or ``lttb``, which returns one chosen
+                           point per pixel for each axis.
+
+        The binary format is the full acceleration as little-endian float32
+        numbers, axis by axis, with the start time, timestep and number of
+        samples per axis in the X-Start, X-Timestep and X-Length headers.
+
+        As the data of a record never changes, the responses carry an entity
+        tag and clients are told they can cache them.
+
+        :param path: The path detailing the requested record.
+        :type path: string
+        :param environment: The WSGI environment containing the request.
+        :type environment: dictionary
+        :param start_response: The WSGI function to start a response.
+        :type start_response: function
+
+        """
+        # Parse the request.
+        chunks = [c for c in path.split('/') if c]
+        query = urlparse.parse_qs(environment.get('QUERY_STRING', ''))
+        try:
+            event, site = chunks
+            event = int(event)
+            format = query.get('format', ['json'])[0]
+            width = int(query.get('width', ['1000'])[0])
+            method = query.get('method', ['minmax'])[0]
+        except ValueError:
+            start_response(STATUS_CODE[404], [])
+            return ('File not found',)
+        if format not in ('json', 'binary') or method not in ('minmax', 'lttb') or width < 1:
+            start_response(STATUS_CODE[400], [])
+            return ('Invalid request parameters',)
+
+        # The entity tag depends on the data file and the representation.
+        try:
+            filename = self.server.get_record_filename(event, site)
+        except sm.NoSuchRecord:
+            start_response(STATUS_CODE[404], [])
+            return ('File not found',)
+        representation = '|'.join((filename, format, str(width), method))
+        etag = '"{0}"'.format(hashlib.md5(representation).hexdigest())
+        headers = [
+            ('ETag', etag),
+            ('Cache-Control', 'public, max-age={0}'.format(RECORD_MAX_AGE)),
+        ]
+
+        # The client already has it.
+        if etag_matches(environment, etag):
+            start_response(STATUS_CODE[304], headers)
+            return ()
+
+        try:
+            record = self.server.get_record(event, site)
+        except sm.record.TooFewComponents:
+            start_response(STATUS_CODE[404], [])
+            return ('File not found',)
+
+        if format == 'binary':
+            content = record.acceleration.astype('<f4').tostring()
+            headers.extend([
+                ('Content-type', 'application/octet-stream'),
+                ('X-Start', record.start.isoformat()),
+                ('X-Timestep', repr(record.timestep)),
+                ('X-Length', str(record.data_length)),
+            ])
+        else:
+            data = {
+                'start': record.start.isoformat(),
+                'timestep': record.timestep,
+                'length': record.data_length,
+                'method': method,
+            }
+            if method == 'minmax':
+                edges, minimum, maximum = sm.decimate.minmax(record.acceleration, width)
+                data['time'] = (edges * record.timestep).tolist()
+                data['minimum'] = minimum.tolist()
+                data['maximum'] = maximum.tolist()
+            else:
+                indices, values = sm.decimate.lttb(record.acceleration, width)
+                data['time'] = (indices * record.timestep).tolist()
+                data['acceleration'] = values.tolist()
+            content = json.dumps(data)
+            headers.append(('Content-type', 'application/json'))
+
+        headers.append(('Content-Length', str(len(content))))
+        start_response(STATUS_CODE[200], headers)
+        return (content,)
+
+    @sm.instrument.timed('wsgi.tile')
+    def serve_tile(self, path, environment, start_response):
+        """Serve the minimum and maximum acceleration of a record over a time
+        range, drawn from the record's pyramid (see :mod:`sm.pyramid`) so the
+        cost does not depend on the length of the record. This uses the path
+        format /<event>/<site>, with the following query parameters:
+
+            * ``start`` - the start of the range in seconds from the start of
+                          the record. Defaults to the start of the record.
+            * ``end`` - the end of the range in seconds from the start of the
+                        record. Defaults to the end of the record.
+            * ``width`` - the number of pixels the range will be drawn across.
+                          Defaults to 1000.
+
+        The pyramid is built if it does not exist yet, although normally it
+        will have been built in the background by
+        :func:`sm.pyramid.build_pyramids`.
+
+        :param path: The path detailing the requested record.
+        :type path: string
+        :param environment: The WSGI environment containing the request.
+        :type environment: dictionary
+        :param start_response: The WSGI function to start a response.
+        :type start_response: function
+
+        """
+        # Parse the request.
+        chunks = [c for c in path.split('/') if c]
+        query = urlparse.parse_qs(environment.get('QUERY_STRING', ''))
+        try:
+            event, site = chunks
+            event = int(event)
+            start = query.get('start', [None])[0]
+            start = None if start is None else float(start)
+            end = query.get('end', [None])[0]
+            end = None if end is None else float(end)
+            width = int(query.get('width', ['1000'])[0])
+        except ValueError:
+            start_response(STATUS_CODE[404], [])
+            return ('File not found',)
+        if width < 1:
+            start_response(STATUS_CODE[400], [])
+            return ('Invalid request parameters',)
+
+        # The entity tag depends on the data file and the requested tile.
+        try:
+            basename = sm.pyramid.pyramid_basename(self.server, event, site)
+        except sm.NoSuchRecord:
+            start_response(STATUS_CODE[404], [])
+            return ('File not found',)
+        representation = '|'.join(map(str, (basename, start, end, width)))
+        etag = '"{0}"'.format(hashlib.md5(representation).hexdigest())
+        headers = [
+            ('ETag', etag),
+            ('Cache-Control', 'public, max-age={0}'.format(RECORD_MAX_AGE)),
+        ]
+        if etag_matches(environment, etag):
+            start_response(STATUS_CODE[304], headers)
+            return ()
+
+        # Open the pyramid, building it if needed.
+        with self._lock:
+            pyramid = self._pyramids.get(basename)
+        if pyramid is None:
+            if not os.path.isfile(basename + '.json'):
+                try:
+                    record = self.server.get_record(event, site)
+                except sm.record.TooFewComponents:
+                    start_response(STATUS_CODE[404], [])
+                    return ('File not found',)
+                sm.pyramid.build_pyramid(record, basename)
+            pyramid = sm.pyramid.Pyramid(basename)
+            with self._lock:
+                if len(self._pyramids) >= PYRAMID_CACHE_SIZE:
+                    self._pyramids.clear()
+                self._pyramids[basename] = pyramid
+
+        time, minimum, maximum = pyramid.tile(start, end, width)
+        content = json.dumps({
+            'start': pyramid.start,
+            'timestep': pyramid.timestep,
+            'length': pyramid.length,
+            'time': time.tolist(),
+            'minimum': minimum.tolist(),
+            'maximum': maximum.tolist(),
+        })
+        headers.extend([
+            ('Content-type', 'application/json'),
+            ('Content-Length', str(len(content))),
+        ])
+        start_response(STATUS_CODE[200], headers)
+        return (content,)
+
+    @sm.instrument.timed('wsgi.shakemap')
+    def serve_shakemap(self, path, start_response):
+        """Serve an interpolated intensity map of an event, creating it if it
+        has not been created before. This uses the path format
+        /<event>/<measure>.<extension>, where the measure is one of the fields
+        of :data:`sm.intensity.MEASURES`. The .json extension returns a
+        description of the grid, and the .f32 extension returns the values as
+        little-endian float32 numbers (see :meth:`sm.shakemap.ShakeMap.save`).
+
+        :param path: The path detailing the requested map.
+        :type path: string
+        :param start_response: The WSGI function to start a response.
+        :type start_response: function
+
+        """
+        # Split the path into the event, measure and extension.
+        chunks = [c for c in path.split('/') if c]
+        try:
+            event, filename = chunks
+            event = int(event)
+            measure, extension = filename.rsplit('.', 1)
+        except ValueError:
+            start_response(STATUS_CODE[404], [])
+            return ('File not found',)
+        content_types = {
+            'json': 'application/json',
+            'f32': 'application/octet-stream',
+        }
+        if measure not in sm.intensity.MEASURES.names or extension not in content_types:
+            start_response(STATUS_CODE[404], [])
+            return ('File not found',)
+
+        # Create the map if needed.
+        basename = sm.shakemap.shakemap_basename(self.server, event, measure)
+        if not os.path.isfile(basename + '.' + extension):
+            try:
+                sm.shakemap.event_shakemap(self.server, event, measure)
+            except sm.NoSuchRecord:
+                start_response(STATUS_CODE[404], [])
+                return ('File not found',)
+
+        f = open(basename + '.' + extension, 'rb')
+        content = f.read()
+        f.close()
+        start_response(STATUS_CODE[200], [
+            ('Content-type', content_types[extension]),
+            ('Content-Length', str(len(content))),
+        ])
+        return (content,)
+
+    def serve_metrics(self, start_response):
+        """Serve the counters and latency histograms collected by
+        :mod:`sm.instrument` in the Prometheus text exposition format.
+
+        :param start_response: The WSGI function to start a response.
+        :type start_response: function
+
+        """
+        content = sm.instrument.prometheus()
+        start_response(STATUS_CODE[200], [
+            ('Content-Type', 'text/plain; version=0.0.4'),
+            ('Content-Length', str(len(content))),
+            ('Cache-Control', 'no-cache'),
+        ])
+        return (content,)
+
+    @sm.instrument.timed('wsgi.media')
+    def serve_media(self, path, environment, start_response):
+        """Serve a static media request. The response carries the length, type,
+        modification time and an entity tag of the file so it can be cached,
+        conditional requests are answered with 304 when the file has not
+        changed, and a single byte range can be requested with the Range
+        header.
 
         :param path: The path of the requested file relative to the applications
                      media path.
         :type path: string
+        :param environment: The WSGI environment containing the request.
+        :type environment: dictionary
         :param start_response: The WSGI function to start a response.
         :type start_response: function
 
@@ -204,8 +663,7 @@ class Application(object):
 
         # Make sure it is in the media directory (unlikely it won't be, but
         # better safe than sorry).
-        common = os.path.commonprefix((self.media_path, filename))
-        if not common == self.media_path:
+        if not filename.startswith(self.media_path + os.sep):
             start_response(STATUS_CODE[403], [])
             return ('You do not have permission to access this file.',)
 
@@ -214,6 +672,77 @@ class Application(object):
             start_response(STATUS_CODE[404], [])
             return ('File not found',)
 
-        # Return the contents of the file.
-        start_response('200 OK', [])
-        return wsgiref.util.FileWrapper(open(filename, 'r'))
+        # Validators for the file.
+        stat = os.stat(filename)
+        size = stat.st_size
+        etag = '"{0:x}-{1:x}"'.format(int(stat.st_mtime), size)
+        headers = [
+            ('ETag', etag),
+            ('Last-Modified', email.utils.formatdate(stat.st_mtime, usegmt=True)),
+            ('Accept-Ranges', 'bytes'),
+            ('Cache-Control', 'public, max-age=3600'),
+        ]
+
+        # Does the client already have it?
+        if 'HTTP_IF_NONE_MATCH' in environment:
+            unchanged = etag_matches(environment, etag)
+        else:
+            since = environment.get('HTTP_IF_MODIFIED_SINCE')
+            since = email.utils.parsedate_tz(since) if since else None
+            unchanged = (since is not None and
+                         int(stat.st_mtime) <= email.utils.mktime_tz(since))
+        if unchanged:
+            start_response(STATUS_CODE[304], headers)
+            return ()
+
+        content_type = mimetypes.guess_type(filename)[0]
+        headers.append(('Content-type', content_type or 'application/octet-stream'))
+
+        # A range request. Only a single range is supported; anything else gets
+        # the whole file, which the specification allows.
+        first, last = 0, size - 1
+        status = STATUS_CODE[200]
+        requested = environment.get('HTTP_RANGE', '')
+        if requested.startswith('bytes=') and ',' not in requested:
+            try:
+                start, end = requested[6:].strip().split('-')
+                if start:
+                    first = int(start)
+                    last = min(int(end), size - 1) if end else size - 1
+                else:
+                    first = max(size - int(end), 0)
+            except ValueError:
+                first, last = 0, size - 1
+            else:
+                if first > last or first >= size:
+                    headers.append(('Content-Range', 'bytes */{0}'.format(size)))
+                    start_response(STATUS_CODE[416], headers)
+                    return ()
+                status = STATUS_CODE[206]
+                headers.append(('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                    first, last, size)))
+
+        # Return the requested part of the file.
+        headers.append(('Content-Length', str(last - first + 1)))
+        start_response(status, headers)
+        f = open(filename, 'rb')
+        if status == STATUS_CODE[200]:
+            return environment.get('wsgi.file_wrapper', wsgiref.util.FileWrapper)(f)
+        f.seek(first)
+        return _read_range(f, last - first + 1)
+
+
+def _read_range(f, length, block=65536):
+    """Helper generator to yield a given number of bytes from a file in blocks,
+    closing the file afterwards.
+
+    """
+    try:
+        while length > 0:
+            data = f.read(min(block, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()